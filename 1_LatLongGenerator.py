@@ -14,107 +14,89 @@
 
 import pandas as pd
 import os
-import googlemaps
+from ParallelRunner import stage_arg_parser, run_files, pool_size
+from GeocodeCache import GeocodeCache, DEFAULT_CACHE
+from GeocodeResolver import (locate_postal_codes, load_postal_code_lookup,
+                             worker_rps, DEFAULT_RPS, DEFAULT_THREADS)
+from Metrics import metrics
 
-# Google Maps API Key
-key = "Enter key here"
-gmaps = googlemaps.Client(key)
 
+# Return the frame of PostalCode, Latitude, Longitude for the postal codes
+# of the start file frame df
+def lat_long_frame(df, lat_lookup, long_lookup, cache=None,
+                   rps=DEFAULT_RPS, threads=DEFAULT_THREADS):
+    # Convert the postal code column to a list
+    postalCodeList = df['Postal Code'].tolist()
 
-def gmap_lookup(postalCode):
-    
-    # Try looking up Lat/Long from Google Maps Geo-Coding API
-    print(postalCode + ' lookup being done with Google Maps')
-            
-    geocode_result = gmaps.geocode(postalCode+', Canada')[0]
-    lat  = geocode_result["geometry"]["location"]["lat"]
-    long = geocode_result["geometry"]["location"]["lng"]
-
-    # Check to see if Gmaps returned a null value
-    # Null value is encoded as: (56.130366, -106.346771) 
-    # eg. this happens for E1C0T5
-    epsilon = 0.000001
-    latDiff  = abs(lat  - 56.130366)
-    longDiff = abs(long + 106.346771)
-                        
-    # Need to use this for floating point compare 
-    if (latDiff < epsilon and longDiff < epsilon):
-        gotResult = 0
-    else:
-        gotResult = 1
-        
-    return (gotResult, lat, long)
-
-
-def generate_lat_long(directory, filename, lat_lookup, long_lookup):
+    # Lookup the Lat/Long of every postal code
+    locationList = locate_postal_codes(postalCodeList, lat_lookup, long_lookup,
+                                       None, cache, rps, threads)
+    metrics.add_rows(len(postalCodeList))
+
+    final_labels = ['PostalCode', 'Latitude', 'Longitude']    
+    return pd.DataFrame.from_records(locationList, columns=final_labels)
+
+
+def generate_lat_long(directory, filename, lat_lookup, long_lookup,
+                      cache_path=None, cache_ttl=None, 
+                      rps=DEFAULT_RPS, threads=DEFAULT_THREADS):
     print('Working on.... ' + filename)
 
+    # Each worker opens its own connection to the shared geocode cache
+    cache = None
+    if (cache_path is not None):
+        cache = GeocodeCache(cache_path, cache_ttl)
+
     # Read the source
     df = pd.read_csv(directory+'/'+filename, header=0)
     
-    # Convert the postal code column to a list
-    postalCodeList = df['Postal Code'].tolist()
-
-    locationList = []
-    
-    # Loop through all postal codes
-    for pc in postalCodeList:
-        
-        # The following two postal codes need to modified slightly to get 
-        # the correct lookup
-        #A1E0G5 -> A1E0B9
-        #V3Z9R6 -> V3S9R2
-        if (pc == "A1E0G5"):
-            postalCode = "A1E0B9"
-        elif (pc == "V3Z9R6"):
-            postalCode = "V3S9R2" 
-        else:
-            postalCode = pc       
-        
-        gotResult = 0 
-        # Lookup Lat/Long based on values from the CSV
-        if postalCode in lat_lookup: 
-            lat  = lat_lookup[postalCode]
-            long = long_lookup[postalCode]
-            gotResult = 1
-                         
-        # Try looking up Lat/Long from Google Maps Geo-Coding API
-        if (gotResult is 0): 
-            (gotResult, lat, long) = gmap_lookup(postalCode)
-            
-        # Try looking up Lat/Long from Google Maps Geo-Coding API
-        # Using FSA (first 3 char of postal code)
-        if (gotResult is 0): 
-            (gotResult, lat, long) = gmap_lookup(postalCode[:3])
-                        
-        if (gotResult is 1): 
-            locationList.append((pc, lat, long))
-        else:
-            print("***ERROR***: Did not find lat/long for ", postalCode)
+    final_df = lat_long_frame(df, lat_lookup, long_lookup, cache, 
+                              rps, threads)
 
     # Write the data to a new CSV to allow comparision
-    final_labels = ['PostalCode', 'Latitude', 'Longitude']    
-    final_df = pd.DataFrame.from_records(locationList, columns=final_labels)
     final_df.set_index('PostalCode', inplace=True)
     final_df.to_csv('2_LatLongLists/' + filename)
+
+    if (cache is not None):
+        print('Geocode cache hits:', cache.hits, ' misses:', cache.misses)
+        cache.close()
     print('Done with.... ' + filename)
 
 
-def main_program():
+def main_program(argv=None):
+    parser = stage_arg_parser('Lookup the Lat/Long of every postal code '
+                              'in the start files')
+    parser.add_argument('--cache', default=DEFAULT_CACHE,
+                        help='geocode cache file shared across runs')
+    parser.add_argument('--cache-ttl', type=float, default=None,
+                        help='days after which a cached geocode is looked '
+                             'up again (default: never)')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='always use the Google Maps API')
+    parser.add_argument('--rps', type=float, default=DEFAULT_RPS,
+                        help='maximum geocode requests per second, shared '
+                             'by all workers')
+    parser.add_argument('--geocode-threads', type=int, default=DEFAULT_THREADS,
+                        help='geocode requests sent at the same time')
+    args = parser.parse_args(argv)
+    metrics.start(args.metrics, args.progress)
+    cache_path = None if args.no_cache else args.cache
     
-    # Load postal code lookup csv into a pandas dataframe
-    pc_df = pd.read_csv('1_PostalCodes/CanadianPostalCodes.csv', header=0)
-    pc_df.set_index('PostalCode', inplace=True)
-
-    # Covert the data frame to a dictionary
-    pc_lookup = pc_df.to_dict()
-    lat_lookup  = pc_lookup['Latitude']
-    long_lookup = pc_lookup['Longitude']
+    # Load postal code lookup csv
+    (lat_lookup, long_lookup) = load_postal_code_lookup()
     
     directory = '1_StartFiles'
+
+    # The workers share the request rate
+    rps = worker_rps(args.rps, pool_size(directory, args.workers))
+
     # Loop through all files in the directory
-    for filename in os.listdir(directory):
-        generate_lat_long(directory, filename, lat_lookup, long_lookup)
+    run_files(generate_lat_long, directory, args.workers, 
+              args=(lat_lookup, long_lookup, cache_path, args.cache_ttl,
+                    rps, args.geocode_threads), 
+              stage='1_LatLongGenerator')
+    metrics.save()
     
-main_program()
+if __name__ == '__main__':
+    main_program()
 
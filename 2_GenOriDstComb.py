@@ -14,47 +14,93 @@
 # Trick 1: Look up Lat/Long before doing combolist to reduce 
 # the number of lat/long lookups. Effectively, we are creating 
 # a cache of data which speeds things up
+#
+# Trick 2: Sites at the same location (same postal code, or the same FSA
+# centre) have the same LOSD to everything, so each pair of locations is
+# only measured once and copied to its pairs of sites (see SiteDedup.py).
+# --weighted-totals only prints the aggregates, from the unique location
+# pairs weighted by their number of site pairs, without writing any rows.
 
-import itertools
 import pandas as pd
 import os
 import datetime
-from geopy.distance import vincenty
+import numpy as np
+from GeoDistance import METHODS
+from PairStream import iter_pair_chunks, pair_count, LosdBucketWriter
+from SiteDedup import unique_locations, dedup_losd, weighted_totals
+from TiledPairs import write_tiled, DEFAULT_TILE_PAIRS
+from ParallelRunner import stage_arg_parser, run_files
+from Metrics import metrics
+from ColumnStore import STORE_FORMATS, store_written
+from NeighborIndex import (FAR_DIR, radius_pairs, write_far_summary, 
+                           remove_far_summary)
 
-def calculate_losd(comboList, lat_lookup, long_lookup):    
+FINAL_LABELS = ['Origin', 'Destination', 'LOSD',
+                'OriLat', 'OriLng',
+                'DstLat', 'DstLng']
+
+# Column types of the combinations
+COMBO_DTYPES = {'Origin': str, 'Destination': str, 'LOSD': np.int64,
+                'OriLat': np.float64, 'OriLng': np.float64,
+                'DstLat': np.float64, 'DstLng': np.float64}
+
+# Return the list of all combinations of the sites (in the order of 
+# itertools.combinations) with their LOSD and Lat/Long
+def calculate_losd(postalCodes, lats, lngs, method='vincenty'):    
     print ("Starting LOSD Calculations. Time: " 
            + str(datetime.datetime.now().strftime('%H:%M:%S'))) 
-     
-    losdList = []
-    i = 0
-    
-    # Iterate through the list of combinations of origins and destinations
-    for combo in comboList:
 
-        if (i%1000 is 0):
-            print(str(i) + ". Time: " 
-                  + str(datetime.datetime.now().strftime('%H:%M:%S')))
-        i+=1
-                
-        origin = combo[0]
-        dest   = combo[1]
-
-        # Get Lat/Long     
-        oriLat = lat_lookup[origin]
-        oriLng = long_lookup[origin]
-        dstLat = lat_lookup[dest]
-        dstLng = long_lookup[dest]
-    
-        # Get the Line of Sight Distance (LOSD) between origin(latitude,longitude)
-        # and destination(latitude,longitude)           
-        losd = vincenty((oriLat, oriLng), 
-                        (dstLat, dstLng)).kilometers
-        
-        losdList.append((origin, dest, round(losd), oriLat, oriLng, dstLat, dstLng))
-        
+    # Origin and destination of every combination, in one chunk
+    noPairs = (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64))
+    (oriIdx, dstIdx) = next(iter_pair_chunks(len(postalCodes), 
+                                             pair_count(len(postalCodes))), 
+                            noPairs)
+
+    # Get the Line of Sight Distance (LOSD) between origin(latitude,longitude)
+    # and destination(latitude,longitude) for all combinations in one go,
+    # once per pair of locations
+    (losds, measured) = dedup_losd(lats, lngs, oriIdx, dstIdx, method)
+
+    losdList = list(zip(postalCodes[oriIdx].tolist(), 
+                        postalCodes[dstIdx].tolist(), losds.tolist(), 
+                        lats[oriIdx].tolist(), lngs[oriIdx].tolist(), 
+                        lats[dstIdx].tolist(), lngs[dstIdx].tolist()))
+
+    print ("Done LOSD Calculations. Pairs: " + str(len(losdList)) + 
+           " (measured: " + str(measured) + "). Time: " 
+           + str(datetime.datetime.now().strftime('%H:%M:%S'))) 
+
     return losdList
 
-def generate_combinations(directory, filename):
+def generate_combinations(directory, filename, stream=False, 
+                          chunk_size=1000000, method='vincenty', radius=None,
+                          tile_workers=None, tile_pairs=DEFAULT_TILE_PAIRS,
+                          totals_only=False, store='csv'):
+    if (totals_only):
+        return region_totals(directory, filename, chunk_size, method)
+
+    result = write_combinations(directory, filename, stream, chunk_size, 
+                                method, radius, tile_workers, tile_pairs)
+
+    # The combinations are written as CSV by every mode, and then turned 
+    # into Parquet with --store parquet (see ColumnStore.py)
+    store_written('3_ComboLists', filename, store, chunk_size, COMBO_DTYPES)
+    return result
+
+# Write the combinations of a region to 3_ComboLists with the mode asked for
+def write_combinations(directory, filename, stream=False, chunk_size=1000000,
+                       method='vincenty', radius=None, tile_workers=None,
+                       tile_pairs=DEFAULT_TILE_PAIRS):
+    if (radius is not None):
+        return generate_combinations_radius(directory, filename, radius,
+                                            chunk_size, method)
+    if (tile_workers is not None):
+        return generate_combinations_tiled(directory, filename, tile_workers,
+                                           chunk_size, method, tile_pairs)
+    if (stream):
+        return generate_combinations_stream(directory, filename, 
+                                            chunk_size, method)
+
     print('Working on.... ' + filename)
 
     ll_dir = '2_LatLongLists'
@@ -64,59 +110,255 @@ def generate_combinations(directory, filename):
     
     # Read the lookup lists
     lat_lng_df = pd.read_csv(ll_dir+'/'+filename, header=0)
-    lat_lng_df.set_index('PostalCode', inplace=True)
 
-    # Covert the lookup data frame to a dictionary
-    ll_lookup = lat_lng_df.to_dict()
-    lat_lookup  = ll_lookup['Latitude']
-    long_lookup = ll_lookup['Longitude']
+    final_df = combination_frame(df, lat_lng_df, method)
     
-    # Convert the postal code column to a list
-    postalCodeList = df['Postal Code'].tolist()
+    # Calculate Aggregates
+    avg = round(final_df['LOSD'].mean())
+    total = final_df['LOSD'].sum()
+    cnt = len(final_df)
+    print(filename, avg, total, cnt)
     
-    # Create a new list with all the combinations 
-    comboList = list(itertools.combinations(postalCodeList, 2))
+    # Write the data to a new CSV to allow comparision
+    final_df.set_index('Origin', inplace=True)
+    final_df.to_csv('3_ComboLists/' + filename)
+    remove_far_summary(filename)
+    print('Done with.... ' + filename)
 
-    # Calculate Line of Sight    
-    losdList = calculate_losd(comboList, lat_lookup, long_lookup)
+    return (filename, avg, total, cnt)
+
+# Return the frame of all combinations of the postal codes of the start
+# file frame df, with their LOSD, in LOSD order
+def combination_frame(df, lat_lng_df, method='vincenty'):
+    postalCodes, lats, lngs = sites_from_frames(df, lat_lng_df)
+
+    # Calculate Line of Sight for all the combinations
+    losdList = calculate_losd(postalCodes, lats, lngs, method)
 
     # Sort the list 
     losdList.sort(key=lambda tup: tup[2])
 
     # Create a Pandas Dataframe
-    final_labels = ['Origin', 'Destination', 'LOSD', 
-                    'OriLat', 'OriLng', 
-                    'DstLat', 'DstLng']    
-    final_df = pd.DataFrame.from_records(losdList, columns=final_labels)
+    final_df = pd.DataFrame.from_records(losdList, columns=FINAL_LABELS)
     
+    metrics.add_rows(len(final_df))
+
     # LOSD of 0 is updated to 1 as you may have atleast 1 km to drive
     # Note this will have negligible effect on the overall result
-    final_df = final_df.replace(0, 1)
+    return final_df.replace(0, 1)
+
+# Return one entry per site of the start file frame df as arrays, pairs
+# are then built from the positions in these arrays
+def sites_from_frames(df, lat_lng_df):
+    lat_lng_df = lat_lng_df.set_index('PostalCode')
+
+    # Covert the lookup data frame to a dictionary
+    ll_lookup = lat_lng_df.to_dict()
+    lat_lookup  = ll_lookup['Latitude']
+    long_lookup = ll_lookup['Longitude']
+    
+    postalCodes = np.array(df['Postal Code'].tolist(), dtype=object)
+    lats = np.array([lat_lookup[pc]  for pc in postalCodes], dtype=np.float64)
+    lngs = np.array([long_lookup[pc] for pc in postalCodes], dtype=np.float64)
+
+    return (postalCodes, lats, lngs)
+
+# Read the start file and the Lat/Long list and return one entry per site
+def load_sites(directory, filename):
+    ll_dir = '2_LatLongLists'
+    
+    # Read the source
+    df = pd.read_csv(directory+'/'+filename, header=0)
     
+    # Read the lookup lists
+    lat_lng_df = pd.read_csv(ll_dir+'/'+filename, header=0)
+
+    return sites_from_frames(df, lat_lng_df)
+
+# Build the per pair frame for the given site indices
+def pair_frame(postalCodes, lats, lngs, oriIdx, dstIdx, losd):
+    return pd.DataFrame({'Origin': postalCodes[oriIdx],
+                         'Destination': postalCodes[dstIdx],
+                         'LOSD': losd,
+                         'OriLat': lats[oriIdx],
+                         'OriLng': lngs[oriIdx],
+                         'DstLat': lats[dstIdx],
+                         'DstLng': lngs[dstIdx]},
+                        columns=FINAL_LABELS)
+
+# Streaming version of generate_combinations. Pairs are generated, 
+# measured and written chunk_size at a time, so memory stays flat 
+# regardless of the size of the start file. The output file is the same 
+# as the one written by generate_combinations.
+def generate_combinations_stream(directory, filename, chunk_size=1000000, 
+                                 method='vincenty', tmp_dir=None):
+    print('Working on.... ' + filename + ' (streaming)')
+
+    postalCodes, lats, lngs = load_sites(directory, filename)
+    locations = unique_locations(lats, lngs)
+
+    total = 0
+    cnt = 0
+    measured = 0
+    pairCnt = pair_count(len(postalCodes))
+
+    with LosdBucketWriter(FINAL_LABELS, tmp_dir=tmp_dir) as writer:
+        for (oriIdx, dstIdx) in iter_pair_chunks(len(postalCodes), chunk_size):
+            (losd, chunkMeasured) = dedup_losd(lats, lngs, oriIdx, dstIdx,
+                                               method, locations)
+            measured += chunkMeasured
+
+            chunk_df = pair_frame(postalCodes, lats, lngs, 
+                                  oriIdx, dstIdx, losd)
+
+            # LOSD of 0 is updated to 1 as you may have atleast 1 km to drive
+            # The bucket is still picked on the original LOSD so that the
+            # 0 km pairs come before the 1 km pairs, as with the full sort
+            chunk_df = chunk_df.replace(0, 1)
+            writer.add(chunk_df, key_values=losd)
+
+            total += int(chunk_df['LOSD'].sum())
+            cnt += len(chunk_df)
+            metrics.add_rows(len(chunk_df))
+            metrics.progress(cnt, pairCnt, 'pairs')
+            print(str(cnt) + " pairs. Time: " 
+                  + str(datetime.datetime.now().strftime('%H:%M:%S')))
+
+        # Write the data to a new CSV in LOSD order
+        writer.merge('3_ComboLists/' + filename)
+    remove_far_summary(filename)
+
     # Calculate Aggregates
-    avg = round(final_df['LOSD'].mean())
-    total = final_df['LOSD'].sum()
-    cnt = len(final_df)
+    avg = round(total / cnt) if cnt > 0 else float('nan')
+    print(filename, avg, total, cnt, "(measured: " + str(measured) + ")")
+    print('Done with.... ' + filename)
+
+    return (filename, avg, total, cnt)
+
+# Aggregates of generate_combinations from the unique locations of the 
+# sites, no combinations are written
+def region_totals(directory, filename, chunk_size=1000000, 
+                  method='vincenty'):
+    print('Working on.... ' + filename + ' (weighted totals)')
+
+    postalCodes, lats, lngs = load_sites(directory, filename)
+    locations = unique_locations(lats, lngs)
+    (total, cnt) = weighted_totals(lats, lngs, method, chunk_size, locations)
+    metrics.add_rows(cnt)
+
+    avg = round(total / cnt) if cnt > 0 else float('nan')
+    print(filename, avg, total, cnt, 
+          "(locations: " + str(len(locations[0])) + ")")
+    print('Done with.... ' + filename)
+
+    return (filename, avg, total, cnt)
+
+# Tiled version of generate_combinations for very large regions. The pairs
+# are measured and written by tile_workers processes (see TiledPairs.py),
+# the output file is the same as the one written by generate_combinations.
+def generate_combinations_tiled(directory, filename, tile_workers=0,
+                                chunk_size=1000000, method='vincenty',
+                                tile_pairs=DEFAULT_TILE_PAIRS, tmp_dir=None):
+    print('Working on.... ' + filename + ' (tiled)')
+
+    postalCodes, lats, lngs = load_sites(directory, filename)
+    (total, cnt, u300Cost, o300Cost) = write_tiled(
+        '3_ComboLists/' + filename, FINAL_LABELS, postalCodes, lats, lngs,
+        tile_workers if tile_workers > 0 else None, method, chunk_size,
+        tile_pairs, tmp_dir)
+    remove_far_summary(filename)
+    metrics.add_rows(cnt)
+
+    # Calculate Aggregates
+    avg = round(total / cnt) if cnt > 0 else float('nan')
     print(filename, avg, total, cnt)
+    print('LOSD cost under 300 km:', u300Cost, ' over 300 km:', o300Cost)
+    print('Done with.... ' + filename)
+
+    return (filename, avg, total, cnt)
+
+# Return the frame of the pairs under radius km in LOSD order, and the 
+# far pair summary of the others
+def radius_frame(postalCodes, lats, lngs, radius=300, chunk_size=1000000, 
+                 method='vincenty'):
+    (oriIdx, dstIdx, losd, far_df) = radius_pairs(postalCodes, lats, lngs, 
+                                                  radius, method, chunk_size)
+    final_df = pair_frame(postalCodes, lats, lngs, oriIdx, dstIdx, losd)
+    metrics.add_rows(len(final_df) + int(far_df['Count'].sum()))
+
+    # LOSD of 0 is updated to 1 as you may have atleast 1 km to drive
+    return (final_df.replace(0, 1), far_df)
+
+# Radius bounded version of generate_combinations. Only the pairs with an
+# LOSD under radius km are written as rows to 3_ComboLists, the pairs over
+# it are counted by postal code prefix and LOSD in 3_FarSummaries. The 
+# aggregates cover all pairs, the same as generate_combinations.
+def generate_combinations_radius(directory, filename, radius=300, 
+                                 chunk_size=1000000, method='vincenty'):
+    print('Working on.... ' + filename + ' (pairs under ' + 
+          str(radius) + ' km)')
+
+    postalCodes, lats, lngs = load_sites(directory, filename)
+    (final_df, far_df) = radius_frame(postalCodes, lats, lngs, radius,
+                                      chunk_size, method)
+
+    # Calculate Aggregates over the rows and the far pairs
+    farCnt = int(far_df['Count'].sum())
+    total = (int(final_df['LOSD'].sum()) + 
+             int((far_df['LOSD'] * far_df['Count']).sum()))
+    cnt = len(final_df) + farCnt
+    avg = round(total / cnt) if cnt > 0 else float('nan')
+    print(filename, avg, total, cnt, "(rows: " + str(len(final_df)) + ")")
     
     # Write the data to a new CSV to allow comparision
     final_df.set_index('Origin', inplace=True)
     final_df.to_csv('3_ComboLists/' + filename)
+    write_far_summary(filename, far_df)
     print('Done with.... ' + filename)
 
     return (filename, avg, total, cnt)
 
-def main_program():
-    directory = '1_StartFiles'
+def main_program(argv=None):
+    parser = stage_arg_parser('Generate the origin and destination '
+                              'combinations and their LOSD')
+    parser.add_argument('--stream', action='store_true',
+                        help='generate and write the pairs in chunks')
+    parser.add_argument('--chunk-size', type=int, default=1000000,
+                        help='pairs per chunk in streaming mode')
+    parser.add_argument('--method', choices=METHODS, default='vincenty',
+                        help='distance formula used for the LOSD')
+    parser.add_argument('--radius', type=int, default=None,
+                        help='only write rows for pairs under this LOSD (km), '
+                             'count the others in ' + FAR_DIR)
+    parser.add_argument('--tile-workers', type=int, default=None,
+                        help='measure and write the pairs of each region in '
+                             'tiles with this many processes (0: one per '
+                             'core), for very large regions')
+    parser.add_argument('--tile-pairs', type=int, default=DEFAULT_TILE_PAIRS,
+                        help='pairs per tile with --tile-workers')
+    parser.add_argument('--weighted-totals', action='store_true',
+                        help='only print the aggregates, from the unique '
+                             'locations of the sites, without writing the '
+                             'combinations')
+    parser.add_argument('--store', choices=STORE_FORMATS, default='csv',
+                        help='format of the files written to 3_ComboLists')
+    args = parser.parse_args(argv)
+    metrics.start(args.metrics, args.progress)
 
-    results = []
+    directory = '1_StartFiles'
 
-    for filename in os.listdir(directory):
-        result = generate_combinations(directory, filename)
-        results.append(result)
+    results = run_files(generate_combinations, directory, args.workers,
+                        args=(args.stream, args.chunk_size, args.method,
+                              args.radius, args.tile_workers, 
+                              args.tile_pairs, args.weighted_totals,
+                              args.store),
+                        stage='2_GenOriDstComb')
     
     for result in results:
         print(result)
+
+    metrics.save()
     
-main_program()
+if __name__ == '__main__':
+    main_program()
 
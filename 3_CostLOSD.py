@@ -9,7 +9,7 @@
 # This file calculates the cost for the Line of Sight Distance (LOSD) between
 # all origin and destination combinations.
 #
-# Cost Rules are as follows:   
+# Cost Rules are as follows (see LOSD_COST_RULES in CostRules.py):   
 # Flight Costs Rules
 # Ontario-Nunavut (X) - $2000
 # # BC-Yukon (Y) - $1000
@@ -24,84 +24,113 @@
 
 import pandas as pd
 import os
+from ParallelRunner import stage_arg_parser, run_files
+from CostRules import LOSD_COST_RULES, apply_rules, zero_to_default
+from NeighborIndex import read_far_summary
+from LookupJournal import remove_journal
+from Metrics import metrics
+from ColumnStore import STORE_FORMATS, read_region, write_region
+from DrivingDistCache import (DrivingDistCache, DEFAULT_DD_CACHE, 
+                              prefill_driving_dist)
 
-def generate_costs(directory, filename):
-    print('Working on.... ' + filename)
+# Add the LOSD cost and the (empty) driving distance columns to the 
+# combinations of df
+def add_cost_columns(df):
+    # If losd is 0, it means the clinics are close by
+    # However, there is some cost to drive from clinic to clinic 
+    # Assume a cost based on distance of 5km. 
+    losd = zero_to_default(df['LOSD'].values)
 
-    # Read the source
-    df = pd.read_csv(directory+'/'+filename, header=0)
-     
-    cost_list   = []
-    dd_list     = []
-    update_list = []
-    mult_list   = []
-    
-    # Iterate through the list of combinations of origins and destinations
-    for series_index, row in df.iterrows():
-        
-        if (series_index%10000 is 0):
-            print(series_index)
-        
-        # Load row into variables
-        origin = df.Origin[series_index]
-        dest   = df.Destination[series_index]
-        losd   = df.LOSD[series_index]
-        
-        # If losd is 0, it means the clinics are close by
-        # However, there is some cost to drive from clinic to clinic 
-        # Assume a cost based on distance of 5km. 
-        if (losd == 0):
-            losd = 5
-        
-        if (origin[:1] == 'X' and dest[:1] != 'X'):
-            cost = 2000
-        elif (origin[:1] != 'X' and dest[:1] == 'X'):
-            cost = 2000
-        elif (origin[:1] == 'Y' and dest[:1] != 'Y'):
-            cost = 1000
-        elif (origin[:1] != 'Y' and dest[:1] == 'Y'):
-            cost = 1000
-        elif(losd >= 500):
-            cost = 600
-        elif(losd >= 300):
-            cost = 400
-        else:
-            cost = (0.5 * losd)        
-            
-        cost_list.append(cost)
-        dd_list.append(0)
-        update_list.append(0)
-        mult_list.append(1)
-    
-    df['LOSD_Cost']   = cost_list
-    df['DrivingDist'] = dd_list
-    df['Update']      = update_list
-    df['Mult']        = mult_list
-            
-    # Calculate Aggregates
+    # Apply the cost rules to all combinations of origins and destinations
+    df['LOSD_Cost']   = apply_rules(LOSD_COST_RULES, df['Origin'].values, 
+                                    df['Destination'].values, losd)
+    df['DrivingDist'] = 0
+    df['Update']      = 0
+    df['Mult']        = 1
+    return df
+
+# Region aggregates of the LOSD and its cost, over the rows of df and the
+# pairs of the far summary (if any)
+def losd_aggregates(df, far_df=None):
     avg = round(df['LOSD'].mean())
     total = df['LOSD'].sum()
     cnt = len(df)
     totalCost = round(df['LOSD_Cost'].sum())
+
+    # Add the pairs over the radius that were only counted by stage 2
+    if (far_df is not None and len(far_df) > 0):
+        farCount = far_df['Count'].values
+        farCost = apply_rules(LOSD_COST_RULES, far_df['OriPrefix'].values, 
+                              far_df['DstPrefix'].values, 
+                              zero_to_default(far_df['LOSD'].values))
+        total = total + (far_df['LOSD'].values * farCount).sum()
+        cnt = cnt + int(farCount.sum())
+        avg = round(total / cnt)
+        totalCost = round(df['LOSD_Cost'].sum() + (farCost * farCount).sum())
+
+    return (avg, total, cnt, totalCost)
+
+# Return the combinations of df with their LOSD cost, pre-filled from the
+# driving distance cache, and the region aggregates
+def cost_frame(df, far_df=None, dd_cache_path=None):
+    add_cost_columns(df)
+    metrics.add_rows(len(df))
+
+    # Reuse every driving distance that was already looked up
+    if (dd_cache_path is not None):
+        with DrivingDistCache(dd_cache_path) as dd_cache:
+            filled = prefill_driving_dist(df, dd_cache)
+        print('Driving distances from cache:', filled)
+            
+    # Calculate Aggregates, with the pairs over the radius that were only 
+    # counted by stage 2
+    return (df, losd_aggregates(df, far_df))
+
+def generate_costs(directory, filename, dd_cache_path=None, store='csv'):
+    print('Working on.... ' + filename)
+
+    # Read the source, CSV or Parquet
+    df = read_region(directory, filename)
+    (df, (avg, total, cnt, totalCost)) = cost_frame(df, 
+                                                    read_far_summary(filename),
+                                                    dd_cache_path)
+
     print(filename, avg, total, cnt, totalCost)
 
-    # Write the data to a new CSV to allow comparision    
+    # Write the data to a new CSV (or Parquet) to allow comparision    
     df.set_index('Origin', inplace=True)
-    df.to_csv('4_CostLists/' + filename)
+    write_region(df, '4_CostLists', filename, store)
+
+    # Lookups journaled against the previous version of the file no longer
+    # apply
+    remove_journal(filename)
     print('Done with.... ' + filename)
 
     return (filename, avg, total, cnt, totalCost)
 
-def main_program():
+def main_program(argv=None):
+    parser = stage_arg_parser('Calculate the LOSD cost of every '
+                              'combination')
+    parser.add_argument('--dd-cache', default=DEFAULT_DD_CACHE,
+                        help='driving distance cache used to pre-fill '
+                             'DrivingDist and Mult')
+    parser.add_argument('--no-dd-cache', action='store_true',
+                        help='do not pre-fill driving distances')
+    parser.add_argument('--store', choices=STORE_FORMATS, default='csv',
+                        help='format of the files written to 4_CostLists')
+    args = parser.parse_args(argv)
+    metrics.start(args.metrics, args.progress)
+    dd_cache_path = None if args.no_dd_cache else args.dd_cache
+
     directory = '3_ComboLists'
     
-    results = []
-
-    for filename in os.listdir(directory):
-        result = generate_costs(directory, filename)
-        results.append(result)
+    results = run_files(generate_costs, directory, args.workers, 
+                        args=(dd_cache_path, args.store), stage='3_CostLOSD')
     
     for result in results:
         print(result)
+
+    metrics.save()
         
-main_program()
\ No newline at end of file
+if __name__ == '__main__':
+    main_program()
\ No newline at end of file
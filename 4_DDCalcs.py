@@ -26,22 +26,62 @@
 # 
 # Based on the lookups done, we can calculate a multiplication factor. 
 # With each iteration, the multiplication factor will become more accurate
-# and start converging. 
+# and start converging. A region stops before its number of lookups once
+# the confidence interval of the multiplier is narrow enough 
+# (see LookupSampler.py).
+#
+# Each completed lookup is appended to 4_Journals/<filename> (see 
+# LookupJournal.py) rather than rewriting the regional file, so an 
+# interrupted run keeps its lookups. --compact folds the journals back
+# into 4_CostLists.
+#
+# --road-network DIR computes the driving distances on a local road graph
+# instead (see RoadNetwork.py), with --max-lookups to go past the fixed
+# number of lookups of each region.
 
 import os
 import datetime
-import googlemaps
+import numpy as np
 import pandas as pd
-from random import randint
-
-# Google Distance Matrix API
-key = "Enter key here"
+from ParallelRunner import stage_arg_parser, run_files
+from DistanceMatrixBatch import lookup_pairs
+from DrivingDistCache import DrivingDistCache, DEFAULT_DD_CACHE
+from LookupSampler import StratifiedSampler, MultiplierEstimate, losd_band
+from LookupJournal import LookupJournal, read_with_journal, compact_journal
+from MapsClient import get_client
+from RoadNetwork import get_road_client
+from Metrics import metrics
+from ColumnStore import region_files
 
-gmaps = googlemaps.Client(key)
+# Stop a region once the 95% confidence interval of its multiplier is 
+# narrower than this, and the number of pairs drawn between two checks
+DEFAULT_CI_WIDTH   = 0.02
+DEFAULT_BATCH_SIZE = 50
 
-def do_lookups(directory, filename):
+def do_lookups(directory, filename, client=None, pack_singles=False,
+               dd_cache_path=None, ci_width=DEFAULT_CI_WIDTH, 
+               batch_size=DEFAULT_BATCH_SIZE, seed=None, road_network=None,
+               max_lookups=None):
     print('Working on.... ' + filename)
 
+    # Read the source, with the lookups of earlier runs that are still 
+    # in the journal. Only the pairs under 300km can be looked up.
+    df = read_with_journal(directory, filename, max_losd=300)
+
+    (df, cumMult_list, updateCount) = run_lookups(df, filename, client, 
+                                                  pack_singles, dd_cache_path,
+                                                  ci_width, batch_size, seed,
+                                                  road_network, max_lookups)
+    print('Done with.... ' + filename)
+
+    return (filename, cumMult_list, updateCount)
+
+# Do the lookups for the region file filename, df is its content with the
+# journal applied. Returns df with the lookups.
+def run_lookups(df, filename, client=None, pack_singles=False,
+                dd_cache_path=None, ci_width=DEFAULT_CI_WIDTH, 
+                batch_size=DEFAULT_BATCH_SIZE, seed=None, road_network=None,
+                max_lookups=None):
     # Do a fixed number of lookups per file
     if 'Atlantic' in filename:
         lookupsMax =  700
@@ -56,44 +96,134 @@ def do_lookups(directory, filename):
     else:
         lookupsMax =    0
 
-    lookupsDone = 0 
+    # Without the daily limit (eg. a local road network) any number of 
+    # lookups can be done
+    if (max_lookups is not None):
+        lookupsMax = max_lookups
 
-    # Read the source
-    df = pd.read_csv(directory+'/'+filename, header=0)
+    lookupsDone = 0 
 
     # Find the index of the entry with the first 300km LOSD
     # Above this index, is the range on which we want to perform the 
     # driving distance calcs
-    maxIndex = df['LOSD'].searchsorted(300, side='left')[0]    
+    maxIndex = int(df['LOSD'].values.searchsorted(300, side='left'))
 
     # Every incremental run will result in the Update Version to be incremented
     updateIncr = df['Update'].max() + 1
+
+    # The multiplier is a ratio, make sure the column can hold one
+    df['Mult'] = df['Mult'].astype(float)
     
-    i = 1
+    # Every completed lookup is recorded in the journal right away
+    journal = LookupJournal(filename)
+
+    dd_cache = None
+    if (dd_cache_path is not None):
+        dd_cache = DrivingDistCache(dd_cache_path)
+
+    # Driving distances from a local road network instead of Google
+    if (client is None and road_network is not None):
+        client = get_road_client(road_network)
+
+    # Randomly select between 0 and entries with LOSD < 300, without 
+    # replacement and spread over the LOSD bands. Only entries where
+    # update is 0 still need a lookup.
+    losd = df['LOSD'].values[:maxIndex]
+    update = df['Update'].values[:maxIndex]
+    sampler = StratifiedSampler(losd, update == 0, seed=seed)
+
+    # Running multiplier, starting from the lookups of earlier runs
+    estimate = MultiplierEstimate(sampler.weights)
+    bands = losd_band(losd)
+    for idx in np.flatnonzero(update != 0):
+        estimate.add(bands[idx], df.loc[idx, 'Mult'])
+
+    # Result of every pair of locations looked up in this run. Sites at the
+    # same location (same postal code or FSA centre) give pairs with the 
+    # same driving distance, which are only looked up once.
+    byLocation = {}
+    shared = 0
+
+    i = 0
     # Update randomly selected entries wtih the driving distance for 
     # the max number of lookups for the region
     while lookupsDone < lookupsMax:
-        # Randomly select between 0 and entries with LOSD < 300
-        idx = randint(0, maxIndex-1)
-
-        # If update is 0, then update the driving distance by doing a lookup 
-        if (df.loc[idx, 'Update'] == 0):
-            ## Update drving distance after doing a lookup
-            distance = gmaps.distance_matrix(origins = 
-                                             str(df.loc[idx, 'OriLat'])+', '+
-                                             str(df.loc[idx, 'OriLng']),
-                                             destinations=
-                                             str(df.loc[idx, 'DstLat'])+', '+
-                                             str(df.loc[idx, 'DstLng']), 
-                                             mode='driving')  
+        
+        # Stop once the multiplier is known well enough
+        if (estimate.converged(ci_width)):
+            print("Multiplier converged: ", round(estimate.value(), 3), 
+                  " CI width:", round(estimate.ci_width(), 4))
+            break
+
+        batch = sampler.draw(min(lookupsMax - lookupsDone, batch_size))
+        if (len(batch) == 0):
+            print("NOTE: No entries left to lookup")
+            break
+        i += len(batch)
+        metrics.add_rows(len(batch))
+
+        pairs = [(idx, 
+                  str(df.loc[idx, 'OriLat'])+', '+str(df.loc[idx, 'OriLng']),
+                  str(df.loc[idx, 'DstLat'])+', '+str(df.loc[idx, 'DstLng']))
+                 for idx in batch]
+        pairs_by_idx = {pair[0]: pair for pair in pairs}
+
+        # Driving distances looked up before (any region, any run) are
+        # taken from the cache instead of the API
+        results = []
+        if (dd_cache is not None):
+            apiPairs = []
+            for pair in pairs:
+                cached = dd_cache.get(df.loc[pair[0], 'Origin'], 
+                                      df.loc[pair[0], 'Destination'])
+                if (cached is None):
+                    apiPairs.append(pair)
+                else:
+                    results.append((pair[0], cached[0], cached[1]))
+                    byLocation[(pair[1], pair[2])] = cached
+            pairs = apiPairs
+
+        # Pairs at the same locations as a pair already looked up, or as 
+        # another pair of the batch, share its result
+        sameLocation = {}
+        for pair in pairs:
+            sameLocation.setdefault((pair[1], pair[2]), []).append(pair[0])
+        pairs = []
+        for (location, idxs) in sameLocation.items():
+            if (location in byLocation):
+                results.extend((idx,) + byLocation[location] for idx in idxs)
+                shared += len(idxs)
+            else:
+                pairs.append((idxs[0],) + location)
+                shared += len(idxs) - 1
+
+        # Google Distance Matrix API, only needed for pairs not in the cache
+        if (len(pairs) > 0 and client is None):
+            client = get_client()
+
+        ## Update drving distance after doing the lookups, several pairs
+        ## are sent in each Distance Matrix request
+        for (idx, status, metres) in lookup_pairs(client, pairs, 
+                                                  pack_singles=pack_singles):
+            location = (pairs_by_idx[idx][1], pairs_by_idx[idx][2])
+            byLocation[location] = (status, metres)
+            for sameIdx in sameLocation[location]:
+                if (dd_cache is not None):
+                    dd_cache.put(df.loc[sameIdx, 'Origin'], 
+                                 df.loc[sameIdx, 'Destination'],
+                                 status, metres, location[0], location[1],
+                                 getattr(client, 'source', 'google'))
+                results.append((sameIdx, status, metres))
+
+        for (idx, status, metres) in results:
             
             # There are some places that don't have roads in Google Maps
             # For these locations, just skip as we can use the multiplier
-            if (distance['rows'][0]['elements'][0]['status'] != 'ZERO_RESULTS'):            
-                dist_km = round(distance['rows'][0]['elements'][0]['distance']['value']/1000)                                                                
+            if (status == 'OK'):            
+                dist_km = round(metres/1000)                                                                
 
                 # Same as LOSD, 0 is converted to 1 as there maybe some driving required
-                if (dist_km is 0):
+                if (dist_km == 0):
                     df.loc[idx, 'DrivingDist'] = 1
                 else:
                     df.loc[idx, 'DrivingDist'] = dist_km
@@ -102,17 +232,24 @@ def do_lookups(directory, filename):
          
                 # Calculate the multiplier for this row
                 df.loc[idx, 'Mult'] = df.loc[idx, 'DrivingDist']/df.loc[idx, 'LOSD']
+                estimate.add(bands[idx], df.loc[idx, 'Mult'])
+                journal.append(idx, df.loc[idx, 'Origin'], 
+                               df.loc[idx, 'Destination'],
+                               df.loc[idx, 'DrivingDist'], updateIncr, 
+                               df.loc[idx, 'Mult'])
             
                 # Increment the lookup counter
                 lookupsDone += 1
             else: 
                 print("NOTE: Skipping Idx:", idx, " Ori:", df.loc[idx, 'Origin'], 
-                      " Dest:", df.loc[idx, 'Destination'])
+                      " Dest:", df.loc[idx, 'Destination'], " Status:", status)
+
+        metrics.progress(lookupsDone, lookupsMax, 'lookups')
 
-        if (i%100 is 0):
-            print("Lookups:" + str(lookupsDone) + " Tries:" + str(i) + ". Time: " + 
-                  str(datetime.datetime.now().strftime('%H:%M:%S')))
-        i+=1
+        print("Lookups:" + str(lookupsDone) + " Tries:" + str(i) + 
+              " Mult:" + str(round(estimate.value(), 3)) + 
+              " CI width:" + str(round(estimate.ci_width(), 4)) + ". Time: " + 
+              str(datetime.datetime.now().strftime('%H:%M:%S')))
 
                
     cumMult_list = []
@@ -128,26 +265,73 @@ def do_lookups(directory, filename):
     
     updateCount = df['Mult'][df['Update'] != 0].count()
     print("Total Updates: ", updateCount)    
+
+    if (shared > 0):
+        print("Lookups shared by pairs at the same locations: ", shared)
+    if (dd_cache is not None):
+        print("Driving distance cache hits: ", dd_cache.hits)
+        dd_cache.close()
         
-    # Write the data back to the same CSV     
-    df.set_index('Origin', inplace=True)
-    df.to_csv(directory + '/' + filename)
-    print('Done with.... ' + filename)
+    # The lookups are in the journal, the region file itself is only 
+    # rewritten when the journal is compacted (--compact)
+    journal.close()
 
-    return (filename, cumMult_list, updateCount)
+    return (df, cumMult_list, updateCount)
 
 
-def main_program():
+def main_program(argv=None):
+    parser = stage_arg_parser('Lookup driving distances for a sample of '
+                              'combinations')
+    parser.add_argument('--pack-singles', action='store_true',
+                        help='also send pairs that share no location in '
+                             'one request (fewer requests, but unused '
+                             'elements are billed, see '
+                             'DistanceMatrixBatch.py)')
+    parser.add_argument('--dd-cache', default=DEFAULT_DD_CACHE,
+                        help='driving distance cache shared across runs')
+    parser.add_argument('--no-dd-cache', action='store_true',
+                        help='always use the Google Maps API')
+    parser.add_argument('--ci-width', type=float, default=DEFAULT_CI_WIDTH,
+                        help='stop a region once the confidence interval of '
+                             'its multiplier is narrower than this (0 to '
+                             'always do the maximum number of lookups)')
+    parser.add_argument('--seed', type=int, default=None,
+                        help='seed for the random selection of pairs')
+    parser.add_argument('--road-network', default=None, metavar='DIR',
+                        help='look up driving distances on the road network '
+                             'in DIR (Nodes.csv, Edges.csv, see '
+                             'RoadNetwork.py) instead of Google Maps')
+    parser.add_argument('--max-lookups', type=int, default=None,
+                        help='lookups per region instead of the fixed '
+                             'number of each region')
+    parser.add_argument('--compact', action='store_true',
+                        help='fold the lookup journals into the region '
+                             'files, without doing any lookups')
+    args = parser.parse_args(argv)
+    metrics.start(args.metrics, args.progress)
+    dd_cache_path = None if args.no_dd_cache else args.dd_cache
     
     directory = '4_CostLists'
-    
-    results = []
 
-    for filename in os.listdir(directory):
-        result = do_lookups(directory, filename)
-        results.append(result)
+    if (args.compact):
+        for filename in region_files(directory):
+            print(filename, 'lookups compacted:', 
+                  compact_journal(directory, filename))
+        return
+    
+    results = run_files(do_lookups, directory, args.workers, 
+                        kwargs={'pack_singles': args.pack_singles,
+                                'dd_cache_path': dd_cache_path,
+                                'ci_width': args.ci_width,
+                                'seed': args.seed,
+                                'road_network': args.road_network,
+                                'max_lookups': args.max_lookups},
+                        stage='4_DDCalcs')
     
     for result in results:
         print(result)
+
+    metrics.save()
         
-main_program()
\ No newline at end of file
+if __name__ == '__main__':
+    main_program()
\ No newline at end of file
@@ -37,95 +37,94 @@
 
 
 import pandas as pd
+import numpy as np
 import os
+from ParallelRunner import stage_arg_parser, run_files
+from CostRules import FINAL_COST_RULES, apply_rules, zero_to_default
+from NeighborIndex import read_far_summary
+from LookupJournal import read_with_journal
+from FsaDistTable import get_fsa_multipliers, pair_multipliers
+from Metrics import metrics
 
-def generate_costs(directory, filename):
-    print('Working on.... ' + filename)
-
-    # Read the source
-    df = pd.read_csv(directory+'/'+filename, header=0)
-     
-    finalDist_list = []
-    finalCost_list = []
-      
+# Return the combinations of df with their final distance and cost, and
+# the region aggregates. fsa_mult (see FsaDistTable.py) gives the
+# multiplier of the pairs of an FSA pair, the others use the region's.
+def final_frame(df, filename, far_df=None, fsa_mult=None):
     multiplier = df['Mult'][(df['Update'] != 0)].mean()
     print("Using Multiplier of ", round(multiplier,2))       
     
-    # Iterate through the list of combinations of origins and destinations
-    for series_index, row in df.iterrows():
-        
-        if (series_index%10000 is 0):
-            print(series_index)
-        
-        # Load row into variables
-        origin = df.Origin[series_index]
-        dest   = df.Destination[series_index]
-        losd   = df.LOSD[series_index]
-        update = df.Update[series_index]
-        drDist = df.DrivingDist[series_index]
- 
-        #print(origin, dest, losd)
-
-        if (update == 0 and losd < 300): 
-            updatedDist = losd * multiplier
-        elif (update > 0 and losd < 300):
-            updatedDist = drDist
-        else:
-            updatedDist = losd
-            
-        #print(" update", update, losd, multiplier, updatedDist)
-        
-        # If updatedDist is 0, it means the clinics are close by
-        # However, there is some cost to drive from clinic to clinic 
-        # Assume a cost based on distance of 5km. 
-        if (updatedDist == 0):
-            updatedDist = 5
-        
-        ontarioPCList = ['K', 'L', 'M', 'N', 'P']
-        prairiePCList = ['R', 'S', 'T']
-        
-        if (origin[:1] == 'X' and dest[:1] in ontarioPCList):
-            cost =  934
-        elif (origin[:1] in ontarioPCList and dest[:1] == 'X'):
-            cost =  934
-        elif (origin[:1] == 'X' and dest[:1] in prairiePCList):
-            cost =  483
-        elif (origin[:1] in prairiePCList and dest[:1] == 'X'):
-            cost =  483
-        elif (origin[:1] == 'Y' and dest[:1] != 'Y'):
-            cost =  263
-        elif (origin[:1] != 'Y' and dest[:1] == 'Y'):
-            cost =  263
-        elif(updatedDist >= 300):
-            cost = 121.64
-        else:
-            cost = (0.5 * updatedDist)        
-            
-        finalDist_list.append(updatedDist)
-        finalCost_list.append(cost)
+    losd   = df['LOSD'].values
+    update = df['Update'].values
+    drDist = df['DrivingDist'].values
+
+    # Pairs under 300km without a lookup use the multiplier, pairs under 
+    # 300km with a lookup use the driving distance, the rest use the LOSD
+    useMult   = (update == 0) & (losd < 300)
+    useDrDist = (update > 0) & (losd < 300)
+    # Distances stay integers when no pair needed the multiplier
+    if (useMult.any()):
+        pairMult = np.full(len(df), multiplier)
+        if (fsa_mult is not None):
+            rows = np.flatnonzero(useMult)
+            fsaMult = pair_multipliers(fsa_mult, df['Origin'].values[rows],
+                                       df['Destination'].values[rows])
+            found = ~np.isnan(fsaMult)
+            pairMult[rows[found]] = fsaMult[found]
+            print("Using FSA pair multipliers for", found.sum(), "of", 
+                  len(rows), "pairs")
+        updatedDist = np.where(useMult, losd * pairMult, 
+                               np.where(useDrDist, drDist, losd))
+    else:
+        updatedDist = np.where(useDrDist, drDist, losd)
+
+    # If updatedDist is 0, it means the clinics are close by
+    # However, there is some cost to drive from clinic to clinic 
+    # Assume a cost based on distance of 5km. 
+    updatedDist = zero_to_default(updatedDist)
     
-    df['Final_Dist']   = finalDist_list
-    df['Final_Cost']   = finalCost_list
+    df['Final_Dist']   = updatedDist
+    df['Final_Cost']   = apply_rules(FINAL_COST_RULES, df['Origin'].values, 
+                                     df['Destination'].values, updatedDist)
             
     # Calculate Aggregates
     avg = round(df['Final_Dist'].mean())
     total = round(df['Final_Dist'].sum())
     cnt = len(df)
     totalCost = round(df['Final_Cost'].sum())
+    metrics.add_rows(cnt)
+
+    # Find the total cost for flying and total cost for driving        
+    u300Cost = df['Final_Cost'][df['Final_Dist'] < 300].sum()
+    o300Cost = df['Final_Cost'][df['Final_Dist'] >= 300].sum()
+
+    # Add the pairs over the radius that were only counted by stage 2
+    if (far_df is not None and len(far_df) > 0):
+        farLosd = far_df['LOSD'].values
+        farCount = far_df['Count'].values
+        farDist = zero_to_default(np.where(farLosd < 300, 
+                                           farLosd * multiplier, farLosd))
+        farCost = apply_rules(FINAL_COST_RULES, far_df['OriPrefix'].values, 
+                              far_df['DstPrefix'].values, farDist)
+        total = round(df['Final_Dist'].sum() + (farDist * farCount).sum())
+        cnt = cnt + int(farCount.sum())
+        avg = round(total / cnt)
+        totalCost = round(df['Final_Cost'].sum() + (farCost * farCount).sum())
+        u300Cost += (farCost * farCount)[farDist < 300].sum()
+        o300Cost += (farCost * farCount)[farDist >= 300].sum()
+
+    u300Cost = round(u300Cost)
+    o300Cost = round(o300Cost)
     print(filename, avg, total, cnt, totalCost)
 
 
     updateIncr = df['Update'].max()
+    cumMult = float('nan')
     print("Iteration   Cumulative Avg")
     for i in range(1, updateIncr+1):
         cumMult = round(df['Mult'][(df['Update'] <= i) & 
                                    (df['Update'] > 0)].mean(),2)
         print(i, "         ", cumMult)
 
-    # Find the total cost for flying and total cost for driving        
-    u300Cost = round(df['Final_Cost'][df['Final_Dist'] < 300].sum())
-    o300Cost = round(df['Final_Cost'][df['Final_Dist'] >= 300].sum())
-
     # Get all the entries where lookups were done through Google 
     # This will allow us to calculate the correlation factor
     losd_list = df['LOSD'][df['Update'] > 0]
@@ -136,24 +135,48 @@ def generate_costs(directory, filename):
     corr = round(result['LOSD'].corr(result['Final_Dist']),2)
     print("Correlation ", corr)
 
+    return (df, (avg, total, cnt, cumMult, totalCost, u300Cost, o300Cost, corr))
+
+def generate_costs(directory, filename, fsa_table=None):
+    print('Working on.... ' + filename)
+
+    fsa_mult = None
+    if (fsa_table is not None):
+        fsa_mult = get_fsa_multipliers(fsa_table)
+
+    # Read the source, including the lookups still in the journal
+    df = read_with_journal(directory, filename)
+    (df, result) = final_frame(df, filename, read_far_summary(filename), 
+                               fsa_mult)
+
     # Write the data to a new CSV to allow comparision    
     df.set_index('Origin', inplace=True)
     df.to_csv('5_FinalLists/' + filename)
     print('Done with.... ' + filename)
 
-    return (filename, avg, total, cnt, cumMult, totalCost, u300Cost, o300Cost, corr)
+    return (filename,) + result
+
+def main_program(argv=None):
+    parser = stage_arg_parser('Calculate the final cost of every '
+                              'combination')
+    parser.add_argument('--fsa-table', default=None, metavar='FILE',
+                        help='use the multiplier of the FSA pair from this '
+                             'table (see FsaDistTable.py) for the pairs '
+                             'without a lookup')
+    args = parser.parse_args(argv)
+    metrics.start(args.metrics, args.progress)
 
-def main_program():
     directory = '4_CostLists'
     
-    results = []
-
-    for filename in os.listdir(directory):
-        result = generate_costs(directory, filename)
-        results.append(result)
+    results = run_files(generate_costs, directory, args.workers, 
+                        kwargs={'fsa_table': args.fsa_table},
+                        stage='5_FinalCost')
     
     print("Region   AvgDist  TotalDist  TotalRec Mult TotalCost u300Cost o300Cost corr")
     for result in results:
         print(result)
+
+    metrics.save()
         
-main_program()
\ No newline at end of file
+if __name__ == '__main__':
+    main_program()
\ No newline at end of file
@@ -0,0 +1,320 @@
+#!/usr/bin/python3
+# CRA OCAD Project
+#
+# Benchmark.py
+# Created for group project:
+# Andrew Campbell, Xiang Gao, Gurleen Kaur and Apurv Shah
+# Algonquin College
+# This file measures the throughput of the stages without real postal data
+# or API keys. For every scale (number of postal codes) it builds a
+# synthetic start file and CanadianPostalCodes.csv in a work directory,
+# replaces the Google Maps client with a deterministic fake that waits a
+# fixed latency per request, and times each stage function:
+# generate_lat_long, generate_combinations, generate_costs (stage 3),
+# do_lookups and generate_costs (stage 5).
+#
+# Every stage runs in a new process, so the peak memory reported is the
+# stage's own. The results are written as JSON so runs can be compared
+# over time, eg. python Benchmark.py --scales 1000,5000 --output base.json
+#
+# Scales with more than FULL_MODE_PAIRS pairs use the --radius mode of
+# stage 2 by default, as one row per pair would not fit in memory.
+
+import os
+import sys
+import json
+import time
+import shutil
+import hashlib
+import datetime
+import platform
+import tempfile
+import threading
+import argparse
+import importlib
+import contextlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+import MapsClient
+from GeoDistance import haversine_km, METHODS
+from GeocodeResolver import NULL_LAT, NULL_LNG, load_postal_code_lookup
+from Pipeline import parse_stages
+
+DEFAULT_SCALES = [1000, 5000, 20000]
+
+# Largest number of pairs for which stage 2 writes one row per pair
+FULL_MODE_PAIRS = 1000000
+
+# Share of the postal codes missing from the synthetic
+# CanadianPostalCodes.csv, these are looked up with the fake client
+MISSING_SHARE = 0.05
+
+REGION = 'Ontario.csv'
+
+STAGE_NAMES = {1: 'generate_lat_long',
+               2: 'generate_combinations',
+               3: 'generate_costs (3_CostLOSD)',
+               4: 'do_lookups',
+               5: 'generate_costs (5_FinalCost)'}
+
+STAGE_MODULES = {1: '1_LatLongGenerator',
+                 2: '2_GenOriDstComb',
+                 3: '3_CostLOSD',
+                 4: '4_DDCalcs',
+                 5: '5_FinalCost'}
+
+
+# Deterministic stand-in for googlemaps.Client, with the geocode and
+# distance_matrix methods used by the stages
+class FakeMapsClient:
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.geocode_calls = 0
+        self.matrix_calls = 0
+        self.matrix_elements = 0
+
+    def _hash(self, text):
+        return int(hashlib.md5(text.encode()).hexdigest()[:8], 16)
+
+    def geocode(self, address):
+        with self.lock:
+            self.geocode_calls += 1
+        time.sleep(self.latency)
+        h = self._hash(address)
+
+        # Some full postal codes are not found, so the FSA is used
+        if (h % 20 == 0 and len(address.split(',')[0]) > 3):
+            lat, lng = NULL_LAT, NULL_LNG
+        else:
+            lat = 42.0 + (h % 8000) / 1000.0
+            lng = -95.0 + (h // 8000 % 21000) / 1000.0
+        return [{'geometry': {'location': {'lat': lat, 'lng': lng}}}]
+
+    def distance_matrix(self, origins, destinations, mode='driving'):
+        self.matrix_calls += 1
+        self.matrix_elements += len(origins) * len(destinations)
+        time.sleep(self.latency)
+
+        rows = []
+        for origin in origins:
+            oriLat, oriLng = [float(x) for x in origin.split(',')]
+            elements = []
+            for dest in destinations:
+                dstLat, dstLng = [float(x) for x in dest.split(',')]
+                km = float(haversine_km(oriLat, oriLng, dstLat, dstLng))
+
+                # Some places have no road, and the roads are not straight
+                if (self._hash(origin + dest) % 50 == 0):
+                    elements.append({'status': 'ZERO_RESULTS'})
+                else:
+                    factor = 1.2 + (self._hash(dest + origin) % 400) / 1000.0
+                    elements.append({'status': 'OK',
+                                     'distance': {'value': int(km * factor * 1000)}})
+            rows.append({'elements': elements})
+        return {'rows': rows}
+
+
+# n unique postal codes with coordinates, mostly in Ontario with a few in
+# Nunavut so that the flight cost rules are used as well
+def synthetic_sites(n, seed=1):
+    rng = np.random.default_rng(seed)
+    letters = np.array(list('ABCEGHJKLMNPRSTVXY'))
+    codes = set()
+    while (len(codes) < n):
+        first = rng.choice(list('KLMNP') * 49 + ['X'], size=n)
+        parts = [first,
+                 rng.integers(0, 10, n).astype(str),
+                 rng.choice(letters, n),
+                 rng.integers(0, 10, n).astype(str),
+                 rng.choice(letters, n),
+                 rng.integers(0, 10, n).astype(str)]
+        for code in map(''.join, zip(*parts)):
+            if (len(codes) < n):
+                codes.add(code)
+    codes = np.array(sorted(codes))
+    rng.shuffle(codes)
+
+    north = np.array([code[0] == 'X' for code in codes])
+    lats = np.where(north, rng.uniform(60, 70, n), rng.uniform(42, 50, n))
+    lngs = np.where(north, rng.uniform(-95, -65, n), rng.uniform(-95, -74, n))
+    return (codes, np.round(lats, 6), np.round(lngs, 6))
+
+
+# Build the folders of one scale in workDir
+def build_scale(workDir, n, seed=1):
+    for folder in ['1_StartFiles', '1_PostalCodes', '2_LatLongLists',
+                   '3_ComboLists', '4_CostLists', '5_FinalLists']:
+        os.makedirs(os.path.join(workDir, folder), exist_ok=True)
+
+    (codes, lats, lngs) = synthetic_sites(n, seed)
+    pd.DataFrame({'Postal Code': codes, 'Name': 'Site'}).to_csv(
+        os.path.join(workDir, '1_StartFiles', REGION), index=False)
+
+    known = np.random.default_rng(seed + 1).random(n) >= MISSING_SHARE
+    pd.DataFrame({'PostalCode': codes[known], 'Latitude': lats[known],
+                  'Longitude': lngs[known]}).to_csv(
+        os.path.join(workDir, '1_PostalCodes', 'CanadianPostalCodes.csv'),
+        index=False)
+
+
+# Peak memory of this process in MB, or None if it cannot be measured
+def peak_rss_mb():
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KB, macOS bytes
+    if (sys.platform == 'darwin'):
+        return peak / (1024 * 1024)
+    return peak / 1024
+
+
+def call_stage(stage, module, options):
+    if (stage == 1):
+        (lat_lookup, long_lookup) = load_postal_code_lookup()
+        start = time.perf_counter()
+        module.generate_lat_long('1_StartFiles', REGION, lat_lookup,
+                                 long_lookup, None, None, options['rps'])
+        return (start, None)
+    start = time.perf_counter()
+    if (stage == 2):
+        return (start, module.generate_combinations(
+            '1_StartFiles', REGION, options['combo_mode'] == 'stream',
+            options['chunk_size'], options['method'],
+            options['radius'] if options['combo_mode'] == 'radius' else None))
+    if (stage == 3):
+        return (start, module.generate_costs('3_ComboLists', REGION))
+    if (stage == 4):
+        return (start, module.do_lookups('4_CostLists', REGION,
+                                         ci_width=0, seed=options['seed']))
+    return (start, module.generate_costs('4_CostLists', REGION))
+
+
+# Run one stage in workDir and return its measurements. Runs in a new
+# process, the output of the stage goes to workDir/logs.
+def measure_stage(workDir, stage, options):
+    os.chdir(workDir)
+    client = FakeMapsClient(options['latency'])
+    MapsClient.gmaps = client
+    module = importlib.import_module(STAGE_MODULES[stage])
+
+    os.makedirs('logs', exist_ok=True)
+    with open(os.path.join('logs', 'stage' + str(stage) + '.log'), 'w') as log:
+        with contextlib.redirect_stdout(log):
+            (start, result) = call_stage(stage, module, options)
+            seconds = time.perf_counter() - start
+
+    if (stage == 1):
+        rows = len(pd.read_csv(os.path.join('2_LatLongLists', REGION)))
+    elif (stage == 4):
+        rows = int(result[2])
+    else:
+        rows = int(result[3])
+
+    return {'seconds': round(seconds, 4),
+            'rows': rows,
+            'rows_per_second': round(rows / seconds, 1) if seconds > 0 else None,
+            'peak_rss_mb': peak_rss_mb(),
+            'geocode_calls': client.geocode_calls,
+            'matrix_calls': client.matrix_calls,
+            'matrix_elements': client.matrix_elements}
+
+
+def combo_mode_for(n, mode):
+    if (mode != 'auto'):
+        return mode
+    return 'full' if n * (n - 1) // 2 <= FULL_MODE_PAIRS else 'radius'
+
+
+def run_benchmark(scales, stages, options, workRoot):
+    results = []
+    context = multiprocessing.get_context('spawn')
+    for n in scales:
+        workDir = os.path.join(workRoot, 'scale_' + str(n))
+        build_scale(workDir, n, options['seed'])
+        scaleOptions = dict(options, combo_mode=combo_mode_for(n, options['combo_mode']))
+
+        for stage in stages:
+            print('Scale', n, 'stage', stage, STAGE_NAMES[stage],
+                  '(' + scaleOptions['combo_mode'] + ')' if stage == 2 else '')
+            with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+                measured = pool.submit(measure_stage, workDir, stage,
+                                       scaleOptions).result()
+            entry = {'scale': n,
+                     'pairs': n * (n - 1) // 2,
+                     'stage': stage,
+                     'function': STAGE_NAMES[stage],
+                     'combo_mode': scaleOptions['combo_mode']}
+            entry.update(measured)
+            print('   ', entry['seconds'], 's ', entry['rows'], 'rows ',
+                  entry['rows_per_second'], 'rows/s ', entry['peak_rss_mb'], 'MB')
+            results.append(entry)
+    return results
+
+
+def main_program(argv=None):
+    parser = argparse.ArgumentParser(description='Time the stages on '
+                                     'synthetic regions with fake clients')
+    parser.add_argument('--scales', default=','.join(map(str, DEFAULT_SCALES)),
+                        help='numbers of postal codes, eg. 1000,5000,20000')
+    parser.add_argument('--stages', type=parse_stages, default=[1, 2, 3, 4, 5],
+                        help='stages to time, eg. 2,3 (later stages need the '
+                             'output of earlier ones)')
+    parser.add_argument('--combo-mode', choices=['auto', 'full', 'stream',
+                                                 'radius'], default='auto',
+                        help='stage 2 mode (auto: full up to ' +
+                             str(FULL_MODE_PAIRS) + ' pairs, then radius)')
+    parser.add_argument('--radius', type=int, default=300,
+                        help='radius for the radius mode of stage 2')
+    parser.add_argument('--chunk-size', type=int, default=1000000,
+                        help='pairs per chunk in streaming mode')
+    parser.add_argument('--method', choices=METHODS, default='vincenty',
+                        help='distance formula used for the LOSD')
+    parser.add_argument('--latency', type=float, default=0.02,
+                        help='seconds the fake client waits per request')
+    parser.add_argument('--rps', type=float, default=0,
+                        help='geocode requests per second (0: no limit)')
+    parser.add_argument('--seed', type=int, default=1,
+                        help='seed for the synthetic data and the lookups')
+    parser.add_argument('--work-dir', default=None,
+                        help='folder for the synthetic regions (default: a '
+                             'temporary folder, removed at the end)')
+    parser.add_argument('--output', default='benchmark.json',
+                        help='JSON file for the results')
+    args = parser.parse_args(argv)
+
+    scales = [int(n) for n in args.scales.split(',') if n != '']
+    options = {'combo_mode': args.combo_mode, 'radius': args.radius,
+               'chunk_size': args.chunk_size, 'method': args.method,
+               'latency': args.latency, 'rps': args.rps, 'seed': args.seed}
+
+    workRoot = args.work_dir
+    if (workRoot is None):
+        workRoot = tempfile.mkdtemp(prefix='benchmark_')
+    workRoot = os.path.abspath(workRoot)
+
+    try:
+        results = run_benchmark(scales, stages=args.stages, options=options,
+                                workRoot=workRoot)
+    finally:
+        if (args.work_dir is None):
+            shutil.rmtree(workRoot, ignore_errors=True)
+
+    report = {'created': datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+              'python': platform.python_version(),
+              'platform': platform.platform(),
+              'numpy': np.__version__,
+              'pandas': pd.__version__,
+              'options': dict(options, scales=scales, stages=args.stages),
+              'results': results}
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=1)
+    print('Results written to', args.output)
+
+if __name__ == '__main__':
+    main_program()
@@ -0,0 +1,294 @@
+#!/usr/bin/python3
+# CRA OCAD Project
+#
+# ColumnStore.py
+# Created for group project:
+# Andrew Campbell, Xiang Gao, Gurleen Kaur and Apurv Shah
+# Algonquin College
+# This file reads and writes the region files of 3_ComboLists and
+# 4_CostLists either as CSV (the default) or as Parquet, with --store
+# parquet in 2_GenOriDstComb and 3_CostLOSD.
+#
+# A Parquet region is written next to where the CSV would be, as
+# <region>.parquet instead of <region>.csv. The stages still name the
+# region <region>.csv (for the journals, far summaries and output files),
+# region_files and region_path map the names to the file actually there.
+#
+# In the Parquet files the postal codes are dictionary encoded and the
+# numbers keep their types, so nothing is parsed from text. The rows are in
+# LOSD order and every row group holds one LOSD band (LOSD_PARTITIONS), so
+# a stage that only needs the pairs under 300 km (4_DDCalcs) reads only the
+# row groups of those bands, and only the columns it asks for.
+#
+# Parquet needs pyarrow (pip install pyarrow), CSV does not. To open the
+# files in Excel, python ColumnStore.py --export writes every region as CSV
+# to CSV_Export/<folder>.
+
+import os
+import argparse
+import numpy as np
+import pandas as pd
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+STORE_FORMATS = ('csv', 'parquet')
+
+PARQUET_EXT = '.parquet'
+
+# Row groups are split at these LOSD (km): the bands of LookupSampler.py
+# and the thresholds of the cost rules
+LOSD_PARTITIONS = [25, 50, 100, 200, 300, 500]
+
+# Largest row group within a band
+ROW_GROUP_ROWS = 1000000
+
+DICTIONARY_COLUMNS = ['Origin', 'Destination']
+
+EXPORT_DIR = 'CSV_Export'
+
+STORE_DIRS = ['3_ComboLists', '4_CostLists']
+
+
+def require_pyarrow():
+    if (pq is None):
+        raise ImportError('The parquet store needs pyarrow '
+                          '(pip install pyarrow)')
+
+
+def parquet_name(filename):
+    return os.path.splitext(filename)[0] + PARQUET_EXT
+
+
+# Region name of a file in a store folder
+def region_name(name):
+    if (name.endswith(PARQUET_EXT)):
+        return name[:-len(PARQUET_EXT)] + '.csv'
+    return name
+
+
+# Region names of the files of a folder, in the order of os.listdir
+def region_files(directory):
+    return list(dict.fromkeys(region_name(name)
+                              for name in os.listdir(directory)))
+
+
+def region_format(directory, filename):
+    if (os.path.exists(os.path.join(directory, parquet_name(filename)))):
+        return 'parquet'
+    return 'csv'
+
+
+# Path of the file holding a region
+def region_path(directory, filename):
+    if (region_format(directory, filename) == 'parquet'):
+        return os.path.join(directory, parquet_name(filename))
+    return os.path.join(directory, filename)
+
+
+# (start, stop) row ranges of each LOSD band, or the whole frame if it is
+# not in LOSD order
+def band_slices(df):
+    if ('LOSD' not in df.columns or len(df) == 0):
+        return [(0, len(df))]
+    losd = df['LOSD'].values
+    if (np.any(losd[1:] < losd[:-1])):
+        return [(0, len(df))]
+    bounds = np.searchsorted(losd, LOSD_PARTITIONS, side='left').tolist()
+    bounds = [0] + bounds + [len(df)]
+    return [(start, stop) for (start, stop) in zip(bounds[:-1], bounds[1:])
+            if stop > start]
+
+
+def parquet_writer(path, schema):
+    return pq.ParquetWriter(path, schema, compression='snappy',
+                            use_dictionary=[name for name in schema.names
+                                            if name in DICTIONARY_COLUMNS])
+
+
+def write_row_groups(writer, table, df):
+    for (start, stop) in band_slices(df):
+        for first in range(start, stop, ROW_GROUP_ROWS):
+            writer.write_table(table.slice(first,
+                                           min(ROW_GROUP_ROWS, stop - first)))
+
+
+def write_parquet(df, path):
+    require_pyarrow()
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    with parquet_writer(path + '.tmp', table.schema) as writer:
+        if (len(df) == 0):
+            writer.write_table(table)
+        write_row_groups(writer, table, df)
+    os.replace(path + '.tmp', path)
+
+
+# Write a region in the given format and remove the file of the other
+# format, df has the index column (Origin, or eg. PostalCode for
+# 2_LatLongLists) as a column or as its index
+def write_region(df, directory, filename, store='csv', index='Origin'):
+    csvPath = os.path.join(directory, filename)
+    parquetPath = os.path.join(directory, parquet_name(filename))
+    if (store == 'parquet'):
+        if (df.index.name == index):
+            df = df.reset_index()
+        write_parquet(df, parquetPath)
+        stalePath = csvPath
+    else:
+        if (df.index.name != index):
+            df = df.set_index(index)
+        df.to_csv(csvPath)
+        stalePath = parquetPath
+    if (os.path.exists(stalePath)):
+        os.remove(stalePath)
+
+
+# Column types of a CSV read chunk_size rows at a time, the same as when
+# reading it at once: float if any chunk has floats, text if any has text
+def csv_dtypes(csvPath, chunk_size=1000000):
+    dtypes = {}
+    for chunk_df in pd.read_csv(csvPath, header=0, chunksize=chunk_size):
+        for (name, dtype) in chunk_df.dtypes.items():
+            dtypes.setdefault(name, []).append(dtype)
+    result = {}
+    for (name, found) in dtypes.items():
+        if (any(pd.api.types.is_string_dtype(dtype) for dtype in found)):
+            result[name] = str
+        elif (any(np.issubdtype(dtype, np.floating) for dtype in found)):
+            result[name] = np.float64
+    return result
+
+
+# Turn the CSV of a region into Parquet, chunk_size rows at a time. dtype
+# gives the column types if they are known, otherwise the CSV is read
+# once more to find them.
+def convert_to_parquet(directory, filename, chunk_size=1000000, dtype=None):
+    require_pyarrow()
+    csvPath = os.path.join(directory, filename)
+    parquetPath = os.path.join(directory, parquet_name(filename))
+    if (dtype is None):
+        dtype = csv_dtypes(csvPath, chunk_size)
+
+    writer = None
+    schema = None
+    try:
+        for chunk_df in pd.read_csv(csvPath, header=0, chunksize=chunk_size,
+                                    dtype=dtype):
+            if (writer is None):
+                schema = pa.Schema.from_pandas(chunk_df, preserve_index=False)
+                writer = parquet_writer(parquetPath + '.tmp', schema)
+            table = pa.Table.from_pandas(chunk_df, schema=schema,
+                                         preserve_index=False)
+            write_row_groups(writer, table, chunk_df.reset_index(drop=True))
+    finally:
+        if (writer is not None):
+            writer.close()
+
+    # A file with only the header
+    if (writer is None):
+        write_parquet(pd.read_csv(csvPath, header=0, dtype=dtype),
+                      parquetPath)
+    else:
+        os.replace(parquetPath + '.tmp', parquetPath)
+    os.remove(csvPath)
+
+
+# Once a stage has written the CSV of a region, turn it into Parquet if
+# that is the store used, or remove an older Parquet file of the region
+def store_written(directory, filename, store='csv', chunk_size=1000000,
+                  dtype=None):
+    if (store == 'parquet'):
+        convert_to_parquet(directory, filename, chunk_size, dtype)
+    else:
+        parquetPath = os.path.join(directory, parquet_name(filename))
+        if (os.path.exists(parquetPath)):
+            os.remove(parquetPath)
+
+
+# Row groups of a Parquet file with some LOSD under max_losd
+def row_groups_under(pf, max_losd):
+    column = pf.schema_arrow.get_field_index('LOSD')
+    groups = []
+    for n in range(pf.metadata.num_row_groups):
+        stats = pf.metadata.row_group(n).column(column).statistics
+        if (stats is None or not stats.has_min_max or stats.min < max_losd):
+            groups.append(n)
+    return groups
+
+
+# Read a region. columns limits the columns read, max_losd the rows to the
+# ones with an LOSD under it (the first rows, as the file is in LOSD order).
+def read_region(directory, filename, columns=None, max_losd=None):
+    if (columns is not None and max_losd is not None and
+        'LOSD' not in columns):
+        columns = list(columns) + ['LOSD']
+
+    if (region_format(directory, filename) == 'csv'):
+        df = pd.read_csv(os.path.join(directory, filename), header=0,
+                         usecols=columns)
+        if (columns is not None):
+            df = df[[name for name in columns if name in df.columns]]
+    else:
+        require_pyarrow()
+        pf = pq.ParquetFile(os.path.join(directory, parquet_name(filename)))
+        if (max_losd is None):
+            table = pf.read(columns=columns)
+        else:
+            table = pf.read_row_groups(row_groups_under(pf, max_losd),
+                                       columns=columns)
+        df = table.to_pandas()
+
+    if (max_losd is not None):
+        df = df[df['LOSD'].values < max_losd].reset_index(drop=True)
+    return df
+
+
+# Write every region of a store folder as CSV to EXPORT_DIR/<folder>
+def export_csv(directory, export_dir=EXPORT_DIR):
+    outDir = os.path.join(export_dir, os.path.basename(directory))
+    os.makedirs(outDir, exist_ok=True)
+    for filename in region_files(directory):
+        df = read_region(directory, filename)
+        df.set_index('Origin').to_csv(os.path.join(outDir, filename))
+        print(filename, 'exported to', outDir)
+
+
+# Rewrite every region of a store folder in the given format
+def convert_store(directory, store):
+    for filename in region_files(directory):
+        if (region_format(directory, filename) == store):
+            continue
+        if (store == 'parquet'):
+            convert_to_parquet(directory, filename)
+        else:
+            write_region(read_region(directory, filename), directory,
+                         filename, 'csv')
+        print(filename, 'converted to', store)
+
+
+def main_program(argv=None):
+    parser = argparse.ArgumentParser(description='Export or convert the '
+                                     'region files of ' +
+                                     ' and '.join(STORE_DIRS))
+    parser.add_argument('--export', action='store_true',
+                        help='write every region as CSV to ' + EXPORT_DIR)
+    parser.add_argument('--convert', choices=STORE_FORMATS, default=None,
+                        help='rewrite every region in this format')
+    parser.add_argument('--dirs', default=','.join(STORE_DIRS),
+                        help='folders to export or convert')
+    args = parser.parse_args(argv)
+
+    for directory in args.dirs.split(','):
+        if (not os.path.isdir(directory)):
+            continue
+        if (args.convert is not None):
+            convert_store(directory, args.convert)
+        if (args.export):
+            export_csv(directory)
+
+if __name__ == '__main__':
+    main_program()
@@ -0,0 +1,115 @@
+#!/usr/bin/python3
+# CRA OCAD Project
+#
+# CostRules.py
+# Created for group project:
+# Andrew Campbell, Xiang Gao, Gurleen Kaur and Apurv Shah
+# Algonquin College
+# This file holds the cost rules for 3_CostLOSD and 5_FinalCost as tables,
+# and a cost engine which applies a table to a whole region at once using
+# column operations instead of looping through the rows.
+#
+# Each rule is a tuple of:
+# (origin prefix, destination prefix, min km, fixed cost, cost per km)
+#
+# A prefix is a string of first letters of the postal code. A leading '!'
+# means "any letter except these", and None matches every postal code.
+# min km of None matches every distance. The cost of a pair is:
+#   fixed cost + cost per km * distance
+# Rules are checked in order and the first rule that matches is used, the
+# same way as the if/elif chains they replace. The last rule should match
+# every pair.
+
+import numpy as np
+import pandas as pd
+
+ONTARIO_PREFIX = 'KLMNP'
+PRAIRIE_PREFIX = 'RST'
+
+# Cost rules for the Line of Sight Distance (3_CostLOSD)
+# Flight Costs Rules
+# Ontario-Nunavut (X) - $2000
+# BC-Yukon (Y) - $1000
+# Prairie-NWT (X) - $2000
+# 300-499 km - $400
+# >500 km - $600
+# Driving: 50 cents per km
+LOSD_COST_RULES = [
+    # origin          dest              min km  fixed    per km
+    ('X',             '!X',             None,   2000,    0),
+    ('!X',            'X',              None,   2000,    0),
+    ('Y',             '!Y',             None,   1000,    0),
+    ('!Y',            'Y',              None,   1000,    0),
+    (None,            None,             500,    600,     0),
+    (None,            None,             300,    400,     0),
+    (None,            None,             None,   0,       0.5),
+]
+
+# Cost rules for the final distance (5_FinalCost)
+# See 5_FinalCost for where the fares come from
+FINAL_COST_RULES = [
+    # origin          dest              min km  fixed    per km
+    ('X',             ONTARIO_PREFIX,   None,   934,     0),
+    (ONTARIO_PREFIX,  'X',              None,   934,     0),
+    ('X',             PRAIRIE_PREFIX,   None,   483,     0),
+    (PRAIRIE_PREFIX,  'X',              None,   483,     0),
+    ('Y',             '!Y',             None,   263,     0),
+    ('!Y',            'Y',              None,   263,     0),
+    (None,            None,             300,    121.64,  0),
+    (None,            None,             None,   0,       0.5),
+]
+
+# Distance used when two clinics are at the same location. There is still
+# some cost to drive from clinic to clinic, so assume 5km.
+ZERO_DIST = 5
+
+
+def prefix_match(letters, prefix):
+    if (prefix is None):
+        return np.ones(len(letters), dtype=bool)
+    if (prefix.startswith('!')):
+        return ~letters.isin(list(prefix[1:])).values
+    return letters.isin(list(prefix)).values
+
+
+# Return the index of the first matching rule for every pair
+def match_rules(rules, origins, dests, dist):
+    oriLetter = pd.Series(origins).astype(str).str[:1]
+    dstLetter = pd.Series(dests).astype(str).str[:1]
+    dist = np.asarray(dist)
+
+    conditions = []
+    for (oriPrefix, dstPrefix, minDist, fixed, perKm) in rules:
+        cond = prefix_match(oriLetter, oriPrefix) & prefix_match(dstLetter, dstPrefix)
+        if (minDist is not None):
+            cond = cond & (dist >= minDist)
+        conditions.append(cond)
+
+    ruleIdx = np.select(conditions, np.arange(len(rules)), default=-1)
+    if ((ruleIdx < 0).any()):
+        raise ValueError('Cost rules do not cover every pair')
+    return ruleIdx
+
+
+# Apply a rule table to whole columns of origins, destinations and distances
+def apply_rules(rules, origins, dests, dist):
+    dist = np.asarray(dist)
+    ruleIdx = match_rules(rules, origins, dests, dist)
+
+    fixed = np.array([rule[3] for rule in rules], dtype=np.float64)
+    perKm = np.array([rule[4] for rule in rules], dtype=np.float64)
+    cost = fixed[ruleIdx] + perKm[ruleIdx] * dist
+
+    # The row by row version only gave float costs when a per km or a
+    # fractional fare was used, otherwise the column stayed integer
+    usedRules = np.unique(ruleIdx)
+    if (np.all(perKm[usedRules] == 0) and
+        np.all(fixed[usedRules] == np.round(fixed[usedRules]))):
+        cost = cost.astype(np.int64)
+
+    return cost
+
+
+def zero_to_default(dist, default=ZERO_DIST):
+    dist = np.asarray(dist)
+    return np.where(dist == 0, default, dist)
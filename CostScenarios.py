@@ -0,0 +1,229 @@
+#!/usr/bin/python3
+# CRA OCAD Project
+#
+# CostScenarios.py
+# Created for group project:
+# Andrew Campbell, Xiang Gao, Gurleen Kaur and Apurv Shah
+# Algonquin College
+# This file evaluates fare scenarios (other rates, fares or cut-off) for
+# all regions without running 5_FinalCost over every pair again.
+#
+# The cost rules only look at the first letter of the postal codes and the
+# distance, and the LOSD and driving distances are whole km. So a region is
+# kept as a histogram with one row per origin letter, destination letter,
+# LOSD and driving distance (0 when the pair has no lookup), with the
+# number of pairs in it, the same as the far pair summaries of stage 2
+# (see NeighborIndex.py), which are added to it. Every pair of a row gets
+# the same final distance and cost in any scenario, so the totals are the
+# same as the ones of 5_FinalCost.
+#
+# The histograms are kept in 5_Histograms (<filename> and <filename>.json
+# with the multiplier) and rebuilt when the region file, its journal or its
+# far summary change.
+#
+# A scenario is a dictionary, eg. {"name": "rate 0.55", "per_km": 0.55}
+#   name        - shown with the results
+#   per_km      - driving cost per km (0.5)
+#   train_air   - train/flight fare over the cut-off (121.64)
+#   nu_ontario  - Nunavut/NWT (X) to/from Ontario fare (934)
+#   nu_prairie  - Nunavut/NWT (X) to/from the Prairies fare (483)
+#   yukon       - Yukon (Y) to/from anywhere else fare (263)
+#   cut_off     - km from which the LOSD is used and the train/flight fare
+#                 applies (300)
+#   multiplier  - driving distance multiplier, default the one of the
+#                 region's lookups
+#   rules       - a whole rule table (see CostRules.py), instead of the
+#                 fares above
+#
+# python CostScenarios.py scenarios.json [--output results.csv] runs a
+# JSON list of scenarios.
+
+import os
+import json
+import argparse
+import numpy as np
+import pandas as pd
+from CostRules import (ONTARIO_PREFIX, PRAIRIE_PREFIX, ZERO_DIST,
+                       apply_rules, zero_to_default)
+from NeighborIndex import read_far_summary, far_summary_path
+from LookupJournal import read_with_journal, journal_path
+from ColumnStore import region_files, region_path
+
+HISTOGRAM_DIR = '5_Histograms'
+
+HISTOGRAM_LABELS = ['OriPrefix', 'DstPrefix', 'LOSD', 'DrivingDist', 'Count']
+
+RESULT_LABELS = ['Scenario', 'Region', 'AvgDist', 'TotalDist', 'TotalRec',
+                 'Mult', 'TotalCost', 'u300Cost', 'o300Cost', 'corr']
+
+# Values of FINAL_COST_RULES
+DEFAULT_SCENARIO = {'per_km': 0.5, 'train_air': 121.64, 'nu_ontario': 934,
+                    'nu_prairie': 483, 'yukon': 263, 'cut_off': 300}
+
+
+# The 5_FinalCost rule table with other fares
+def final_rules(per_km=0.5, train_air=121.64, nu_ontario=934, nu_prairie=483,
+                yukon=263, cut_off=300):
+    return [
+        # origin          dest              min km    fixed        per km
+        ('X',             ONTARIO_PREFIX,   None,     nu_ontario,  0),
+        (ONTARIO_PREFIX,  'X',              None,     nu_ontario,  0),
+        ('X',             PRAIRIE_PREFIX,   None,     nu_prairie,  0),
+        (PRAIRIE_PREFIX,  'X',              None,     nu_prairie,  0),
+        ('Y',             '!Y',             None,     yukon,       0),
+        ('!Y',            'Y',              None,     yukon,       0),
+        (None,            None,             cut_off,  train_air,   0),
+        (None,            None,             None,     0,           per_km),
+    ]
+
+
+def histogram_paths(filename):
+    path = os.path.join(HISTOGRAM_DIR, filename)
+    return (path, path + '.json')
+
+
+# Size and time of the files a histogram is built from
+def source_stamp(directory, filename):
+    stamp = []
+    for path in [region_path(directory, filename), journal_path(filename),
+                 far_summary_path(filename)]:
+        if (os.path.exists(path)):
+            stat = os.stat(path)
+            stamp.append([path, stat.st_size, stat.st_mtime_ns])
+    return stamp
+
+
+# Return the histogram of a region (df with its journal applied, far_df
+# its far summary or None) and its multiplier
+def build_histogram(df, far_df=None):
+    lookup = df['Update'].values != 0
+    multiplier = df['Mult'][lookup].mean()
+    hist_df = pd.DataFrame({
+        'OriPrefix': df['Origin'].astype(str).str[:1].values,
+        'DstPrefix': df['Destination'].astype(str).str[:1].values,
+        'LOSD': df['LOSD'].values,
+        'DrivingDist': np.where(lookup, df['DrivingDist'].values, 0),
+        'Count': 1})
+
+    if (far_df is not None and len(far_df) > 0):
+        far_df = far_df.assign(DrivingDist=0)
+        hist_df = pd.concat([hist_df, far_df[HISTOGRAM_LABELS]],
+                            ignore_index=True)
+
+    hist_df = (hist_df.groupby(HISTOGRAM_LABELS[:-1], as_index=False)
+               ['Count'].sum())
+    return (hist_df, float(multiplier))
+
+
+# The histogram of a region, built first if it is missing or out of date
+def load_histogram(directory, filename):
+    (path, metaPath) = histogram_paths(filename)
+    stamp = source_stamp(directory, filename)
+    if (os.path.exists(metaPath)):
+        with open(metaPath) as f:
+            meta = json.load(f)
+        if (meta['stamp'] == stamp and os.path.exists(path)):
+            hist_df = pd.read_csv(path, header=0, keep_default_na=False)
+            return (hist_df, meta['multiplier'])
+
+    df = read_with_journal(directory, filename, ['Origin', 'Destination',
+                                                 'LOSD', 'DrivingDist',
+                                                 'Update', 'Mult'])
+    (hist_df, multiplier) = build_histogram(df, read_far_summary(filename))
+
+    os.makedirs(HISTOGRAM_DIR, exist_ok=True)
+    hist_df.to_csv(path, index=False)
+    with open(metaPath + '.tmp', 'w') as f:
+        json.dump({'stamp': stamp, 'multiplier': multiplier,
+                   'pairs': int(hist_df['Count'].sum())}, f)
+    os.replace(metaPath + '.tmp', metaPath)
+    return (hist_df, multiplier)
+
+
+# Return the totals of one region for one scenario, as returned by
+# 5_FinalCost.generate_costs:
+# (avg, total, cnt, cumMult, totalCost, u300Cost, o300Cost, corr)
+def evaluate(hist_df, multiplier, scenario=None):
+    options = dict(DEFAULT_SCENARIO)
+    options.update(scenario or {})
+    rules = options.get('rules')
+    if (rules is None):
+        rules = final_rules(options['per_km'], options['train_air'],
+                            options['nu_ontario'], options['nu_prairie'],
+                            options['yukon'], options['cut_off'])
+    if (options.get('multiplier') is not None):
+        multiplier = options['multiplier']
+    cutOff = options['cut_off']
+
+    losd = hist_df['LOSD'].values
+    drDist = hist_df['DrivingDist'].values
+    count = hist_df['Count'].values
+    lookup = drDist != 0
+
+    # Same choice of distance as 5_FinalCost
+    dist = np.where(losd < cutOff,
+                    np.where(lookup, drDist, losd * multiplier), losd)
+    dist = zero_to_default(dist, options.get('zero_dist', ZERO_DIST))
+    cost = apply_rules(rules, hist_df['OriPrefix'].values,
+                       hist_df['DstPrefix'].values, dist)
+
+    cnt = int(count.sum())
+    total = round((dist * count).sum())
+    avg = round((dist * count).sum() / cnt) if cnt > 0 else float('nan')
+    totalCost = round((cost * count).sum())
+    u300Cost = round((cost * count)[dist < cutOff].sum())
+    o300Cost = round((cost * count)[dist >= cutOff].sum())
+
+    # Correlation of the LOSD and final distance of the looked up pairs
+    looked = pd.DataFrame({'LOSD': np.repeat(losd[lookup], count[lookup]),
+                           'Final_Dist': np.repeat(dist[lookup],
+                                                   count[lookup])})
+    corr = round(looked['LOSD'].corr(looked['Final_Dist']), 2)
+
+    return (avg, total, cnt, round(multiplier, 2), totalCost, u300Cost,
+            o300Cost, corr)
+
+
+# Evaluate every scenario for every region of directory, returns a frame
+# with one row per scenario and region
+def evaluate_scenarios(scenarios, directory='4_CostLists'):
+    histograms = {filename: load_histogram(directory, filename)
+                  for filename in sorted(region_files(directory))}
+
+    rows = []
+    for (n, scenario) in enumerate(scenarios):
+        name = scenario.get('name', 'Scenario ' + str(n + 1))
+        for (filename, (hist_df, multiplier)) in histograms.items():
+            rows.append((name, filename) +
+                        evaluate(hist_df, multiplier, scenario))
+    return pd.DataFrame(rows, columns=RESULT_LABELS)
+
+
+def main_program(argv=None):
+    parser = argparse.ArgumentParser(description='Evaluate fare scenarios '
+                                     'for all regions')
+    parser.add_argument('scenarios', nargs='?', default=None,
+                        help='JSON list of scenarios (default: the current '
+                             'fares)')
+    parser.add_argument('--output', default=None,
+                        help='write the results to this CSV')
+    args = parser.parse_args(argv)
+
+    scenarios = [{'name': 'Current'}]
+    if (args.scenarios is not None):
+        with open(args.scenarios) as f:
+            scenarios = json.load(f)
+
+    results_df = evaluate_scenarios(scenarios)
+
+    for (name, scenario_df) in results_df.groupby('Scenario', sort=False):
+        print(name)
+        print("Region   AvgDist  TotalDist  TotalRec Mult TotalCost u300Cost o300Cost corr")
+        for row in scenario_df.itertuples(index=False):
+            print(tuple(row[1:]))
+
+    if (args.output is not None):
+        results_df.to_csv(args.output, index=False)
+
+if __name__ == '__main__':
+    main_program()
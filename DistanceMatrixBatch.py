@@ -0,0 +1,125 @@
+#!/usr/bin/python3
+# CRA OCAD Project
+#
+# DistanceMatrixBatch.py
+# Created for group project:
+# Andrew Campbell, Xiang Gao, Gurleen Kaur and Apurv Shah
+# Algonquin College
+# This file groups the driving distance lookups of 4_DDCalcs into Distance
+# Matrix requests with several origins and destinations, instead of one
+# request per pair.
+#
+# The API bills every element (origin x destination) of a request, so the
+# planner only builds requests where every element is a pair we want:
+# one origin with up to 25 of its destinations, or one destination with up
+# to 25 of its origins. The location shared by the most pending pairs is
+# taken first. If pack_singles is set, the pairs left over are also packed
+# k origins x k destinations into one request, trading unused elements for
+# fewer round trips.
+#
+# pack_singles is off by default on purpose. The pairs of 4_DDCalcs are a
+# random sample (LookupSampler.py) and rarely share a location, so most of
+# them are singles. Packing k of them bills k x k elements for k pairs
+# (10 times the quota with the 100 element limit), while the daily quota is
+# what limits the lookups, not the number of round trips. The sample is not
+# drawn by shared origin either: pairs of one origin have close multipliers,
+# so a sample of them narrows the confidence interval less than the same
+# number of independent pairs and would need more lookups.
+#
+# The client is anything with the distance_matrix(origins, destinations,
+# mode) method of googlemaps.Client, eg. a local stub in tests.
+
+import math
+
+# Google Distance Matrix API limits per request
+MAX_ORIGINS      = 25
+MAX_DESTINATIONS = 25
+MAX_ELEMENTS     = 100
+
+# API statuses meaning the quota is used up
+QUOTA_STATUSES = ['OVER_QUERY_LIMIT', 'OVER_DAILY_LIMIT']
+
+
+# A request is a list of origins, a list of destinations, and the pairs
+# (key, origin position, destination position) it answers
+class MatrixRequest:
+
+    def __init__(self, origins, destinations, pairs):
+        self.origins = origins
+        self.destinations = destinations
+        self.pairs = pairs
+
+    def elements(self):
+        return len(self.origins) * len(self.destinations)
+
+
+# pairs is a list of (key, origin, destination) where origin and destination
+# are anything the client accepts (eg. "45.42, -75.69")
+def plan_requests(pairs, max_origins=MAX_ORIGINS, max_dests=MAX_DESTINATIONS,
+                  max_elements=MAX_ELEMENTS, pack_singles=False):
+    pending = list(pairs)
+    requests = []
+
+    starSize = min(max(max_origins, max_dests), max_elements)
+    while len(pending) > 0:
+        # Find the origin or destination shared by the most pending pairs
+        byOrigin = {}
+        byDest = {}
+        for pair in pending:
+            byOrigin.setdefault(pair[1], []).append(pair)
+            byDest.setdefault(pair[2], []).append(pair)
+
+        bestOrigin = max(byOrigin.values(), key=len)
+        bestDest = max(byDest.values(), key=len)
+        if (len(bestOrigin) < 2 and len(bestDest) < 2):
+            break
+
+        if (len(bestOrigin) >= len(bestDest)):
+            group = bestOrigin[:min(max_dests, starSize)]
+            dests = list(dict.fromkeys(pair[2] for pair in group))
+            requests.append(MatrixRequest(
+                [group[0][1]], dests,
+                [(pair[0], 0, dests.index(pair[2])) for pair in group]))
+        else:
+            group = bestDest[:min(max_origins, starSize)]
+            origins = list(dict.fromkeys(pair[1] for pair in group))
+            requests.append(MatrixRequest(
+                origins, [group[0][2]],
+                [(pair[0], origins.index(pair[1]), 0) for pair in group]))
+
+        taken = set(id(pair) for pair in group)
+        pending = [pair for pair in pending if id(pair) not in taken]
+
+    # Pairs that do not share a location with any other pair
+    if (pack_singles):
+        k = max(1, min(max_origins, max_dests, int(math.sqrt(max_elements))))
+    else:
+        k = 1
+    for start in range(0, len(pending), k):
+        group = pending[start:start+k]
+        requests.append(MatrixRequest(
+            [pair[1] for pair in group], [pair[2] for pair in group],
+            [(pair[0], n, n) for n, pair in enumerate(group)]))
+
+    return requests
+
+
+# Send the requests and yield (key, status, metres) for every pair.
+# status is the element status from the API (OK, ZERO_RESULTS, NOT_FOUND),
+# metres is None unless the status is OK.
+def run_requests(client, requests, mode='driving'):
+    for request in requests:
+        distance = client.distance_matrix(origins=request.origins,
+                                          destinations=request.destinations,
+                                          mode=mode)
+        for (key, oriPos, dstPos) in request.pairs:
+            element = distance['rows'][oriPos]['elements'][dstPos]
+            if (element['status'] == 'OK'):
+                yield (key, 'OK', element['distance']['value'])
+            else:
+                yield (key, element['status'], None)
+
+
+def lookup_pairs(client, pairs, mode='driving', **plan_options):
+    requests = plan_requests(pairs, **plan_options)
+    return run_requests(client, requests, mode)
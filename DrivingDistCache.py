@@ -0,0 +1,120 @@
+#!/usr/bin/python3
+# CRA OCAD Project
+#
+# DrivingDistCache.py
+# Created for group project:
+# Andrew Campbell, Xiang Gao, Gurleen Kaur and Apurv Shah
+# Algonquin College
+# This file holds an on-disk cache (SQLite) of the driving distances looked
+# up by 4_DDCalcs, shared by all regions and runs. Every distance we paid
+# for is kept, even if the region files are regenerated by stages 2-3.
+#
+# Distances are keyed by the unordered pair of postal codes, so A->B and
+# B->A are the same entry. The coordinates used for the lookup, the status
+# returned (OK or eg. ZERO_RESULTS), the source and the fetch date are kept
+# with the distance.
+
+import sqlite3
+import datetime
+import numpy as np
+import pandas as pd
+
+DEFAULT_DD_CACHE = 'driving_cache.sqlite'
+
+
+def pair_key(origin, dest):
+    if (origin <= dest):
+        return origin + '|' + dest
+    return dest + '|' + origin
+
+
+# Vectorized pair_key for whole columns
+def pair_keys(origins, dests):
+    origins = np.asarray(origins, dtype=str)
+    dests = np.asarray(dests, dtype=str)
+    first = np.where(origins <= dests, origins, dests)
+    second = np.where(origins <= dests, dests, origins)
+    return np.char.add(np.char.add(first, '|'), second)
+
+
+class DrivingDistCache:
+
+    def __init__(self, path=DEFAULT_DD_CACHE):
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+
+        # Several regional files may share the cache from different workers
+        self.conn = sqlite3.connect(path, timeout=60)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS driving ('
+                          ' pair    TEXT PRIMARY KEY,'
+                          ' status  TEXT NOT NULL,'
+                          ' metres  INTEGER,'
+                          ' ori     TEXT,'
+                          ' dst     TEXT,'
+                          ' source  TEXT NOT NULL,'
+                          ' fetched TEXT NOT NULL)')
+        self.conn.commit()
+
+    # Return (status, metres) or None if the pair was never looked up
+    def get(self, origin, dest):
+        row = self.conn.execute('SELECT status, metres FROM driving '
+                                'WHERE pair = ?',
+                                (pair_key(origin, dest),)).fetchone()
+        if (row is None):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return (row[0], row[1])
+
+    def put(self, origin, dest, status, metres, ori=None, dst=None,
+            source='google'):
+        fetched = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        with self.conn:
+            self.conn.execute('INSERT OR REPLACE INTO driving '
+                              '(pair, status, metres, ori, dst, source, fetched) '
+                              'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                              (pair_key(origin, dest), status, metres,
+                               ori, dst, source, fetched))
+
+    # All distances with an OK status as a frame with Pair and Metres columns
+    def ok_frame(self):
+        return pd.read_sql_query("SELECT pair AS Pair, metres AS Metres "
+                                 "FROM driving WHERE status = 'OK'",
+                                 self.conn)
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+# Fill DrivingDist, Update and Mult of the rows with LOSD under max_losd
+# from the cache. Returns the number of rows filled.
+def prefill_driving_dist(df, cache, update=1, max_losd=300):
+    cached = cache.ok_frame()
+    if (len(cached) == 0):
+        return 0
+
+    metres = pd.Series(cached['Metres'].values, index=cached['Pair'].values)
+    near = (df['LOSD'] < max_losd).values
+    keys = pair_keys(df['Origin'].values[near], df['Destination'].values[near])
+    found = metres.reindex(keys).values
+
+    rows = np.flatnonzero(near)[~np.isnan(found)]
+    dist_km = np.round(found[~np.isnan(found)] / 1000).astype(np.int64)
+
+    # Same as LOSD, 0 is converted to 1 as there maybe some driving required
+    dist_km = np.where(dist_km == 0, 1, dist_km)
+
+    if (df['Mult'].dtype != np.float64):
+        df['Mult'] = df['Mult'].astype(float)
+    df.loc[df.index[rows], 'DrivingDist'] = dist_km
+    df.loc[df.index[rows], 'Update'] = update
+    df.loc[df.index[rows], 'Mult'] = dist_km / df['LOSD'].values[rows]
+
+    return len(rows)
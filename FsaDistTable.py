@@ -0,0 +1,323 @@
+#!/usr/bin/python3
+# CRA OCAD Project
+#
+# FsaDistTable.py
+# Created for group project:
+# Andrew Campbell, Xiang Gao, Gurleen Kaur and Apurv Shah
+# Algonquin College
+# This file builds a national table of driving distances between the
+# centres of the forward sortation areas (FSA, the first 3 characters of a
+# postal code), and gives a multiplier per FSA pair from it.
+#
+# 5_FinalCost --fsa-table uses these multipliers for the pairs under 300 km
+# without a lookup, instead of the one multiplier of the region:
+#   1. the driving distance of the pair, if it was looked up (4_DDCalcs)
+#   2. the multiplier of its FSA pair, if the table has one
+#   3. the mean multiplier of the region
+# Pairs in the same FSA, or in FSAs whose centres are under MIN_LOSD_KM
+# apart, have no multiplier in the table.
+#
+# The centre of an FSA is the mean Lat/Long of its postal codes in
+# CanadianPostalCodes.csv. Only the FSA pairs under TABLE_RADIUS_KM are in
+# the table, the pairs of sites under 300 km can have centres a bit further
+# apart.
+#
+# The table (fsa_table.sqlite) is built once and shared by all regions and
+# runs. Every answer is committed as it comes, so the build can be stopped
+# at any time (or by --max-lookups, or the daily limit of Google) and the
+# next run carries on with the pairs left. The distances come from any
+# client with the distance_matrix method of googlemaps.Client: Google Maps
+# (the default), a road network with --road-network DIR (RoadNetwork.py),
+# or a local stub in tests.
+
+import os
+import sqlite3
+import argparse
+import datetime
+import numpy as np
+import pandas as pd
+from DistanceMatrixBatch import plan_requests, run_requests, QUOTA_STATUSES
+from DrivingDistCache import pair_key, pair_keys
+from NeighborIndex import radius_pairs
+from PostalCodeIndex import POSTAL_CODES_CSV
+from GeoDistance import METHODS
+from RoadNetwork import get_road_client
+from Metrics import metrics
+
+DEFAULT_FSA_TABLE = 'fsa_table.sqlite'
+
+# FSA pairs whose centres are under this LOSD (km) are looked up
+TABLE_RADIUS_KM = 350
+
+# FSA pairs whose centres are closer than this (km) give no multiplier, the
+# distance between the centres says little about the pairs of sites
+MIN_LOSD_KM = 5
+
+# Pairs looked up at a time, the answers are committed after each batch
+DEFAULT_BATCH_SIZE = 100
+
+PENDING = 'pending'
+DONE    = 'done'
+
+
+def fsa_codes(postalCodes):
+    return np.asarray(postalCodes, dtype=str).astype('<U3')
+
+
+# Centre of every FSA of the postal code csv, as a frame with the columns
+# FSA, Lat, Long, Codes (number of postal codes)
+def fsa_centres(csv_path=POSTAL_CODES_CSV):
+    pc_df = pd.read_csv(csv_path, header=0)
+    pc_df = pc_df.drop_duplicates('PostalCode', keep='last')
+    pc_df['FSA'] = fsa_codes(pc_df['PostalCode'].values)
+    centre_df = (pc_df.groupby('FSA', as_index=False)
+                 .agg(Lat=('Latitude', 'mean'), Long=('Longitude', 'mean'),
+                      Codes=('PostalCode', 'size')))
+    return centre_df
+
+
+# FSAs of the postal codes in the files of a folder (eg. 2_LatLongLists)
+def used_fsas(directory):
+    fsas = set()
+    for filename in os.listdir(directory):
+        ll_df = pd.read_csv(os.path.join(directory, filename), header=0,
+                            usecols=['PostalCode'])
+        fsas.update(fsa_codes(ll_df['PostalCode'].values).tolist())
+    return fsas
+
+
+class FsaDistTable:
+
+    def __init__(self, path=DEFAULT_FSA_TABLE):
+        self.path = path
+        self.conn = sqlite3.connect(path, timeout=60)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS fsas ('
+                          ' fsa     TEXT PRIMARY KEY,'
+                          ' lat     REAL NOT NULL,'
+                          ' lng     REAL NOT NULL,'
+                          ' codes   INTEGER NOT NULL)')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS pairs ('
+                          ' pair    TEXT PRIMARY KEY,'
+                          ' losd    INTEGER NOT NULL,'
+                          ' ori     TEXT NOT NULL,'
+                          ' dst     TEXT NOT NULL,'
+                          ' state   TEXT NOT NULL,'
+                          ' status  TEXT,'
+                          ' metres  INTEGER,'
+                          ' source  TEXT,'
+                          ' fetched TEXT)')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS next_pairs ON pairs '
+                          '(state, losd)')
+        self.conn.commit()
+
+    # Add the FSA pairs of centre_df under radius_km that are not in the
+    # table yet, the pairs already looked up are kept. Returns the number
+    # of pairs added.
+    def add_pairs(self, centre_df, radius_km=TABLE_RADIUS_KM,
+                  method='vincenty'):
+        fsas = centre_df['FSA'].values.astype(str)
+        lats = centre_df['Lat'].values.astype(np.float64)
+        lngs = centre_df['Long'].values.astype(np.float64)
+        (oriIdx, dstIdx, losd, far_df) = radius_pairs(fsas, lats, lngs,
+                                                      radius_km, method)
+        locations = [str(lat) + ', ' + str(lng)
+                     for (lat, lng) in zip(lats, lngs)]
+
+        with self.conn:
+            self.conn.executemany('INSERT OR REPLACE INTO fsas '
+                                  '(fsa, lat, lng, codes) VALUES (?, ?, ?, ?)',
+                                  zip(fsas.tolist(), lats.tolist(),
+                                      lngs.tolist(),
+                                      centre_df['Codes'].astype(int).tolist()))
+            before = self.conn.total_changes
+            self.conn.executemany('INSERT OR IGNORE INTO pairs '
+                                  '(pair, losd, ori, dst, state) '
+                                  'VALUES (?, ?, ?, ?, ?)',
+                                  ((pair_key(fsas[i], fsas[j]), int(km),
+                                    locations[i], locations[j], PENDING)
+                                   for (i, j, km) in zip(oriIdx.tolist(),
+                                                         dstIdx.tolist(),
+                                                         losd.tolist())))
+        return self.conn.total_changes - before
+
+    # (pending, done, ok) pair counts
+    def counts(self):
+        (pending, done, ok) = self.conn.execute(
+            "SELECT COALESCE(SUM(state = 'pending'), 0),"
+            " COALESCE(SUM(state = 'done'), 0),"
+            " COALESCE(SUM(status = 'OK'), 0) FROM pairs").fetchone()
+        return (pending, done, ok)
+
+    # The next k pairs to look up, the closest first: [(pair, ori, dst)]
+    def next_pairs(self, k):
+        return self.conn.execute('SELECT pair, ori, dst FROM pairs '
+                                 'WHERE state = ? ORDER BY losd, pair '
+                                 'LIMIT ?', (PENDING, k)).fetchall()
+
+    def record(self, pair, status, metres, source='google'):
+        fetched = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        self.conn.execute('UPDATE pairs SET state = ?, status = ?, '
+                          'metres = ?, source = ?, fetched = ? '
+                          'WHERE pair = ?',
+                          (DONE, status, metres, source, fetched, pair))
+
+    def commit(self):
+        self.conn.commit()
+
+    # The multiplier of every FSA pair with a driving distance, as a Series
+    # indexed by the pair (see DrivingDistCache.pair_key). The driving
+    # distance is rounded to km as in 4_DDCalcs.
+    def multipliers(self, min_losd=MIN_LOSD_KM):
+        mult_df = pd.read_sql_query("SELECT pair, losd, metres FROM pairs "
+                                    "WHERE status = 'OK' AND losd >= ?",
+                                    self.conn, params=(min_losd,))
+        drDist = np.maximum(np.round(mult_df['metres'].values / 1000), 1)
+        return pd.Series(drDist / mult_df['losd'].values,
+                         index=mult_df['pair'].values, name='Mult')
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+# Look up the pending pairs of the table, at most max_lookups of them
+# (None: all). Returns the number of pairs looked up.
+def look_up_pairs(table, client, max_lookups=None,
+                  batch_size=DEFAULT_BATCH_SIZE):
+    (pending, done, ok) = table.counts()
+    total = pending + done
+    lookups = 0
+    source = getattr(client, 'source', 'google')
+    while (max_lookups is None or lookups < max_lookups):
+        k = batch_size
+        if (max_lookups is not None):
+            k = min(k, max_lookups - lookups)
+        batch = table.next_pairs(k)
+        if (len(batch) == 0):
+            break
+
+        try:
+            for (pair, status, metres) in run_requests(client,
+                                                       plan_requests(batch)):
+                table.record(pair, status, metres, source)
+                lookups += 1
+        except Exception as e:
+            if (getattr(e, 'status', None) not in QUOTA_STATUSES):
+                raise
+            print('Google Maps quota reached:', e.status)
+            break
+        finally:
+            table.commit()
+
+        metrics.add_rows(len(batch))
+        metrics.progress(done + lookups, total, 'pairs')
+        print("FSA pairs looked up: " + str(done + lookups) + " of " +
+              str(total) + ". Time: " +
+              datetime.datetime.now().strftime('%H:%M:%S'))
+    return lookups
+
+
+# Add the FSA pairs of the postal code csv to the table and look them up.
+# fsas limits the table to these FSAs (None: all of them).
+def build_table(path=DEFAULT_FSA_TABLE, csv_path=POSTAL_CODES_CSV,
+                client=None, road_network=None, radius_km=TABLE_RADIUS_KM,
+                method='vincenty', fsas=None, max_lookups=None,
+                batch_size=DEFAULT_BATCH_SIZE):
+    centre_df = fsa_centres(csv_path)
+    if (fsas is not None):
+        centre_df = centre_df[centre_df['FSA'].isin(fsas)]
+
+    with FsaDistTable(path) as table:
+        added = table.add_pairs(centre_df, radius_km, method)
+        print('FSAs:', len(centre_df), ' FSA pairs added:', added)
+
+        if (client is None and road_network is not None):
+            client = get_road_client(road_network)
+        if (client is None and table.counts()[0] > 0 and max_lookups != 0):
+            # Only needed to build the table, 5_FinalCost only reads it
+            from MapsClient import get_client
+            client = get_client()
+        lookups = look_up_pairs(table, client, max_lookups, batch_size)
+
+        (pending, done, ok) = table.counts()
+        print('FSA pairs: done', done, '(' + str(ok) + ' with a road)',
+              ' pending', pending)
+    return lookups
+
+
+# Tables already read in this process, by path
+_multipliers = {}
+
+def get_fsa_multipliers(path=DEFAULT_FSA_TABLE):
+    if (path not in _multipliers):
+        with FsaDistTable(path) as table:
+            _multipliers[path] = table.multipliers()
+        print('FSA pair multipliers loaded:', len(_multipliers[path]))
+    return _multipliers[path]
+
+
+# Multiplier of the FSA pair of every origin and destination from the
+# Series of get_fsa_multipliers, NaN where the table has none
+def pair_multipliers(fsa_mult, origins, dests):
+    keys = pair_keys(fsa_codes(origins), fsa_codes(dests))
+    return fsa_mult.reindex(keys).values
+
+
+def main_program(argv=None):
+    parser = argparse.ArgumentParser(description='Build the table of driving '
+                                     'distances between FSA centres')
+    parser.add_argument('--table', default=DEFAULT_FSA_TABLE,
+                        help='FSA table file')
+    parser.add_argument('--csv', default=POSTAL_CODES_CSV,
+                        help='postal code csv the FSA centres are taken from')
+    parser.add_argument('--radius', type=int, default=TABLE_RADIUS_KM,
+                        help='only FSA pairs under this LOSD (km)')
+    parser.add_argument('--method', choices=METHODS, default='vincenty',
+                        help='distance formula used for the LOSD')
+    parser.add_argument('--used-only', default=None, metavar='DIR',
+                        help='only the FSAs of the postal codes in DIR, eg. '
+                             '2_LatLongLists')
+    parser.add_argument('--road-network', default=None, metavar='DIR',
+                        help='look up driving distances on the road network '
+                             'in DIR instead of Google Maps')
+    parser.add_argument('--max-lookups', type=int, default=None,
+                        help='stop after this many FSA pairs (the next run '
+                             'carries on)')
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE,
+                        help='pairs looked up at a time')
+    parser.add_argument('--status', action='store_true',
+                        help='only show the state of the table')
+    parser.add_argument('--metrics', default=None, metavar='FILE',
+                        help='write the time, rows, API calls and peak '
+                             'memory to FILE as JSON')
+    parser.add_argument('--progress', action='store_true',
+                        help='show a live progress line on stderr')
+    args = parser.parse_args(argv)
+    metrics.start(args.metrics, args.progress)
+
+    if (args.status):
+        with FsaDistTable(args.table) as table:
+            (pending, done, ok) = table.counts()
+            print('FSA pairs: done', done, '(' + str(ok) + ' with a road)',
+                  ' pending', pending, ' multipliers',
+                  len(table.multipliers()))
+        return
+
+    fsas = None
+    if (args.used_only is not None):
+        fsas = used_fsas(args.used_only)
+
+    with metrics.region('FsaDistTable', args.table):
+        build_table(args.table, args.csv, road_network=args.road_network,
+                    radius_km=args.radius, method=args.method, fsas=fsas,
+                    max_lookups=args.max_lookups, batch_size=args.batch_size)
+
+    metrics.save()
+
+if __name__ == '__main__':
+    main_program()
@@ -0,0 +1,320 @@
+#!/usr/bin/python3
+# CRA OCAD Project
+#
+# GeoDistance.py
+# Created for group project:
+# Andrew Campbell, Xiang Gao, Gurleen Kaur and Apurv Shah
+# Algonquin College
+# This file holds the batched distance engine used for the Line of Sight
+# Distance (LOSD). Instead of calling geopy once per origin/destination
+# pair, all pairs are computed at once from arrays of coordinates.
+#
+# Two methods are available:
+# vincenty  - Vincenty's inverse formula on the WGS-84 ellipsoid. This is
+#             the same formula geopy's vincenty() uses, so the rounded km
+#             values match the original per-pair output.
+# haversine - Great circle distance on a sphere with the mean earth radius.
+#             Faster, but can differ from vincenty by up to ~0.5%.
+# tiered    - The same whole km as vincenty for a fraction of the work.
+#             Lambert's formula (ellipsoidal, no iterations) gives every
+#             distance within LAMBERT_ERROR of the exact one. When that
+#             range can only round to one whole km, that km is used. Only
+#             the few pairs whose range crosses a rounding boundary (x.5 km)
+#             are solved with vincenty. The 300 and 500 km thresholds of the
+#             cost rules are whole km, so every pair lands on the same side
+#             of them and gets the same cost as with vincenty.
+
+import argparse
+import numpy as np
+
+# WGS-84 ellipsoid (same constants geopy uses)
+WGS84_A = 6378.137
+WGS84_F = 1 / 298.257223563
+WGS84_B = (1 - WGS84_F) * WGS84_A
+
+# Mean earth radius used for the spherical (haversine) distance
+EARTH_RADIUS_KM = 6371.009
+
+METHODS = ('vincenty', 'haversine', 'tiered')
+
+# Largest error of Lambert's formula relative to the distance. Its error
+# terms are of the order of the flattening squared, the value used has a
+# margin of about 8 times the largest error seen on Canadian pairs (check
+# it with python GeoDistance.py --check-lambert). The small absolute part
+# covers the rounding of the float arithmetic.
+LAMBERT_ERROR = WGS84_F**2
+LAMBERT_ERROR_KM = 1e-6
+
+
+def haversine_km(oriLat, oriLng, dstLat, dstLng):
+
+    lat1 = np.radians(np.asarray(oriLat, dtype=np.float64))
+    lng1 = np.radians(np.asarray(oriLng, dtype=np.float64))
+    lat2 = np.radians(np.asarray(dstLat, dtype=np.float64))
+    lng2 = np.radians(np.asarray(dstLng, dtype=np.float64))
+
+    sinDLat = np.sin((lat2 - lat1) / 2)
+    sinDLng = np.sin((lng2 - lng1) / 2)
+    h = sinDLat**2 + np.cos(lat1) * np.cos(lat2) * sinDLng**2
+
+    # Guard against rounding pushing h slightly above 1
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.minimum(h, 1.0)))
+
+
+def vincenty_km(oriLat, oriLng, dstLat, dstLng, iter_limit=20):
+
+    lat1 = np.radians(np.asarray(oriLat, dtype=np.float64))
+    lng1 = np.radians(np.asarray(oriLng, dtype=np.float64))
+    lat2 = np.radians(np.asarray(dstLat, dtype=np.float64))
+    lng2 = np.radians(np.asarray(dstLng, dtype=np.float64))
+
+    f = WGS84_F
+    L = lng2 - lng1
+
+    # Reduced latitudes
+    U1 = np.arctan((1 - f) * np.tan(lat1))
+    U2 = np.arctan((1 - f) * np.tan(lat2))
+    sinU1, cosU1 = np.sin(U1), np.cos(U1)
+    sinU2, cosU2 = np.sin(U2), np.cos(U2)
+
+    lambdaLng = L.copy()
+
+    # Iterate on all pairs together until every pair has converged.
+    # Pairs that converge early are simply recomputed with the same result.
+    with np.errstate(invalid='ignore', divide='ignore'):
+        for _ in range(iter_limit):
+            sinLambda = np.sin(lambdaLng)
+            cosLambda = np.cos(lambdaLng)
+
+            sinSigma = np.sqrt((cosU2 * sinLambda)**2 +
+                               (cosU1 * sinU2 - sinU1 * cosU2 * cosLambda)**2)
+            cosSigma = sinU1 * sinU2 + cosU1 * cosU2 * cosLambda
+            sigma = np.arctan2(sinSigma, cosSigma)
+
+            # Coincident points have sinSigma of 0
+            sinAlpha = np.where(sinSigma == 0, 0.0,
+                                cosU1 * cosU2 * sinLambda / sinSigma)
+            cosSqAlpha = 1 - sinAlpha**2
+
+            # Equatorial lines have cosSqAlpha of 0
+            cos2SigmaM = np.where(cosSqAlpha == 0, 0.0,
+                                  cosSigma - 2 * sinU1 * sinU2 / cosSqAlpha)
+
+            C = f / 16 * cosSqAlpha * (4 + f * (4 - 3 * cosSqAlpha))
+            lambdaPrev = lambdaLng
+            lambdaLng = L + (1 - C) * f * sinAlpha * (
+                sigma + C * sinSigma * (
+                    cos2SigmaM + C * cosSigma * (-1 + 2 * cos2SigmaM**2)))
+
+            if (np.size(lambdaLng) == 0 or
+                np.max(np.abs(lambdaLng - lambdaPrev)) <= 1e-12):
+                break
+        else:
+            raise ValueError('Vincenty formula failed to converge')
+
+    uSq = cosSqAlpha * (WGS84_A**2 - WGS84_B**2) / WGS84_B**2
+    A = 1 + uSq / 16384 * (4096 + uSq * (-768 + uSq * (320 - 175 * uSq)))
+    B = uSq / 1024 * (256 + uSq * (-128 + uSq * (74 - 47 * uSq)))
+    deltaSigma = B * sinSigma * (
+        cos2SigmaM + B / 4 * (
+            cosSigma * (-1 + 2 * cos2SigmaM**2) -
+            B / 6 * cos2SigmaM * (-3 + 4 * sinSigma**2) *
+            (-3 + 4 * cos2SigmaM**2)))
+
+    dist = WGS84_B * A * (sigma - deltaSigma)
+    return np.where(sinSigma == 0, 0.0, dist)
+
+
+# Lambert's formula for long lines on the ellipsoid: the great circle
+# distance between the reduced latitudes, corrected for the flattening
+def lambert_km(oriLat, oriLng, dstLat, dstLng):
+
+    lat1 = np.radians(np.asarray(oriLat, dtype=np.float64))
+    lng1 = np.radians(np.asarray(oriLng, dtype=np.float64))
+    lat2 = np.radians(np.asarray(dstLat, dtype=np.float64))
+    lng2 = np.radians(np.asarray(dstLng, dtype=np.float64))
+
+    f = WGS84_F
+    beta1 = np.arctan((1 - f) * np.tan(lat1))
+    beta2 = np.arctan((1 - f) * np.tan(lat2))
+
+    h = (np.sin((beta2 - beta1) / 2)**2 +
+         np.cos(beta1) * np.cos(beta2) * np.sin((lng2 - lng1) / 2)**2)
+    sigma = 2 * np.arcsin(np.sqrt(np.minimum(h, 1.0)))
+
+    P = (beta1 + beta2) / 2
+    Q = (beta2 - beta1) / 2
+    with np.errstate(invalid='ignore', divide='ignore'):
+        X = ((sigma - np.sin(sigma)) * np.sin(P)**2 * np.cos(Q)**2 /
+             np.cos(sigma / 2)**2)
+        Y = ((sigma + np.sin(sigma)) * np.cos(P)**2 * np.sin(Q)**2 /
+             np.sin(sigma / 2)**2)
+        dist = WGS84_A * (sigma - f / 2 * (X + Y))
+
+    # Coincident points have a sigma of 0
+    return np.where(sigma == 0, 0.0, dist)
+
+
+# The whole km of vincenty_km, solving vincenty only where Lambert's
+# formula is too close to a rounding boundary to tell
+def tiered_losd_km(oriLat, oriLng, dstLat, dstLng):
+
+    oriLat = np.asarray(oriLat, dtype=np.float64)
+    oriLng = np.asarray(oriLng, dtype=np.float64)
+    dstLat = np.asarray(dstLat, dtype=np.float64)
+    dstLng = np.asarray(dstLng, dtype=np.float64)
+
+    approx = lambert_km(oriLat, oriLng, dstLat, dstLng)
+    error = approx * LAMBERT_ERROR + LAMBERT_ERROR_KM
+    losd = np.rint(approx).astype(np.int64)
+
+    # Exact where the range of the distance holds a rounding boundary
+    unsure = np.floor(approx - error + 0.5) != np.floor(approx + error + 0.5)
+    if (np.ndim(approx) == 0):
+        if (unsure):
+            return np.rint(vincenty_km(oriLat, oriLng, dstLat,
+                                       dstLng)).astype(np.int64)
+        return losd
+    if (unsure.any()):
+        losd[unsure] = np.rint(vincenty_km(
+            np.broadcast_to(oriLat, approx.shape)[unsure],
+            np.broadcast_to(oriLng, approx.shape)[unsure],
+            np.broadcast_to(dstLat, approx.shape)[unsure],
+            np.broadcast_to(dstLng, approx.shape)[unsure])).astype(np.int64)
+    return losd
+
+
+# Lambert's formula split into terms of each point (the sines and cosines
+# of the reduced latitude and of the longitude), for many pairs between the
+# same points. A pair then only takes products, a square root and one
+# arcsin, with the half angles and P, Q of lambert_km written as cosines of
+# sums and differences. Gives the same whole km as tiered_losd_km (points
+# a few metres apart lose the absolute part of the bound to the float
+# rounding, but are still far from the 0.5 km boundary).
+class LambertPoints:
+
+    def __init__(self, lats, lngs):
+        self.lats = np.asarray(lats, dtype=np.float64)
+        self.lngs = np.asarray(lngs, dtype=np.float64)
+
+        beta = np.arctan((1 - WGS84_F) * np.tan(np.radians(self.lats)))
+        lng = np.radians(self.lngs)
+        self.sinBeta = np.sin(beta)
+        self.cosBeta = np.cos(beta)
+        self.sinLng = np.sin(lng)
+        self.cosLng = np.cos(lng)
+
+    def lambert_km(self, oriIdx, dstIdx):
+        cosCos = self.cosBeta[oriIdx] * self.cosBeta[dstIdx]
+        sinSin = self.sinBeta[oriIdx] * self.sinBeta[dstIdx]
+        cosDLng = (self.cosLng[oriIdx] * self.cosLng[dstIdx] +
+                   self.sinLng[oriIdx] * self.sinLng[dstIdx])
+
+        # sin(Q)**2 and sin(P)**2, from cos(beta2 - beta1) and
+        # cos(beta1 + beta2)
+        sinSqQ = (1 - (cosCos + sinSin)) / 2
+        sinSqP = (1 - (cosCos - sinSin)) / 2
+
+        h = np.clip(sinSqQ + cosCos * (1 - cosDLng) / 2, 0.0, 1.0)
+        sigma = 2 * np.arcsin(np.sqrt(h))
+        sinSigma = 2 * np.sqrt(h * (1 - h))
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            X = (sigma - sinSigma) * sinSqP * (1 - sinSqQ) / (1 - h)
+            Y = (sigma + sinSigma) * (1 - sinSqP) * sinSqQ / h
+            dist = WGS84_A * (sigma - WGS84_F / 2 * (X + Y))
+        return np.where(sigma == 0, 0.0, dist)
+
+    # Whole km of vincenty_km between the points oriIdx and dstIdx
+    def losd_km(self, oriIdx, dstIdx):
+        approx = self.lambert_km(oriIdx, dstIdx)
+        error = approx * LAMBERT_ERROR + LAMBERT_ERROR_KM
+        losd = np.rint(approx).astype(np.int64)
+
+        unsure = np.floor(approx - error + 0.5) != np.floor(approx + error + 0.5)
+        if (unsure.any()):
+            ori = oriIdx[unsure]
+            dst = dstIdx[unsure]
+            losd[unsure] = np.rint(vincenty_km(
+                self.lats[ori], self.lngs[ori],
+                self.lats[dst], self.lngs[dst])).astype(np.int64)
+        return losd
+
+
+def distance_km(oriLat, oriLng, dstLat, dstLng, method='vincenty'):
+
+    if (method == 'vincenty'):
+        return vincenty_km(oriLat, oriLng, dstLat, dstLng)
+    elif (method == 'haversine'):
+        return haversine_km(oriLat, oriLng, dstLat, dstLng)
+    elif (method == 'tiered'):
+        # tiered only gives whole km (see losd_km), its exact distance is
+        # the one of vincenty
+        return vincenty_km(oriLat, oriLng, dstLat, dstLng)
+    else:
+        raise ValueError('Unknown distance method: ' + str(method))
+
+
+def losd_km(oriLat, oriLng, dstLat, dstLng, method='vincenty'):
+
+    if (method == 'tiered'):
+        return tiered_losd_km(oriLat, oriLng, dstLat, dstLng)
+
+    # Round to the nearest km the same way round() did per pair
+    dist = distance_km(oriLat, oriLng, dstLat, dstLng, method)
+    return np.rint(dist).astype(np.int64)
+
+
+# Lat/Long box around Canada, for check_lambert_error
+CANADA_LATS = (41.7, 83.1)
+CANADA_LNGS = (-141.0, -52.6)
+
+
+# Compare lambert_km with vincenty_km on random Canadian pairs: half of
+# them anywhere in the box, half under 300 km apart (where the rounding
+# matters for the cost rules). Returns (largest relative error, pairs).
+def check_lambert_error(pairs=1000000, seed=0):
+    rng = np.random.default_rng(seed)
+    oriLat = rng.uniform(*CANADA_LATS, pairs)
+    oriLng = rng.uniform(*CANADA_LNGS, pairs)
+    dstLat = rng.uniform(*CANADA_LATS, pairs)
+    dstLng = rng.uniform(*CANADA_LNGS, pairs)
+
+    # Near pairs, a random direction and a distance of up to ~300 km
+    near = np.arange(pairs) % 2 == 1
+    bearing = rng.uniform(0, 2 * np.pi, pairs)
+    degrees = rng.uniform(0, 2.7, pairs)
+    dstLat[near] = np.clip(oriLat + degrees * np.cos(bearing),
+                           -89.9, 89.9)[near]
+    dstLng[near] = (oriLng + degrees * np.sin(bearing) /
+                    np.cos(np.radians(oriLat)))[near]
+
+    exact = vincenty_km(oriLat, oriLng, dstLat, dstLng)
+    approx = lambert_km(oriLat, oriLng, dstLat, dstLng)
+    measured = exact > 0
+    error = (np.abs(approx - exact)[measured] / exact[measured]).max()
+    return (float(error), int(measured.sum()))
+
+
+def main_program(argv=None):
+    parser = argparse.ArgumentParser(description='Check the error bound of '
+                                     'the tiered method')
+    parser.add_argument('--check-lambert', action='store_true',
+                        help='compare Lambert with vincenty on random '
+                             'Canadian pairs')
+    parser.add_argument('--pairs', type=int, default=1000000,
+                        help='number of random pairs')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='seed of the random pairs')
+    args = parser.parse_args(argv)
+
+    if (args.check_lambert):
+        (error, pairs) = check_lambert_error(args.pairs, args.seed)
+        print('Pairs:', pairs, ' largest relative error:', error,
+              ' bound:', LAMBERT_ERROR,
+              ' margin:', round(LAMBERT_ERROR / error, 1))
+        if (error > LAMBERT_ERROR):
+            raise SystemExit('Lambert error is over LAMBERT_ERROR')
+
+if __name__ == '__main__':
+    main_program()
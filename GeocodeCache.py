@@ -0,0 +1,77 @@
+#!/usr/bin/python3
+# CRA OCAD Project
+#
+# GeocodeCache.py
+# Created for group project:
+# Andrew Campbell, Xiang Gao, Gurleen Kaur and Apurv Shah
+# Algonquin College
+# This file holds an on-disk cache (SQLite) of Google Maps geocode results,
+# shared by all runs and all regional files. A re-run only pays for the
+# postal codes that were never looked up before.
+#
+# Every lookup is stored under the text that was geocoded (a postal code, or
+# an FSA for the fallback lookup) with its status:
+# ok   - a usable Lat/Long
+# null - Google returned the Canada centroid (56.130366, -106.346771), so
+#        the FSA fallback will be needed again. Caching this saves the
+#        lookup of the full postal code on the next run.
+#
+# Entries older than the optional TTL (in days) are treated as missing.
+
+import time
+import sqlite3
+
+DEFAULT_CACHE = 'geocode_cache.sqlite'
+
+STATUS_OK   = 'ok'
+STATUS_NULL = 'null'
+
+
+class GeocodeCache:
+
+    def __init__(self, path=DEFAULT_CACHE, ttl_days=None):
+        self.path = path
+        self.ttl = None if ttl_days is None else ttl_days * 86400
+        self.hits = 0
+        self.misses = 0
+
+        # Several regional files may share the cache from different workers
+        self.conn = sqlite3.connect(path, timeout=60)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS geocode ('
+                          ' query   TEXT PRIMARY KEY,'
+                          ' status  TEXT NOT NULL,'
+                          ' lat     REAL,'
+                          ' lng     REAL,'
+                          ' fetched REAL NOT NULL)')
+        self.conn.commit()
+
+    # Return (gotResult, lat, long) like GeocodeResolver.parse_geocode, or
+    # None if the query is not in the cache or has expired
+    def get(self, query):
+        row = self.conn.execute('SELECT status, lat, lng, fetched FROM geocode '
+                                'WHERE query = ?', (query,)).fetchone()
+        if (row is None or
+            (self.ttl is not None and time.time() - row[3] > self.ttl)):
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        gotResult = 1 if row[0] == STATUS_OK else 0
+        return (gotResult, row[1], row[2])
+
+    def put(self, query, gotResult, lat, long):
+        status = STATUS_OK if gotResult == 1 else STATUS_NULL
+        with self.conn:
+            self.conn.execute('INSERT OR REPLACE INTO geocode '
+                              '(query, status, lat, lng, fetched) '
+                              'VALUES (?, ?, ?, ?, ?)',
+                              (query, status, lat, long, time.time()))
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
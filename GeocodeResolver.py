@@ -0,0 +1,229 @@
+#!/usr/bin/python3
+# CRA OCAD Project
+#
+# GeocodeResolver.py
+# Created for group project:
+# Andrew Campbell, Xiang Gao, Gurleen Kaur and Apurv Shah
+# Algonquin College
+# This file resolves the postal codes that are not in
+# CanadianPostalCodes.csv. All unresolved codes of a file are collected
+# first and then geocoded concurrently from a pool of threads, with a limit
+# on the number of requests per second and retries with backoff.
+#
+# The limit is per process. When regional files are run by several
+# workers, each one gets its share of the limit (see worker_rps), so all
+# of them together stay within it. Every result goes to the GeocodeCache as
+# soon as it arrives, so a failed query (or a crash) does not lose the
+# lookups that were already paid for.
+#
+# The client is anything with a geocode(address) method that returns a list
+# of results in the Google Maps format, eg. googlemaps.Client, or a fake
+# client (or a client for a local fake server) in tests:
+# [{'geometry': {'location': {'lat': 45.42, 'lng': -75.69}}}]
+#
+# Lookups are done in two rounds. First the full postal codes, then the FSA
+# (first 3 characters) of the codes that came back with the null value.
+#
+# locate_postal_codes is the lookup done by 1_LatLongGenerator for a list
+# of postal codes: CanadianPostalCodes.csv first (through the index of
+# PostalCodeIndex.py), then the client.
+
+import time
+import threading
+from MapsClient import get_client
+from PostalCodeIndex import (POSTAL_CODES_CSV, INDEX_DIR, CoordinateView,
+                             load_index, locate_in_lookup, remap_postal_code)
+from Metrics import metrics
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+DEFAULT_RPS     = 10
+DEFAULT_THREADS = 8
+DEFAULT_RETRIES = 3
+DEFAULT_BACKOFF = 1.0
+
+# Google returns the centre of Canada when it cannot find a postal code
+# Null value is encoded as: (56.130366, -106.346771)
+# eg. this happens for E1C0T5
+NULL_LAT =   56.130366
+NULL_LNG = -106.346771
+
+
+def is_null_location(lat, long):
+    # Need to use this for floating point compare
+    epsilon = 0.000001
+    return abs(lat - NULL_LAT) < epsilon and abs(long - NULL_LNG) < epsilon
+
+
+# Turn a geocode response into (gotResult, lat, long)
+def parse_geocode(geocode_results):
+    if (len(geocode_results) == 0):
+        return (0, None, None)
+
+    geocode_result = geocode_results[0]
+    lat  = geocode_result["geometry"]["location"]["lat"]
+    long = geocode_result["geometry"]["location"]["lng"]
+
+    if (is_null_location(lat, long)):
+        return (0, lat, long)
+    return (1, lat, long)
+
+
+# Requests per second of one worker, when workers regional files are
+# geocoded at the same time with a total of rps
+def worker_rps(rps, workers):
+    if (not rps or rps <= 0 or workers is None or workers <= 1):
+        return rps
+    return rps / workers
+
+
+class RateLimiter:
+
+    def __init__(self, rps):
+        self.interval = 1.0 / rps if rps and rps > 0 else 0
+        self.lock = threading.Lock()
+        self.next_time = time.monotonic()
+
+    # Block until the next request is allowed
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            waitTime = self.next_time - now
+            self.next_time = max(now, self.next_time) + self.interval
+        if (waitTime > 0):
+            time.sleep(waitTime)
+
+
+class GeocodeResolver:
+
+    def __init__(self, client, rps=DEFAULT_RPS, threads=DEFAULT_THREADS,
+                 retries=DEFAULT_RETRIES, backoff=DEFAULT_BACKOFF,
+                 cache=None):
+        self.client = client
+        self.limiter = RateLimiter(rps)
+        self.threads = threads
+        self.retries = retries
+        self.backoff = backoff
+        self.cache = cache
+        self.api_calls = 0
+        self.lock = threading.Lock()
+
+    def _geocode(self, query):
+        attempt = 0
+        while True:
+            self.limiter.wait()
+            with self.lock:
+                self.api_calls += 1
+            try:
+                return parse_geocode(self.client.geocode(query + ', Canada'))
+            except Exception as e:
+                if (attempt >= self.retries):
+                    raise
+                delay = self.backoff * (2 ** attempt)
+                print('Retrying', query, 'in', delay, 's after:', repr(e))
+                time.sleep(delay)
+                attempt += 1
+
+    # Geocode a list of queries concurrently, using the cache when possible
+    # The cache is only used from this thread. If a query fails after its
+    # retries, the other queries are still finished and cached before the
+    # error is raised.
+    def _lookup_all(self, queries):
+        results = {}
+        todo = []
+        for query in queries:
+            cached = None
+            if (self.cache is not None):
+                cached = self.cache.get(query)
+            if (cached is not None):
+                results[query] = cached
+            else:
+                todo.append(query)
+
+        if (len(todo) > 0):
+            print(str(len(todo)) + ' lookups being done with Google Maps')
+            error = None
+            with ThreadPoolExecutor(max_workers=self.threads) as pool:
+                futures = {pool.submit(self._geocode, query): query
+                           for query in todo}
+                for future in as_completed(futures):
+                    query = futures[future]
+                    try:
+                        result = future.result()
+                    except Exception as e:
+                        print('***ERROR***: Geocode failed for', query,
+                              repr(e))
+                        if (error is None):
+                            error = e
+                        continue
+                    results[query] = result
+                    metrics.progress(len(results), len(queries), 'geocodes')
+                    if (self.cache is not None):
+                        self.cache.put(query, *result)
+            if (error is not None):
+                raise error
+
+        return results
+
+    # Return {postalCode: (gotResult, lat, long)} for all postal codes,
+    # falling back on the FSA when the full code gives the null value
+    def resolve(self, postalCodes):
+        postalCodes = list(dict.fromkeys(postalCodes))
+        results = self._lookup_all(postalCodes)
+
+        fsaNeeded = [pc for pc in postalCodes if results[pc][0] == 0]
+        fsaResults = self._lookup_all(list(dict.fromkeys(pc[:3] for pc in fsaNeeded)))
+        for pc in fsaNeeded:
+            results[pc] = fsaResults[pc[:3]]
+
+        return results
+
+
+# Open the postal code lookup csv as two lookups, postal code -> lat and
+# postal code -> long (the overrides of PostalCodeIndex.py are applied)
+def load_postal_code_lookup(path=POSTAL_CODES_CSV, index_dir=INDEX_DIR):
+    index = load_index(path, index_dir)
+    return (CoordinateView(index, 0), CoordinateView(index, 1))
+
+
+# Return [(postalCode, lat, long)] for the postal codes that could be
+# located, in the order of postalCodeList
+# The client is only created if a postal code is not in the CSV
+def locate_postal_codes(postalCodeList, lat_lookup, long_lookup, client=None,
+                        cache=None, rps=DEFAULT_RPS, threads=DEFAULT_THREADS):
+    # Lookup Lat/Long of all postal codes in the CSV in one go
+    (inCsv, csvLats, csvLngs) = locate_in_lookup(postalCodeList, lat_lookup,
+                                                 long_lookup)
+
+    # Collect the postal codes which are not in the CSV
+    unresolved = [remap_postal_code(pc) 
+                  for (pc, found) in zip(postalCodeList, inCsv) if not found]
+
+    # Try looking up Lat/Long from Google Maps Geo-Coding API, using the 
+    # FSA (first 3 char of postal code) if the full code is not found
+    geocoded = {}
+    if (len(unresolved) > 0):
+        if (client is None):
+            client = get_client()
+        resolver = GeocodeResolver(client, rps, threads, cache=cache)
+        geocoded = resolver.resolve(unresolved)
+        print('Google Maps lookups:', resolver.api_calls)
+
+    locationList = []
+    
+    # Loop through all postal codes
+    for (n, pc) in enumerate(postalCodeList):
+        postalCode = remap_postal_code(pc)
+        
+        # Lookup Lat/Long based on values from the CSV
+        if (inCsv[n]): 
+            (gotResult, lat, long) = (1, float(csvLats[n]), 
+                                      float(csvLngs[n]))
+        else:
+            (gotResult, lat, long) = geocoded[postalCode]
+                        
+        if (gotResult == 1): 
+            locationList.append((pc, lat, long))
+        else:
+            print("***ERROR***: Did not find lat/long for ", postalCode)
+
+    return locationList
@@ -0,0 +1,166 @@
+#!/usr/bin/python3
+# CRA OCAD Project
+#
+# LookupJournal.py
+# Created for group project:
+# Andrew Campbell, Xiang Gao, Gurleen Kaur and Apurv Shah
+# Algonquin College
+# This file holds the append-only journal of driving distance lookups.
+# Instead of writing the whole region file back after its lookups,
+# 4_DDCalcs appends one line per completed lookup to
+# 4_Journals/<filename> and syncs it to disk, so an interrupted run loses at
+# most the lookup in progress, and the cost of a lookup does not depend on
+# the size of the region.
+#
+# Stages reading 4_CostLists use read_with_journal, which applies the
+# journal on top of the base file. compact_journal folds the journal into
+# the base file and empties it.
+
+import os
+import datetime
+import pandas as pd
+from ColumnStore import read_region, region_format, region_path, write_parquet
+
+JOURNAL_DIR = '4_Journals'
+
+JOURNAL_LABELS = ['Row', 'Origin', 'Destination', 'DrivingDist',
+                  'Update', 'Mult', 'Timestamp']
+
+# Columns of the region file the journal entries are applied to
+JOURNAL_COLUMNS = ['Origin', 'Destination', 'DrivingDist', 'Update', 'Mult']
+
+
+def journal_path(filename):
+    return os.path.join(JOURNAL_DIR, filename)
+
+
+# Cut a record left incomplete by a crash off the end of the journal, so
+# the next record does not get appended to it. Only the torn record is
+# lost, its lookup was not synced and is done again.
+def drop_torn_record(path, block_size=4096):
+    with open(path, 'rb+') as f:
+        end = f.seek(0, os.SEEK_END)
+        pos = end
+        while (pos > 0):
+            start = max(0, pos - block_size)
+            f.seek(start)
+            block = f.read(pos - start)
+            newline = block.rfind(b'\n')
+            if (newline >= 0):
+                pos = start + newline + 1
+                break
+            pos = start
+        if (pos < end):
+            f.truncate(pos)
+            f.flush()
+            os.fsync(f.fileno())
+        return end - pos
+
+
+class LookupJournal:
+
+    def __init__(self, filename):
+        os.makedirs(JOURNAL_DIR, exist_ok=True)
+        path = journal_path(filename)
+        if (os.path.exists(path)):
+            drop_torn_record(path)
+        newFile = not os.path.exists(path) or os.path.getsize(path) == 0
+        self.f = open(path, 'a', newline='')
+        if (newFile):
+            self._write(','.join(JOURNAL_LABELS))
+
+    def _write(self, line):
+        self.f.write(line + '\n')
+        self.f.flush()
+        os.fsync(self.f.fileno())
+
+    # Record one completed lookup for the row at position row
+    def append(self, row, origin, dest, drivingDist, update, mult):
+        timestamp = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        self._write(','.join([str(row), origin, dest, str(drivingDist),
+                              str(update), repr(float(mult)), timestamp]))
+
+    def close(self):
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def read_journal(filename):
+    path = journal_path(filename)
+    if (not os.path.exists(path) or os.path.getsize(path) == 0):
+        return None
+
+    # A crash while writing can leave the last line incomplete
+    journal_df = pd.read_csv(path, header=0, on_bad_lines='skip',
+                             float_precision='round_trip')
+    journal_df = journal_df.dropna(subset=['Timestamp'])
+    if (len(journal_df) == 0):
+        return None
+    return journal_df
+
+
+# Apply the journal entries to the rows of df. Entries are matched on the
+# row position, and only used if the row still has the same pair.
+def apply_journal(df, journal_df):
+    rows = journal_df['Row'].astype(int).values
+    valid = rows < len(df)
+    rows = rows[valid]
+    journal_df = journal_df[valid]
+
+    same = ((df['Origin'].values[rows] == journal_df['Origin'].values) &
+            (df['Destination'].values[rows] == journal_df['Destination'].values))
+    if (not same.all()):
+        print('NOTE: Ignoring', (~same).sum(), 'journal entries for other pairs')
+    rows = rows[same]
+    journal_df = journal_df[same]
+
+    if (df['Mult'].dtype != float):
+        df['Mult'] = df['Mult'].astype(float)
+    index = df.index[rows]
+    df.loc[index, 'DrivingDist'] = journal_df['DrivingDist'].astype(int).values
+    df.loc[index, 'Update'] = journal_df['Update'].astype(int).values
+    df.loc[index, 'Mult'] = journal_df['Mult'].astype(float).values
+    return df
+
+
+# Read a region file from 4_CostLists with its journal applied. columns
+# and max_losd limit what is read (see ColumnStore.read_region), the
+# columns of the journal are always read.
+def read_with_journal(directory, filename, columns=None, max_losd=None):
+    if (columns is not None):
+        columns = list(dict.fromkeys(list(columns) + JOURNAL_COLUMNS))
+    df = read_region(directory, filename, columns, max_losd)
+    journal_df = read_journal(filename)
+    if (journal_df is not None):
+        df = apply_journal(df, journal_df)
+    return df
+
+
+# Fold the journal into the base file and remove it. The base file is
+# replaced in one step so a crash leaves either the old or the new file.
+def compact_journal(directory, filename):
+    journal_df = read_journal(filename)
+    if (journal_df is None):
+        return 0
+
+    df = read_with_journal(directory, filename)
+    if (region_format(directory, filename) == 'parquet'):
+        write_parquet(df, region_path(directory, filename))
+    else:
+        tmpPath = journal_path(filename) + '.tmp'
+        df.set_index('Origin', inplace=True)
+        df.to_csv(tmpPath)
+        os.replace(tmpPath, directory + '/' + filename)
+    os.remove(journal_path(filename))
+    return len(journal_df)
+
+
+def remove_journal(filename):
+    path = journal_path(filename)
+    if (os.path.exists(path)):
+        os.remove(path)
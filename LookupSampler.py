@@ -0,0 +1,130 @@
+#!/usr/bin/python3
+# CRA OCAD Project
+#
+# LookupSampler.py
+# Created for group project:
+# Andrew Campbell, Xiang Gao, Gurleen Kaur and Apurv Shah
+# Algonquin College
+# This file picks which pairs 4_DDCalcs looks up, and decides when the
+# region multiplier is known well enough to stop.
+#
+# StratifiedSampler - draws pairs without replacement, spread over LOSD
+#                     bands in proportion to the number of pairs in each
+#                     band, so the sample covers short and long trips alike.
+#                     The pairs are drawn one by one, not by origin, so the
+#                     confidence interval stays that of independent pairs
+#                     (see DistanceMatrixBatch.py for the request cost).
+# MultiplierEstimate - running stratified mean of the multiplier
+#                      (DrivingDist / LOSD) with its confidence interval.
+#                      Once the interval is narrower than the target width,
+#                      more lookups will not change the multiplier much and
+#                      the rest of the daily lookups can go to other regions.
+
+import math
+import numpy as np
+
+# LOSD bands (km) used for stratification, up to the 300 km cut-off
+LOSD_BANDS = [0, 25, 50, 100, 200, 300]
+
+# z value for a 95% confidence interval
+Z_95 = 1.96
+
+# Smallest number of lookups before the interval is trusted
+MIN_LOOKUPS = 30
+
+
+def losd_band(losd, bands=LOSD_BANDS):
+    band = np.searchsorted(bands, np.asarray(losd), side='right') - 1
+    return np.clip(band, 0, len(bands) - 2)
+
+
+class StratifiedSampler:
+
+    # losd is the LOSD of every pair under the cut-off and candidate is
+    # True for the pairs that can still be looked up
+    def __init__(self, losd, candidate, bands=LOSD_BANDS, seed=None):
+        rng = np.random.default_rng(seed)
+        self.band = losd_band(losd, bands)
+        self.nBands = len(bands) - 1
+
+        # Shuffle the candidates of each band once, then take them in order
+        candidate = np.asarray(candidate, dtype=bool)
+        self.queues = []
+        for b in range(self.nBands):
+            rows = np.flatnonzero(candidate & (self.band == b))
+            self.queues.append(list(rng.permutation(rows)))
+
+        # Share of each band in all pairs under the cut-off
+        counts = np.bincount(self.band, minlength=self.nBands)
+        self.weights = counts / max(counts.sum(), 1)
+        self.drawn = np.zeros(self.nBands, dtype=np.int64)
+
+    def remaining(self):
+        return sum(len(queue) for queue in self.queues)
+
+    # Draw up to k pairs, each time from the band furthest behind its share
+    def draw(self, k):
+        rows = []
+        for _ in range(k):
+            total = self.drawn.sum() + 1
+            deficit = self.weights * total - self.drawn
+            for b in range(self.nBands):
+                if (len(self.queues[b]) == 0):
+                    deficit[b] = -np.inf
+            b = int(np.argmax(deficit))
+            if (deficit[b] == -np.inf):
+                break
+            rows.append(int(self.queues[b].pop()))
+            self.drawn[b] += 1
+        return rows
+
+
+class MultiplierEstimate:
+
+    def __init__(self, weights, z=Z_95):
+        self.weights = np.asarray(weights, dtype=np.float64)
+        self.z = z
+        nBands = len(self.weights)
+        self.n = np.zeros(nBands, dtype=np.int64)
+        self.mean = np.zeros(nBands)
+        self.m2 = np.zeros(nBands)
+
+    # Add one multiplier to its band (Welford's running variance)
+    def add(self, band, mult):
+        self.n[band] += 1
+        delta = mult - self.mean[band]
+        self.mean[band] += delta / self.n[band]
+        self.m2[band] += delta * (mult - self.mean[band])
+
+    def count(self):
+        return int(self.n.sum())
+
+    # Stratified mean over the bands that have lookups
+    def value(self):
+        have = self.n > 0
+        if (not have.any()):
+            return float('nan')
+        w = self.weights[have] / self.weights[have].sum()
+        return float((w * self.mean[have]).sum())
+
+    # Width of the confidence interval of value()
+    def ci_width(self):
+        have = self.n > 0
+        if (self.count() < 2 or not have.any()):
+            return float('inf')
+        w = self.weights[have] / self.weights[have].sum()
+        n = self.n[have]
+
+        # A band with a single lookup has no variance yet, use the largest
+        # variance seen in the other bands
+        var = np.where(n > 1, self.m2[have] / np.maximum(n - 1, 1), np.nan)
+        if (np.isnan(var).all()):
+            return float('inf')
+        var = np.where(np.isnan(var), np.nanmax(var), var)
+
+        return 2 * self.z * math.sqrt(float((w**2 * var / n).sum()))
+
+    def converged(self, target_width, min_lookups=MIN_LOOKUPS):
+        if (target_width is None or target_width <= 0):
+            return False
+        return self.count() >= min_lookups and self.ci_width() < target_width
@@ -0,0 +1,499 @@
+#!/usr/bin/python3
+# CRA OCAD Project
+#
+# LookupScheduler.py
+# Created for group project:
+# Andrew Campbell, Xiang Gao, Gurleen Kaur and Apurv Shah
+# Algonquin College
+# This file runs the driving distance lookups of all regions from one
+# persistent queue with a daily quota, instead of a fixed number of lookups
+# per region in 4_DDCalcs and a manual re-run every day.
+#
+# The queue (lookup_queue.sqlite) holds every pair under 300 km of
+# 4_CostLists without a driving distance, and the quota used per day. The
+# next pairs are picked by priority:
+#   region   - the region whose multiplier is known least well (widest
+#              confidence interval for its weight, see LookupSampler.py);
+#              regions whose multiplier has converged get no more lookups
+#   LOSD band - within the region, the band furthest behind its share of
+#              the LOSD (the cost the multiplier is applied to)
+#   pair     - within the band, a random order fixed when the pair was
+#              queued, so the sample of the band stays unbiased
+#
+# The run stops when the quota of the day is used (or Google answers with
+# OVER_QUERY_LIMIT), and the next run carries on from there. With --wait it
+# sleeps until the next day instead.
+#
+# Every lookup is appended to the journal of its region (LookupJournal.py)
+# before the queue marks it done, and the quota is reserved before a
+# request is sent. After a crash the queue is reconciled with the journals,
+# so no lookup is lost or paid twice, and the quota is never under-counted.
+# Pairs for which Google finds no road (ZERO_RESULTS, NOT_FOUND) have no
+# journal entry, their status is committed to the queue as soon as it comes
+# instead, so they are not paid again after a crash either.
+#
+# The queue of a region is rebuilt when its 4_CostLists file changes (eg.
+# stage 3 was run again, or the journal was compacted).
+
+import os
+import json
+import time
+import zlib
+import sqlite3
+import argparse
+import datetime
+import numpy as np
+from DistanceMatrixBatch import plan_requests, run_requests, QUOTA_STATUSES
+from DrivingDistCache import DrivingDistCache, DEFAULT_DD_CACHE
+from LookupSampler import MultiplierEstimate, losd_band, LOSD_BANDS
+from LookupJournal import LookupJournal, read_with_journal, read_journal
+from MapsClient import get_client
+from Metrics import metrics
+from ColumnStore import region_files, region_path
+
+DEFAULT_QUEUE = 'lookup_queue.sqlite'
+
+# Google Distance Matrix elements per day
+DEFAULT_QUOTA = 2500
+
+# Pairs taken from the queue at a time
+DEFAULT_BATCH_SIZE = 25
+
+DEFAULT_CI_WIDTH = 0.02
+
+# Pairs at or over this LOSD (km) use the LOSD, and are not looked up
+CUT_OFF = 300
+
+PENDING = 'pending'
+DONE    = 'done'
+SKIPPED = 'skipped'
+
+
+def today():
+    return datetime.date.today().isoformat()
+
+
+def file_stamp(path):
+    stat = os.stat(path)
+    return json.dumps([stat.st_size, stat.st_mtime_ns])
+
+
+class LookupQueue:
+
+    def __init__(self, path=DEFAULT_QUEUE):
+        self.path = path
+        self.conn = sqlite3.connect(path, timeout=60)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS pairs ('
+                          ' region  TEXT NOT NULL,'
+                          ' idx     INTEGER NOT NULL,'
+                          ' origin  TEXT NOT NULL,'
+                          ' dest    TEXT NOT NULL,'
+                          ' ori     TEXT NOT NULL,'
+                          ' dst     TEXT NOT NULL,'
+                          ' losd    INTEGER NOT NULL,'
+                          ' band    INTEGER NOT NULL,'
+                          ' rank    INTEGER NOT NULL,'
+                          ' state   TEXT NOT NULL,'
+                          ' status  TEXT,'
+                          ' updated TEXT,'
+                          ' PRIMARY KEY (region, idx))')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS next_pairs ON pairs '
+                          '(region, state, band, rank)')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS regions ('
+                          ' region TEXT PRIMARY KEY,'
+                          ' stamp  TEXT NOT NULL)')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS quota ('
+                          ' day    TEXT PRIMARY KEY,'
+                          ' used   INTEGER NOT NULL)')
+        self.conn.commit()
+
+    def region_stamp(self, region):
+        row = self.conn.execute('SELECT stamp FROM regions WHERE region = ?',
+                                (region,)).fetchone()
+        return None if row is None else row[0]
+
+    # Queue the pairs of df under the cut-off that have no driving distance
+    def sync_region(self, region, df, stamp, seed=None):
+        losd = df['LOSD'].values
+        candidate = np.flatnonzero((losd < CUT_OFF) &
+                                   (df['Update'].values == 0))
+
+        # Same order for the same seed, different for every region
+        rng = np.random.default_rng(None if seed is None else
+                                    [seed, zlib.crc32(region.encode())])
+        rank = rng.permutation(len(candidate))
+
+        coords = lambda lat, lng: (df[lat].astype(str) + ', ' +
+                                   df[lng].astype(str)).values
+        ori = coords('OriLat', 'OriLng')
+        dst = coords('DstLat', 'DstLng')
+        origins = df['Origin'].values
+        dests = df['Destination'].values
+        bands = losd_band(losd)
+
+        with self.conn:
+            self.conn.execute('DELETE FROM pairs WHERE region = ?', (region,))
+            self.conn.executemany(
+                'INSERT INTO pairs (region, idx, origin, dest, ori, dst, '
+                'losd, band, rank, state) VALUES (?,?,?,?,?,?,?,?,?,?)',
+                ((region, int(idx), str(origins[idx]), str(dests[idx]),
+                  ori[idx], dst[idx], int(losd[idx]), int(bands[idx]),
+                  int(rank[n]), PENDING)
+                 for (n, idx) in enumerate(candidate)))
+            self.conn.execute('INSERT OR REPLACE INTO regions (region, stamp) '
+                              'VALUES (?, ?)', (region, stamp))
+        return len(candidate)
+
+    # Mark the pairs already in the journal of the region as done, eg.
+    # after a crash between the journal and the queue. The other terminal
+    # statuses are committed when they are marked (see run_queue).
+    def reconcile(self, region, journal_df):
+        if (journal_df is None):
+            return 0
+        with self.conn:
+            cursor = self.conn.executemany(
+                'UPDATE pairs SET state = ?, status = ? WHERE region = ? AND '
+                'idx = ? AND origin = ? AND dest = ? AND state = ?',
+                ((DONE, 'OK', region, int(row), str(origin), str(dest),
+                  PENDING)
+                 for (row, origin, dest) in zip(journal_df['Row'],
+                                                journal_df['Origin'],
+                                                journal_df['Destination'])))
+        return cursor.rowcount
+
+    def used(self, day):
+        row = self.conn.execute('SELECT used FROM quota WHERE day = ?',
+                                (day,)).fetchone()
+        return 0 if row is None else row[0]
+
+    # Count units against the quota of the day before they are spent
+    def reserve(self, day, units):
+        with self.conn:
+            self.conn.execute('INSERT OR IGNORE INTO quota (day, used) '
+                              'VALUES (?, 0)', (day,))
+            self.conn.execute('UPDATE quota SET used = used + ? WHERE day = ?',
+                              (units, day))
+
+    def use_up(self, day, quota):
+        with self.conn:
+            self.conn.execute('INSERT OR REPLACE INTO quota (day, used) '
+                              'VALUES (?, ?)', (day, max(quota, self.used(day))))
+
+    # {region: {band: (pending, done, losd of all pairs)}}
+    def band_counts(self):
+        counts = {}
+        for (region, band, pending, done, losd) in self.conn.execute(
+                'SELECT region, band, SUM(state = ?), SUM(state = ?), '
+                'SUM(losd) FROM pairs GROUP BY region, band',
+                (PENDING, DONE)):
+            counts.setdefault(region, {})[band] = (pending, done, losd)
+        return counts
+
+    # Next k pending pairs of the band, as (idx, origin, dest, ori, dst, losd)
+    def next_pairs(self, region, band, k):
+        return self.conn.execute(
+            'SELECT idx, origin, dest, ori, dst, losd FROM pairs '
+            'WHERE region = ? AND state = ? AND band = ? ORDER BY rank '
+            'LIMIT ?', (region, PENDING, band, k)).fetchall()
+
+    def mark(self, region, row, state, status):
+        self.conn.execute('UPDATE pairs SET state = ?, status = ?, '
+                          'updated = ? WHERE region = ? AND idx = ?',
+                          (state, status,
+                           datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+                           region, row))
+
+    def commit(self):
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+
+# State of one region for the scheduler: its lookups so far, the journal
+# for new ones and the running multiplier
+class RegionLookups:
+
+    def __init__(self, directory, filename):
+        self.filename = filename
+        self.df = read_with_journal(directory, filename, max_losd=CUT_OFF)
+        self.updateIncr = int(self.df['Update'].max()) + 1
+        self.journal = None
+
+        # Running multiplier, starting from the lookups of earlier runs
+        losd = self.df['LOSD'].values
+        under = losd < CUT_OFF
+        bands = losd_band(losd[under])
+        counts = np.bincount(bands, minlength=len(LOSD_BANDS) - 1)
+        self.estimate = MultiplierEstimate(counts / max(counts.sum(), 1))
+        update = self.df['Update'].values[under]
+        mult = self.df['Mult'].values[under]
+        for idx in np.flatnonzero(update != 0):
+            self.estimate.add(bands[idx], mult[idx])
+
+    def record(self, row, origin, dest, losd, metres):
+        dist_km = round(metres/1000)
+
+        # Same as LOSD, 0 is converted to 1 as there maybe some driving required
+        drivingDist = 1 if dist_km == 0 else dist_km
+        mult = drivingDist / losd
+        if (self.journal is None):
+            self.journal = LookupJournal(self.filename)
+        self.journal.append(row, origin, dest, drivingDist, self.updateIncr,
+                            mult)
+        self.estimate.add(int(losd_band(losd)), mult)
+
+    def close(self):
+        if (self.journal is not None):
+            self.journal.close()
+
+
+# Pick the region that needs lookups the most, and its band furthest behind
+# its share of the LOSD. Returns (None, None) when nothing is left.
+def pick_next(regions, counts, ci_width, region_weights):
+    best = None
+    for (region, bands) in counts.items():
+        if (region not in regions):
+            continue
+        if (sum(pending for (pending, done, losd) in bands.values()) == 0):
+            continue
+        estimate = regions[region].estimate
+        if (estimate.converged(ci_width)):
+            continue
+        weight = region_weights.get(region, 1.0)
+        if (ci_width is not None and ci_width > 0):
+            need = weight * min(estimate.ci_width() / ci_width, 1e9)
+        else:
+            need = weight
+        score = (need, -estimate.count(), region)
+        if (best is None or score > best[0]):
+            best = (score, region)
+    if (best is None):
+        return (None, None)
+
+    region = best[1]
+    bands = counts[region]
+    totalLosd = sum(losd for (pending, done, losd) in bands.values())
+    totalDone = sum(done for (pending, done, losd) in bands.values())
+    deficit = {band: losd / max(totalLosd, 1) * (totalDone + 1) - done
+               for (band, (pending, done, losd)) in bands.items()
+               if pending > 0}
+    return (region, max(deficit, key=deficit.get))
+
+
+def seconds_to_tomorrow():
+    now = datetime.datetime.now()
+    tomorrow = datetime.datetime.combine(now.date() + datetime.timedelta(1),
+                                         datetime.time(0, 1))
+    return (tomorrow - now).total_seconds()
+
+
+def load_regions(directory, queue, seed=None):
+    regions = {}
+    for filename in sorted(region_files(directory)):
+        stamp = file_stamp(region_path(directory, filename))
+        regions[filename] = RegionLookups(directory, filename)
+        if (queue.region_stamp(filename) != stamp):
+            queued = queue.sync_region(filename, regions[filename].df, stamp,
+                                       seed)
+            print(filename, 'pairs queued:', queued)
+        fixed = queue.reconcile(filename, read_journal(filename))
+        if (fixed > 0):
+            print(filename, 'lookups recovered from the journal:', fixed)
+    return regions
+
+
+def print_status(regions, queue, quota):
+    counts = queue.band_counts()
+    print("Region   Pending  Done  Mult  CI width")
+    for (region, state) in regions.items():
+        bands = counts.get(region, {})
+        print(region, sum(b[0] for b in bands.values()),
+              sum(b[1] for b in bands.values()),
+              round(state.estimate.value(), 3),
+              round(state.estimate.ci_width(), 4))
+    print('Quota used today:', queue.used(today()), 'of', quota)
+
+
+def run_queue(directory='4_CostLists', queue_path=DEFAULT_QUEUE,
+              quota=DEFAULT_QUOTA, ci_width=DEFAULT_CI_WIDTH,
+              region_weights=None, dd_cache_path=None,
+              batch_size=DEFAULT_BATCH_SIZE, seed=None, wait=False,
+              client=None):
+    queue = LookupQueue(queue_path)
+    regions = load_regions(directory, queue, seed)
+    dd_cache = None
+    if (dd_cache_path is not None):
+        dd_cache = DrivingDistCache(dd_cache_path)
+
+    byLocation = {}
+    lookups = 0
+
+    # Journal the result of a pair and mark it in the queue, returns 1 if
+    # a driving distance was found. A pair without a road is only recorded
+    # in the queue, so that mark is committed right away.
+    def finish(region, state, info, row, status, metres):
+        (origin, dest, ori, dst, losd) = info
+        byLocation[(ori, dst)] = (status, metres)
+        if (status == 'OK'):
+            state.record(row, origin, dest, losd, metres)
+            queue.mark(region, row, DONE, status)
+            return 1
+        print("NOTE: Skipping Row:", row, " Ori:", origin,
+              " Dest:", dest, " Status:", status)
+        queue.mark(region, row, SKIPPED, status)
+        queue.commit()
+        return 0
+
+    try:
+        while True:
+            day = today()
+            left = quota - queue.used(day)
+            if (left <= 0):
+                print('Daily quota of', quota, 'used. Time: ' +
+                      datetime.datetime.now().strftime('%H:%M:%S'))
+                if (not wait):
+                    break
+                time.sleep(seconds_to_tomorrow())
+                continue
+
+            (region, band) = pick_next(regions, queue.band_counts(),
+                                       ci_width, region_weights or {})
+            if (region is None):
+                print('No pairs left to look up')
+                break
+            state = regions[region]
+
+            # Driving distances already known (cache, or another pair at the
+            # same locations) do not count against the quota
+            batch = queue.next_pairs(region, band, min(batch_size, left))
+            pairInfo = {row: (origin, dest, ori, dst, losd) for
+                        (row, origin, dest, ori, dst, losd) in batch}
+            results = []
+            apiPairs = []
+            for (row, origin, dest, ori, dst, losd) in batch:
+                cached = None
+                if (dd_cache is not None):
+                    cached = dd_cache.get(origin, dest)
+                if (cached is None):
+                    cached = byLocation.get((ori, dst))
+                if (cached is None):
+                    apiPairs.append((row, ori, dst))
+                else:
+                    results.append((row, cached[0], cached[1]))
+
+            # Known distances are not put in the cache again, so their
+            # source and fetch date stay as they are
+            for (row, status, metres) in results:
+                lookups += finish(region, state, pairInfo[row], row, status,
+                                  metres)
+
+            # Every answer is journaled and cached as it comes, so the
+            # answers paid for are kept if a later request fails
+            if (len(apiPairs) > 0):
+                requests = plan_requests(apiPairs)
+                queue.reserve(day, sum(request.elements()
+                                       for request in requests))
+                if (client is None):
+                    client = get_client()
+                source = getattr(client, 'source', 'google')
+                try:
+                    for (row, status, metres) in run_requests(client, requests):
+                        (origin, dest, ori, dst, losd) = pairInfo[row]
+                        if (dd_cache is not None):
+                            dd_cache.put(origin, dest, status, metres, ori,
+                                         dst, source)
+                        lookups += finish(region, state, pairInfo[row], row,
+                                          status, metres)
+                        results.append((row, status, metres))
+                except Exception as e:
+                    if (getattr(e, 'status', None) not in QUOTA_STATUSES):
+                        raise
+                    print('Google Maps quota reached:', e.status)
+                    queue.use_up(day, quota)
+                finally:
+                    queue.commit()
+
+            queue.commit()
+            metrics.add_rows(len(results))
+            metrics.progress(queue.used(day), quota, 'elements')
+
+            print(region, "Lookups:" + str(lookups) +
+                  " Mult:" + str(round(state.estimate.value(), 3)) +
+                  " CI width:" + str(round(state.estimate.ci_width(), 4)) +
+                  " Quota used:" + str(queue.used(day)) + ". Time: " +
+                  datetime.datetime.now().strftime('%H:%M:%S'))
+    finally:
+        for state in regions.values():
+            state.close()
+        if (dd_cache is not None):
+            dd_cache.close()
+
+    print_status(regions, queue, quota)
+    queue.close()
+    return lookups
+
+
+def parse_weights(text):
+    weights = {}
+    for item in text.split(','):
+        if (item != ''):
+            (region, weight) = item.split('=')
+            weights[region] = float(weight)
+    return weights
+
+
+def main_program(argv=None):
+    parser = argparse.ArgumentParser(description='Look up driving distances '
+                                     'for all regions within a daily quota')
+    parser.add_argument('--queue', default=DEFAULT_QUEUE,
+                        help='lookup queue file')
+    parser.add_argument('--quota', type=int, default=DEFAULT_QUOTA,
+                        help='Distance Matrix elements per day')
+    parser.add_argument('--ci-width', type=float, default=DEFAULT_CI_WIDTH,
+                        help='no more lookups for a region once the '
+                             'confidence interval of its multiplier is '
+                             'narrower than this (0: never)')
+    parser.add_argument('--region-weights', type=parse_weights, default={},
+                        help='priority of regions, eg. Ontario.csv=2,'
+                             'Quebec.csv=0.5 (default: 1)')
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE,
+                        help='pairs taken from the queue at a time')
+    parser.add_argument('--dd-cache', default=DEFAULT_DD_CACHE,
+                        help='driving distance cache shared across runs')
+    parser.add_argument('--no-dd-cache', action='store_true',
+                        help='always use the Google Maps API')
+    parser.add_argument('--seed', type=int, default=None,
+                        help='seed for the order of the pairs of a band')
+    parser.add_argument('--wait', action='store_true',
+                        help='when the quota is used, wait for the next day '
+                             'instead of stopping')
+    parser.add_argument('--status', action='store_true',
+                        help='only show the state of the queue')
+    parser.add_argument('--metrics', default=None, metavar='FILE',
+                        help='write the time, rows, API calls and peak '
+                             'memory to FILE as JSON')
+    parser.add_argument('--progress', action='store_true',
+                        help='show a live progress line on stderr')
+    args = parser.parse_args(argv)
+    metrics.start(args.metrics, args.progress)
+    dd_cache_path = None if args.no_dd_cache else args.dd_cache
+
+    directory = '4_CostLists'
+
+    if (args.status):
+        queue = LookupQueue(args.queue)
+        print_status(load_regions(directory, queue, args.seed), queue,
+                     args.quota)
+        queue.close()
+        return
+
+    with metrics.region('LookupScheduler', directory):
+        run_queue(directory, args.queue, args.quota, args.ci_width,
+                  args.region_weights, dd_cache_path, args.batch_size,
+                  args.seed, args.wait)
+
+    metrics.save()
+
+if __name__ == '__main__':
+    main_program()
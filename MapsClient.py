@@ -0,0 +1,28 @@
+#!/usr/bin/python3
+# CRA OCAD Project
+#
+# MapsClient.py
+# Created for group project:
+# Andrew Campbell, Xiang Gao, Gurleen Kaur and Apurv Shah
+# Algonquin College
+# This file holds the Google Maps API key used by the stages. The client is
+# created the first time it is needed, so the stages can be imported (eg.
+# by Pipeline.py) and run on cached data without a key.
+#
+# With --metrics the client returned is wrapped so that every API call is
+# recorded (see Metrics.py).
+
+import googlemaps
+from Metrics import metrics
+
+# Google Maps API Key
+key = "Enter key here"
+
+gmaps = None
+
+
+def get_client():
+    global gmaps
+    if (gmaps is None):
+        gmaps = googlemaps.Client(key)
+    return metrics.instrument(gmaps)
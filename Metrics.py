@@ -0,0 +1,285 @@
+#!/usr/bin/python3
+# CRA OCAD Project
+#
+# Metrics.py
+# Created for group project:
+# Andrew Campbell, Xiang Gao, Gurleen Kaur and Apurv Shah
+# Algonquin College
+# This file records what a run did, for every region of every stage: the
+# wall time, the rows processed and the peak memory. It also records the
+# Google Maps API calls: their count, a latency histogram, the statuses
+# returned and the quota used (one unit per geocode request, one per
+# Distance Matrix element).
+#
+# Nothing is recorded unless a stage is run with --metrics FILE, so the
+# hooks in the stages only cost a check of metrics.enabled. The metrics
+# are then written to FILE as JSON when the stage is done. --progress
+# also prints a live progress line on stderr.
+#
+# With workers every process records its own regions, which are sent back
+# with the result of the region and merged (see ParallelRunner.py).
+
+import os
+import sys
+import json
+import time
+import datetime
+import platform
+import threading
+import contextlib
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# Upper bound (s) of each bucket of the API latency histogram, the last
+# bucket counts the calls slower than all of them
+LATENCY_BUCKETS = [0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10]
+
+# Seconds between two updates of the progress line
+PROGRESS_INTERVAL = 1.0
+
+
+# Peak resident memory of this process in MB (ru_maxrss is in kB on
+# Linux, in bytes on macOS)
+def peak_rss_mb():
+    if (resource is None):
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if (sys.platform == 'darwin'):
+        return round(peak / (1024 * 1024), 1)
+    return round(peak / 1024, 1)
+
+
+def new_api_entry():
+    return {'calls': 0, 'seconds': 0.0,
+            'latency_histogram': [0] * (len(LATENCY_BUCKETS) + 1),
+            'statuses': {}, 'element_statuses': {}, 'quota_units': 0}
+
+
+def add_counts(counts, more):
+    for (name, value) in more.items():
+        counts[name] = counts.get(name, 0) + value
+
+
+class Metrics:
+
+    def __init__(self):
+        self.enabled = False
+        self.show_progress = False
+        self.path = None
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.regions = []
+        self.api = {}
+        self.started = time.perf_counter()
+        self._open = []
+        self._clients = {}
+        self._lastProgress = 0.0
+
+    # collect turns the recording on without a file, eg. in a worker
+    def start(self, path=None, show_progress=False, collect=False):
+        self.enabled = collect or path is not None or show_progress
+        self.show_progress = show_progress
+        self.path = path
+        self.reset()
+
+    # Time a region of a stage, the rows and the progress reported while
+    # it runs are counted against it
+    @contextlib.contextmanager
+    def region(self, stage, filename):
+        if (not self.enabled):
+            yield None
+            return
+
+        entry = {'stage': stage, 'filename': filename, 'rows': 0}
+        start = time.perf_counter()
+        self._open.append((entry, start))
+        try:
+            yield entry
+        finally:
+            entry['seconds'] = round(time.perf_counter() - start, 4)
+            entry['rows_per_second'] = (round(entry['rows'] / entry['seconds'])
+                                        if entry['seconds'] > 0 else None)
+            entry['peak_rss_mb'] = peak_rss_mb()
+            self._open.pop()
+            self.regions.append(entry)
+            if (self._lastProgress > 0):
+                sys.stderr.write('\n')
+                self._lastProgress = 0.0
+
+    def add_rows(self, rows):
+        if (self.enabled and len(self._open) > 0):
+            self._open[-1][0]['rows'] += int(rows)
+
+    # Update the progress line with done out of total (total may be None)
+    def progress(self, done, total=None, unit='rows'):
+        if (not self.show_progress or len(self._open) == 0):
+            return
+        now = time.perf_counter()
+        if (now - self._lastProgress < PROGRESS_INTERVAL):
+            return
+        self._lastProgress = now
+
+        (entry, start) = self._open[-1]
+        elapsed = now - start
+        line = entry['stage'] + ' ' + entry['filename'] + ': ' + str(done)
+        if (total is not None and total > 0):
+            line += '/' + str(total) + ' (' + str(round(100 * done / total)) + '%)'
+        line += ' ' + unit
+        if (elapsed > 0):
+            line += ', ' + str(round(done / elapsed)) + ' ' + unit + '/s'
+        sys.stderr.write('\r' + line + '   ')
+        sys.stderr.flush()
+
+    def record_call(self, method, seconds, status, units=0,
+                    element_statuses=None):
+        bucket = len(LATENCY_BUCKETS)
+        for (n, bound) in enumerate(LATENCY_BUCKETS):
+            if (seconds <= bound):
+                bucket = n
+                break
+        with self.lock:
+            entry = self.api.setdefault(method, new_api_entry())
+            entry['calls'] += 1
+            entry['seconds'] += seconds
+            entry['latency_histogram'][bucket] += 1
+            add_counts(entry['statuses'], {status: 1})
+            if (element_statuses is not None):
+                add_counts(entry['element_statuses'], element_statuses)
+            entry['quota_units'] += units
+
+    # Wrap a Google Maps client so that its calls are recorded, the client
+    # is returned as is when the metrics are off
+    def instrument(self, client):
+        if (not self.enabled or client is None):
+            return client
+        with self.lock:
+            if (id(client) not in self._clients):
+                self._clients[id(client)] = InstrumentedClient(client, self)
+            return self._clients[id(client)]
+
+    # The regions and API calls recorded in this process, to be merged in
+    # the main process
+    def snapshot(self):
+        with self.lock:
+            return {'regions': list(self.regions),
+                    'api': json.loads(json.dumps(self.api))}
+
+    def merge(self, snapshot):
+        with self.lock:
+            self.regions.extend(snapshot['regions'])
+            for (method, more) in snapshot['api'].items():
+                entry = self.api.setdefault(method, new_api_entry())
+                entry['calls'] += more['calls']
+                entry['seconds'] += more['seconds']
+                entry['latency_histogram'] = [
+                    a + b for (a, b) in zip(entry['latency_histogram'],
+                                            more['latency_histogram'])]
+                add_counts(entry['statuses'], more['statuses'])
+                add_counts(entry['element_statuses'],
+                           more['element_statuses'])
+                entry['quota_units'] += more['quota_units']
+
+    # Totals per stage over its regions
+    def stage_totals(self):
+        stages = {}
+        for entry in self.regions:
+            total = stages.setdefault(entry['stage'],
+                                      {'regions': 0, 'seconds': 0.0,
+                                       'rows': 0, 'peak_rss_mb': None})
+            total['regions'] += 1
+            total['seconds'] = round(total['seconds'] + entry['seconds'], 4)
+            total['rows'] += entry['rows']
+            if (entry['peak_rss_mb'] is not None):
+                total['peak_rss_mb'] = max(total['peak_rss_mb'] or 0,
+                                           entry['peak_rss_mb'])
+        for total in stages.values():
+            total['rows_per_second'] = (round(total['rows'] / total['seconds'])
+                                        if total['seconds'] > 0 else None)
+        return stages
+
+    def report(self):
+        api = {}
+        for (method, entry) in self.api.items():
+            api[method] = dict(entry)
+            api[method]['seconds'] = round(entry['seconds'], 4)
+            api[method]['mean_seconds'] = (round(entry['seconds'] /
+                                                 entry['calls'], 4)
+                                           if entry['calls'] > 0 else None)
+        return {'created': datetime.datetime.now().isoformat(
+                    timespec='seconds'),
+                'command': sys.argv,
+                'python': platform.python_version(),
+                'wall_seconds': round(time.perf_counter() - self.started, 4),
+                'peak_rss_mb': peak_rss_mb(),
+                'latency_buckets': LATENCY_BUCKETS,
+                'stages': self.stage_totals(),
+                'regions': self.regions,
+                'api': api}
+
+    # Write the metrics to the file given to start, if any
+    def save(self):
+        if (self.path is None):
+            return
+        directory = os.path.dirname(self.path)
+        if (directory != ''):
+            os.makedirs(directory, exist_ok=True)
+        with open(self.path + '.tmp', 'w') as f:
+            json.dump(self.report(), f, indent=1)
+        os.replace(self.path + '.tmp', self.path)
+        print('Metrics written to', self.path)
+
+
+# The geocode and distance_matrix methods of googlemaps.Client, timed
+class InstrumentedClient:
+
+    def __init__(self, client, metrics):
+        self.client = client
+        self.metrics = metrics
+
+    def _call(self, method, func, args, kwargs, count):
+        start = time.perf_counter()
+        try:
+            result = func(*args, **kwargs)
+        except Exception as e:
+            # googlemaps errors carry the API status (eg. OVER_QUERY_LIMIT)
+            status = getattr(e, 'status', None) or type(e).__name__
+            self.metrics.record_call(method, time.perf_counter() - start,
+                                     str(status))
+            raise
+        (status, units, element_statuses) = count(result)
+        self.metrics.record_call(method, time.perf_counter() - start,
+                                 status, units, element_statuses)
+        return result
+
+    def geocode(self, *args, **kwargs):
+        return self._call('geocode', self.client.geocode, args, kwargs,
+                          geocode_counts)
+
+    def distance_matrix(self, *args, **kwargs):
+        return self._call('distance_matrix', self.client.distance_matrix,
+                          args, kwargs, distance_matrix_counts)
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+
+def geocode_counts(results):
+    return ('OK' if len(results) > 0 else 'ZERO_RESULTS', 1, None)
+
+
+def distance_matrix_counts(distance):
+    elementStatuses = {}
+    for row in distance['rows']:
+        for element in row['elements']:
+            add_counts(elementStatuses, {element['status']: 1})
+    return (distance.get('status', 'OK'), sum(elementStatuses.values()),
+            elementStatuses)
+
+
+# The metrics of this process
+metrics = Metrics()
@@ -0,0 +1,244 @@
+#!/usr/bin/python3
+# CRA OCAD Project
+#
+# NeighborIndex.py
+# Created for group project:
+# Andrew Campbell, Xiang Gao, Gurleen Kaur and Apurv Shah
+# Algonquin College
+# This file holds a grid index over the coordinates of a region, used to
+# list only the pairs that are within the 300 km driving threshold.
+#
+# The grid cells are at least radius km high and wide, so two sites within
+# radius km of each other are always in the same or in neighbouring cells.
+# Pairs from those cells are measured and kept as rows if they are under
+# the threshold. Every other pair is over the threshold, and is only
+# counted in a far pair summary by postal code prefix and LOSD:
+#
+# OriPrefix, DstPrefix, LOSD, Count
+#
+# The cost rules only depend on the first letter of the postal codes and on
+# the distance, so the summary gives the same costs and totals as one row
+# per pair.
+#
+# The summary still needs the whole km of every far pair (for the total
+# distance, and for CostScenarios.py with another cut-off), so the far
+# blocks are measured too. Since both the rows and the summary only keep
+# whole km, the pairs are measured with PAIR_METHODS: for vincenty, the
+# tiered method gives the same whole km for a fraction of the work. Its
+# Lambert terms are taken once per location (GeoDistance.LambertPoints), so
+# a pair costs little more than a few products and one arcsin.
+
+import os
+import math
+import numpy as np
+import pandas as pd
+
+from SiteDedup import unique_locations, dedup_losd
+from GeoDistance import LambertPoints
+from Metrics import metrics
+
+FAR_DIR = '3_FarSummaries'
+
+FAR_LABELS = ['OriPrefix', 'DstPrefix', 'LOSD', 'Count']
+
+# Smallest radius of curvature of the WGS-84 ellipsoid (north-south at the
+# equator) in km, and a margin for the difference between the ellipsoid
+# and the sphere used to size the grid
+MIN_EARTH_RADIUS_KM = 6335.4
+RADIUS_MARGIN = 1.01
+
+# Method used to measure the pairs for a method, same whole km
+PAIR_METHODS = {'vincenty': 'tiered'}
+
+
+class GridIndex:
+
+    def __init__(self, lats, lngs, radius_km):
+        self.lats = np.asarray(lats, dtype=np.float64)
+        self.lngs = np.asarray(lngs, dtype=np.float64)
+        self.radius_km = radius_km
+
+        # Largest angle between two points that are radius km apart
+        angle = radius_km * RADIUS_MARGIN / MIN_EARTH_RADIUS_KM
+        self.cell_lat = math.degrees(angle)
+
+        # Cells get narrower in km towards the pole, so size the longitude
+        # on the highest latitude in the region
+        maxLat = np.max(np.abs(self.lats)) if len(self.lats) > 0 else 0
+        cosLat = math.cos(math.radians(min(maxLat + self.cell_lat, 90)))
+        sinHalf = math.sin(angle / 2) / cosLat if cosLat > 0 else 2
+        if (sinHalf >= 1):
+            self.cell_lng = 360.0
+        else:
+            self.cell_lng = math.degrees(2 * math.asin(sinHalf))
+
+        rows = np.floor(self.lats / self.cell_lat).astype(np.int64)
+        cols = np.floor(self.lngs / self.cell_lng).astype(np.int64)
+
+        # Cell -> sorted array of site indices
+        self.cells = {}
+        order = np.lexsort((np.arange(len(rows)), cols, rows))
+        for idx in order:
+            self.cells.setdefault((rows[idx], cols[idx]), []).append(idx)
+        for cell in self.cells:
+            self.cells[cell] = np.array(self.cells[cell], dtype=np.int64)
+
+    def _is_neighbour(self, a, b):
+        return abs(a[0] - b[0]) <= 1 and abs(a[1] - b[1]) <= 1
+
+    # Yield (P, Q) for every pair of cells (including a cell with itself)
+    # The near blocks are cells that are the same or touching, the far
+    # blocks are all the others.
+    def blocks(self, near=True):
+        cellList = sorted(self.cells)
+        for a in range(len(cellList)):
+            for b in range(a, len(cellList)):
+                if (self._is_neighbour(cellList[a], cellList[b]) == near):
+                    yield (self.cells[cellList[a]], self.cells[cellList[b]])
+
+
+# Yield (i, j) index arrays with i < j for all site pairs of a block,
+# at most about chunk_size pairs at a time
+def iter_block_pairs(P, Q, chunk_size=1000000):
+    if (P is Q):
+        oriIdx, dstIdx = np.triu_indices(len(P), 1)
+        for start in range(0, len(oriIdx), chunk_size):
+            yield (P[oriIdx[start:start+chunk_size]],
+                   P[dstIdx[start:start+chunk_size]])
+        return
+
+    step = max(1, chunk_size // max(len(Q), 1))
+    for start in range(0, len(P), step):
+        part = P[start:start+step]
+        a = np.repeat(part, len(Q))
+        b = np.tile(Q, len(part))
+        yield (np.minimum(a, b), np.maximum(a, b))
+
+
+class FarSummary:
+
+    def __init__(self, prefixes):
+        # Postal code prefix (first letter) of every site, as integer codes
+        self.letters, self.letterIdx = np.unique(prefixes, return_inverse=True)
+        self.nLetters = len(self.letters)
+        self.keys = []
+        self.counts = []
+
+    def add(self, oriIdx, dstIdx, losd):
+        key = ((self.letterIdx[oriIdx] * self.nLetters +
+                self.letterIdx[dstIdx]) * 100000 + losd)
+        keys, counts = np.unique(key, return_counts=True)
+        self.keys.append(keys)
+        self.counts.append(counts)
+
+    def to_frame(self):
+        if (len(self.keys) == 0):
+            return pd.DataFrame(columns=FAR_LABELS)
+
+        keys = np.concatenate(self.keys)
+        counts = np.concatenate(self.counts)
+
+        # Sum the counts by letter pair (row) and LOSD (column), the
+        # letters and distances are few enough to count them all at once
+        letterPair = keys // 100000
+        losd = keys % 100000
+        width = int(losd.max()) + 1
+        counts = np.bincount(letterPair * width + losd, weights=counts,
+                             minlength=self.nLetters**2 * width)
+        (letterPair, losd) = np.nonzero(counts.reshape(-1, width))
+        counts = counts.reshape(-1, width)[letterPair, losd].astype(np.int64)
+
+        return pd.DataFrame({'OriPrefix': self.letters[letterPair // self.nLetters],
+                             'DstPrefix': self.letters[letterPair % self.nLetters],
+                             'LOSD': losd,
+                             'Count': counts},
+                            columns=FAR_LABELS)
+
+
+# LOSD of the site pairs of a block. points holds the Lambert terms of the
+# unique locations when the pairs are measured with the tiered method.
+def block_losd(lats, lngs, oriIdx, dstIdx, method, locations, points):
+    if (points is not None):
+        siteLocation = locations[3]
+        return points.losd_km(siteLocation[oriIdx], siteLocation[dstIdx])
+    (losd, measured) = dedup_losd(lats, lngs, oriIdx, dstIdx, method,
+                                  locations)
+    return losd
+
+
+# Split all pairs of a region into the pairs under radius km (returned as
+# index and LOSD arrays in combination order) and a summary of the others
+def radius_pairs(postalCodes, lats, lngs, radius_km=300,
+                 method='vincenty', chunk_size=1000000):
+    index = GridIndex(lats, lngs, radius_km)
+    locations = unique_locations(lats, lngs)
+    prefixes = np.array([str(pc)[:1] for pc in postalCodes])
+    far = FarSummary(prefixes)
+
+    # Only whole km are kept, see PAIR_METHODS
+    points = None
+    pairMethod = PAIR_METHODS.get(method, method)
+    if (pairMethod == 'tiered'):
+        points = LambertPoints(locations[0], locations[1])
+
+    nearOri = []
+    nearDst = []
+    nearLosd = []
+    done = 0
+    pairCnt = len(postalCodes) * (len(postalCodes) - 1) // 2
+
+    for (P, Q) in index.blocks(near=True):
+        for (oriIdx, dstIdx) in iter_block_pairs(P, Q, chunk_size):
+            losd = block_losd(lats, lngs, oriIdx, dstIdx, pairMethod,
+                              locations, points)
+            isNear = losd < radius_km
+            nearOri.append(oriIdx[isNear])
+            nearDst.append(dstIdx[isNear])
+            nearLosd.append(losd[isNear])
+            if (not isNear.all()):
+                far.add(oriIdx[~isNear], dstIdx[~isNear], losd[~isNear])
+            done += len(losd)
+            metrics.progress(done, pairCnt, 'pairs')
+
+    for (P, Q) in index.blocks(near=False):
+        for (oriIdx, dstIdx) in iter_block_pairs(P, Q, chunk_size):
+            losd = block_losd(lats, lngs, oriIdx, dstIdx, pairMethod,
+                              locations, points)
+            far.add(oriIdx, dstIdx, losd)
+            done += len(losd)
+            metrics.progress(done, pairCnt, 'pairs')
+
+    if (len(nearOri) > 0):
+        oriIdx = np.concatenate(nearOri)
+        dstIdx = np.concatenate(nearDst)
+        losd = np.concatenate(nearLosd)
+    else:
+        oriIdx = dstIdx = losd = np.zeros(0, dtype=np.int64)
+
+    # Same order as sorting itertools.combinations on LOSD
+    order = np.lexsort((dstIdx, oriIdx, losd))
+    return (oriIdx[order], dstIdx[order], losd[order], far.to_frame())
+
+
+def far_summary_path(filename):
+    return os.path.join(FAR_DIR, filename)
+
+
+def write_far_summary(filename, far_df):
+    os.makedirs(FAR_DIR, exist_ok=True)
+    far_df.to_csv(far_summary_path(filename), index=False)
+
+
+# The far pair summary of a region, or None if the region was generated
+# with one row for every pair
+def read_far_summary(filename):
+    path = far_summary_path(filename)
+    if (not os.path.exists(path)):
+        return None
+    return pd.read_csv(path, header=0, keep_default_na=False)
+
+
+def remove_far_summary(filename):
+    path = far_summary_path(filename)
+    if (os.path.exists(path)):
+        os.remove(path)
@@ -0,0 +1,99 @@
+#!/usr/bin/python3
+# CRA OCAD Project
+#
+# PairStream.py
+# Created for group project:
+# Andrew Campbell, Xiang Gao, Gurleen Kaur and Apurv Shah
+# Algonquin College
+# This file holds the helpers for generating origin and destination
+# combinations in fixed size chunks, so that a region never needs the
+# full list of n*(n-1)/2 pairs in memory.
+#
+# iter_pair_chunks  - yields index arrays (i, j) with i < j in the same
+#                     order as itertools.combinations, optionally only
+#                     for the origins first_row to last_row - 1
+# LosdBucketWriter  - an external sort on LOSD. Each chunk is appended to
+#                     one bucket file per LOSD km value, and the buckets are
+#                     then concatenated in LOSD order into the final CSV.
+#                     Rows within a bucket keep the order they were added,
+#                     which gives the same result as a stable sort.
+
+import os
+import shutil
+import tempfile
+import numpy as np
+
+
+def iter_pair_chunks(n, chunk_size=1000000, first_row=0, last_row=None):
+
+    chunk_size = max(int(chunk_size), 1)
+    if (last_row is None):
+        last_row = n
+    oriParts = []
+    dstParts = []
+    pending = 0
+
+    for i in range(first_row, min(last_row, n - 1)):
+        j = i + 1
+        while j < n:
+            # Take as many destinations for this origin as fit in the chunk
+            take = min(n - j, chunk_size - pending)
+            oriParts.append(np.full(take, i, dtype=np.int64))
+            dstParts.append(np.arange(j, j + take, dtype=np.int64))
+            pending += take
+            j += take
+
+            if (pending == chunk_size):
+                yield (np.concatenate(oriParts), np.concatenate(dstParts))
+                oriParts = []
+                dstParts = []
+                pending = 0
+
+    if (pending > 0):
+        yield (np.concatenate(oriParts), np.concatenate(dstParts))
+
+
+def pair_count(n):
+    return n * (n - 1) // 2
+
+
+class LosdBucketWriter:
+
+    def __init__(self, columns, sort_column='LOSD', tmp_dir=None):
+        self.columns = list(columns)
+        self.sort_column = sort_column
+        self.tmp = tempfile.TemporaryDirectory(dir=tmp_dir)
+        self.keys = set()
+
+    def _bucket_path(self, key):
+        return os.path.join(self.tmp.name, str(key) + '.csv')
+
+    # Append a chunk to the bucket files. The bucket key is taken from
+    # key_values (defaults to the sort column) so callers can bucket on the
+    # raw value and still write an adjusted one (eg. LOSD of 0 written as 1)
+    def add(self, df, key_values=None):
+        if (key_values is None):
+            key_values = df[self.sort_column].values
+
+        for key, group in df.groupby(key_values, sort=False):
+            key = int(key)
+            with open(self._bucket_path(key), 'a', newline='') as f:
+                group.to_csv(f, columns=self.columns, header=False, index=False)
+            self.keys.add(key)
+
+    # Write the header and all buckets in sorted order to path
+    def merge(self, path):
+        with open(path, 'w', newline='') as out:
+            out.write(','.join(self.columns) + os.linesep)
+            for key in sorted(self.keys):
+                with open(self._bucket_path(key), 'r', newline='') as f:
+                    shutil.copyfileobj(f, out)
+
+    def close(self):
+        self.tmp.cleanup()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,115 @@
+#!/usr/bin/python3
+# CRA OCAD Project
+#
+# ParallelRunner.py
+# Created for group project:
+# Andrew Campbell, Xiang Gao, Gurleen Kaur and Apurv Shah
+# Algonquin College
+# This file runs a stage over all the regional files of a directory. Each
+# file is independent, so with more than one worker the files are handed
+# out to a pool of processes, largest file first so that the longest region
+# does not start last.
+#
+# With workers the printed progress of every region goes to its own log
+# file (logs/<stage>_<filename>.log) instead of being mixed on the console.
+# The result tuple of every region is still returned to main_program, in
+# the same order as os.listdir, so the summary printed at the end does not
+# change.
+#
+# Every region is timed with Metrics.py when the stage is run with
+# --metrics or --progress. With workers the metrics of every region are
+# sent back with its result.
+
+import os
+import argparse
+import contextlib
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from Metrics import metrics
+from ColumnStore import region_files, region_path
+
+LOG_DIR = 'logs'
+
+
+def stage_arg_parser(description):
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of regional files processed at the '
+                             'same time (default: 1)')
+    parser.add_argument('--metrics', default=None, metavar='FILE',
+                        help='write the time, rows, API calls and peak '
+                             'memory of every region to FILE as JSON')
+    parser.add_argument('--progress', action='store_true',
+                        help='show a live progress line on stderr')
+    return parser
+
+
+# List the files of a directory, largest first
+def files_by_size(directory):
+    filenames = region_files(directory)
+    return sorted(filenames,
+                  key=lambda f: os.path.getsize(region_path(directory, f)),
+                  reverse=True)
+
+
+def _run_one(func, directory, filename, log_path, args, kwargs, stage,
+             collect=False):
+    # A worker records the metrics of its region only, for the main process
+    if (collect):
+        metrics.start(collect=True)
+
+    with contextlib.ExitStack() as stack:
+        if (log_path is not None):
+            log = stack.enter_context(open(log_path, 'w'))
+            stack.enter_context(contextlib.redirect_stdout(log))
+        with metrics.region(stage, filename):
+            result = func(directory, filename, *args, **kwargs)
+
+    if (collect):
+        return (result, metrics.snapshot())
+    return result
+
+
+# Number of regional files run_files processes at the same time, eg. to
+# split a request rate between the workers
+def pool_size(directory, workers=1):
+    if (workers is None or workers <= 1):
+        return 1
+    return max(1, min(workers, len(region_files(directory))))
+
+
+# Call func(directory, filename, *args, **kwargs) for every file in the
+# directory and return the list of results
+def run_files(func, directory, workers=1, args=(), kwargs=None,
+              stage=None, log_dir=LOG_DIR):
+    if (kwargs is None):
+        kwargs = {}
+
+    filenames = region_files(directory)
+    if (stage is None):
+        stage = func.__name__
+
+    if (pool_size(directory, workers) <= 1):
+        return [_run_one(func, directory, filename, None, args, kwargs, stage)
+                for filename in filenames]
+
+    os.makedirs(log_dir, exist_ok=True)
+
+    futures = {}
+    with ProcessPoolExecutor(max_workers=pool_size(directory, workers)) as pool:
+        for filename in files_by_size(directory):
+            log_path = os.path.join(log_dir, stage + '_' + filename + '.log')
+            print('Starting.... ' + filename + ' (log: ' + log_path + ')')
+            futures[filename] = pool.submit(_run_one, func, directory, filename,
+                                            log_path, args, kwargs, stage,
+                                            metrics.enabled)
+
+        names = {future: filename for filename, future in futures.items()}
+        for future in as_completed(names):
+            print('Finished.... ' + names[future])
+
+    results = [futures[filename].result() for filename in filenames]
+    if (metrics.enabled):
+        for (result, snapshot) in results:
+            metrics.merge(snapshot)
+        results = [result for (result, snapshot) in results]
+    return results
@@ -0,0 +1,413 @@
+#!/usr/bin/python3
+# CRA OCAD Project
+#
+# Pipeline.py
+# Created for group project:
+# Andrew Campbell, Xiang Gao, Gurleen Kaur and Apurv Shah
+# Algonquin College
+# This file runs the numbered stages for every regional file in one
+# process. The data is passed from one stage to the next in memory, instead
+# of being written to and read back from the CSV folders:
+# 1_StartFiles -> 1 -> 2 -> 3 -> 4 -> 5 -> 5_FinalLists
+#
+# The intermediate folders (2_LatLongLists, 3_ComboLists and
+# 3_FarSummaries, 4_CostLists) are only written with --write. 4_CostLists
+# is always written when stage 4 runs, as the lookup journal refers to it.
+# A stage left out of --stages takes its input from the folders, as when
+# the stages are run one by one.
+#
+# A stage is skipped when the hash of its inputs and options is the same as
+# in the last run, and the output it wrote then has not changed since. The
+# hashes are kept in PipelineState/<filename>.json. The output of a skipped
+# stage is only read from its folder if a later stage needs it. Stage 4 is
+# never skipped, each run adds lookups.
+#
+# Only a stage whose output is in its folder can be skipped, as a later
+# stage may need to read it back. Stages 1 and 2 are skipped only when the
+# run that made them had --write 1 and --write 2, stage 3 when 4_CostLists
+# was written (--write 3, or stage 4 in the run), stage 5 always. Without
+# --write every run redoes stages 1 and 2.
+#
+# 3_ComboLists and 4_CostLists are read and written through ColumnStore.py,
+# as CSV or with --store parquet as Parquet, the same as stages 2 and 3.
+# 2_LatLongLists stays CSV, as stage 2 reads it as CSV.
+
+import os
+import json
+import hashlib
+import importlib
+import pandas as pd
+from ParallelRunner import stage_arg_parser, run_files, pool_size
+from Metrics import metrics
+from GeoDistance import METHODS
+from GeocodeCache import GeocodeCache, DEFAULT_CACHE
+from GeocodeResolver import (load_postal_code_lookup, POSTAL_CODES_CSV,
+                             worker_rps, DEFAULT_RPS, DEFAULT_THREADS)
+from DrivingDistCache import DEFAULT_DD_CACHE
+from NeighborIndex import (far_summary_path, read_far_summary,
+                           write_far_summary, remove_far_summary)
+from LookupJournal import journal_path, read_with_journal, remove_journal
+from FsaDistTable import get_fsa_multipliers
+from ColumnStore import STORE_FORMATS, read_region, write_region, region_path
+
+# The stages are imported for their functions, they do not run on import
+latLongGenerator = importlib.import_module('1_LatLongGenerator')
+genOriDstComb    = importlib.import_module('2_GenOriDstComb')
+costLOSD         = importlib.import_module('3_CostLOSD')
+ddCalcs          = importlib.import_module('4_DDCalcs')
+finalCost        = importlib.import_module('5_FinalCost')
+
+STATE_DIR = 'PipelineState'
+
+STAGES = [1, 2, 3, 4, 5]
+
+
+# Content hash of data frames (None for a missing frame)
+def frame_hash(*frames):
+    h = hashlib.sha256()
+    for df in frames:
+        if (df is None):
+            h.update(b'None')
+            continue
+        h.update(','.join(str(col) for col in df.columns).encode())
+        h.update(pd.util.hash_pandas_object(df, index=False).values.tobytes())
+    return h.hexdigest()
+
+
+# Content hash of files (None for a missing file)
+def file_hash(*paths):
+    h = hashlib.sha256()
+    for path in paths:
+        if (not os.path.exists(path)):
+            h.update(b'None')
+            continue
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                h.update(block)
+    return h.hexdigest()
+
+
+# Size and modification time of files, to see if they changed since
+def file_stamp(*paths):
+    stamp = []
+    for path in paths:
+        if (os.path.exists(path)):
+            stat = os.stat(path)
+            stamp.append([stat.st_size, stat.st_mtime_ns])
+        else:
+            stamp.append(None)
+    return stamp
+
+
+def stage_key(stage, options, *inputs):
+    return hashlib.sha256(json.dumps([stage, options, inputs]).encode()).hexdigest()
+
+
+# The postal code lookup csv, loaded once per process when stage 1 runs
+postalCodeLookup = None
+
+def postal_code_lookup():
+    global postalCodeLookup
+    if (postalCodeLookup is None):
+        postalCodeLookup = load_postal_code_lookup()
+    return postalCodeLookup
+
+
+def parse_stages(text):
+    if (text == 'all'):
+        return list(STAGES)
+    stages = sorted(set(int(s) for s in text.split(',') if s != ''))
+    for stage in stages:
+        if (stage not in STAGES):
+            raise ValueError('no stage ' + str(stage))
+    return stages
+
+
+class PipelineState:
+
+    def __init__(self, filename):
+        self.path = os.path.join(STATE_DIR, filename + '.json')
+        self.stages = {}
+        if (os.path.exists(self.path)):
+            with open(self.path) as f:
+                self.stages = json.load(f)
+
+    # The output of the last run of a stage, if its inputs had the hash key
+    # and its output files did not change since (or only still exist if
+    # exact is False)
+    def unchanged(self, stage, key, paths, exact=True):
+        entry = self.stages.get(str(stage))
+        if (entry is None or entry['key'] != key or entry['stamp'] is None):
+            return None
+        if (exact and entry['stamp'] != file_stamp(*paths)):
+            return None
+        if (not exact and not all(os.path.exists(path) for path in paths)):
+            return None
+        return entry
+
+    def record(self, stage, key, output, paths=None, result=None):
+        stamp = file_stamp(*paths) if paths is not None else None
+        self.stages[str(stage)] = {'key': key, 'output': output,
+                                   'stamp': stamp, 'result': result}
+
+    def save(self):
+        os.makedirs(STATE_DIR, exist_ok=True)
+        with open(self.path + '.tmp', 'w') as f:
+            json.dump(self.stages, f, indent=1)
+        os.replace(self.path + '.tmp', self.path)
+
+
+def run_region(directory, filename, stages=STAGES, write=(), force=False,
+               cache_path=None, rps=DEFAULT_RPS, threads=DEFAULT_THREADS,
+               method='vincenty', radius=None, dd_cache_path=None,
+               lookup_options=None, fsa_table=None, store='csv'):
+    print('Working on.... ' + filename)
+
+    state = PipelineState(filename)
+    if (force):
+        state.stages = {}
+
+    startPath = directory + '/' + filename
+    llPath    = '2_LatLongLists/' + filename
+    finalPath = '5_FinalLists/' + filename
+    farPath   = far_summary_path(filename)
+
+    # The combinations and costs are <filename> or its Parquet file, 
+    # whichever was written last
+    comboPath = lambda: region_path('3_ComboLists', filename)
+    costPath  = lambda: region_path('4_CostLists', filename)
+
+    # Frames are read from the folders only when a stage needs them
+    loaders = {
+        'start':   lambda: pd.read_csv(startPath, header=0),
+        'latlong': lambda: read_region('2_LatLongLists', filename),
+        'combos':  lambda: read_region('3_ComboLists', filename),
+        'far':     lambda: read_far_summary(filename),
+        'costs':   lambda: read_with_journal('4_CostLists', filename),
+    }
+    data = {}
+
+    def get(name):
+        if (name not in data):
+            data[name] = loaders[name]()
+        return data[name]
+
+    def skip(stage, key, paths, exact=True):
+        entry = state.unchanged(stage, key, paths, exact)
+        if (entry is not None):
+            print('Stage', stage, 'inputs unchanged, skipped')
+        return entry
+
+    # Stage 1: Lat/Long of every postal code
+    startHash = file_hash(startPath)
+    key = stage_key(1, [file_stamp(POSTAL_CODES_CSV)], startHash)
+    entry = skip(1, key, [llPath]) if 1 in stages else None
+    if (1 not in stages):
+        llHash = file_hash(llPath)
+    elif (entry is not None):
+        llHash = entry['output']
+    else:
+        (lat_lookup, long_lookup) = postal_code_lookup()
+        cache = GeocodeCache(cache_path) if cache_path is not None else None
+        with metrics.region('1_LatLongGenerator', filename):
+            data['latlong'] = latLongGenerator.lat_long_frame(get('start'),
+                                                              lat_lookup,
+                                                              long_lookup,
+                                                              cache, rps,
+                                                              threads)
+        if (cache is not None):
+            cache.close()
+        llHash = frame_hash(data['latlong'])
+        if (1 in write):
+            write_region(data['latlong'], '2_LatLongLists', filename,
+                         index='PostalCode')
+            state.record(1, key, llHash, [llPath])
+        else:
+            state.record(1, key, llHash)
+
+    # Stage 2: Combinations and their LOSD
+    # The store is only in the key when it is not the default, so the 
+    # states of earlier runs stay valid
+    storeOptions = [] if store == 'csv' else [store]
+    key = stage_key(2, [method, radius] + storeOptions, startHash, llHash)
+    entry = skip(2, key, [comboPath(), farPath]) if 2 in stages else None
+    if (2 not in stages):
+        comboHash = file_hash(comboPath(), farPath)
+    elif (entry is not None):
+        comboHash = entry['output']
+    else:
+        (start_df, lat_lng_df) = (get('start'), get('latlong'))
+        with metrics.region('2_GenOriDstComb', filename):
+            if (radius is not None):
+                (postalCodes, lats, lngs) = genOriDstComb.sites_from_frames(
+                    start_df, lat_lng_df)
+                (data['combos'], data['far']) = genOriDstComb.radius_frame(
+                    postalCodes, lats, lngs, radius, method=method)
+            else:
+                data['combos'] = genOriDstComb.combination_frame(
+                    start_df, lat_lng_df, method)
+                data['far'] = None
+        print('Combinations:', len(data['combos']))
+        comboHash = frame_hash(data['combos'], data['far'])
+        if (2 in write):
+            write_region(data['combos'], '3_ComboLists', filename, store)
+            if (data['far'] is not None):
+                write_far_summary(filename, data['far'])
+            else:
+                remove_far_summary(filename)
+            state.record(2, key, comboHash, [comboPath(), farPath])
+        else:
+            state.record(2, key, comboHash)
+
+    # Stage 3: LOSD cost, stage 4 needs it in 4_CostLists for the journal.
+    # 4_CostLists changes after stage 3 (eg. compacting the journal), so 
+    # the stage is skipped as long as the file is there, and the hash of 
+    # the costs is taken from the file and the journal.
+    key = stage_key(3, [dd_cache_path] + storeOptions, comboHash)
+    entry = skip(3, key, [costPath()], exact=False) if 3 in stages else None
+    if (3 not in stages or entry is not None):
+        costHash = file_hash(costPath(), journal_path(filename))
+    else:
+        (combo_df, far_df) = (get('combos'), get('far'))
+        with metrics.region('3_CostLOSD', filename):
+            (data['costs'], aggregates) = costLOSD.cost_frame(combo_df, far_df,
+                                                              dd_cache_path)
+        print(filename, *aggregates)
+        if (3 in write or 4 in stages):
+            write_region(data['costs'], '4_CostLists', filename, store)
+            remove_journal(filename)
+            costHash = file_hash(costPath(), journal_path(filename))
+            state.record(3, key, costHash, [costPath()])
+        else:
+            costHash = frame_hash(data['costs'])
+            state.record(3, key, costHash)
+
+    # Stage 4: Driving distance lookups, appended to the journal
+    if (4 in stages):
+        cost_df = get('costs')
+        with metrics.region('4_DDCalcs', filename):
+            (data['costs'], cumMult_list, updateCount) = ddCalcs.run_lookups(
+                cost_df, filename, **(lookup_options or {}))
+        costHash = file_hash(costPath(), journal_path(filename))
+
+    # Stage 5: Final cost, always written
+    key = stage_key(5, [] if fsa_table is None else [file_stamp(fsa_table)],
+                    costHash, comboHash)
+    entry = skip(5, key, [finalPath]) if 5 in stages else None
+    result = None
+    if (5 not in stages):
+        pass
+    elif (entry is not None):
+        result = tuple(entry['result'])
+    else:
+        (cost_df, far_df) = (get('costs'), get('far'))
+        with metrics.region('5_FinalCost', filename):
+            fsa_mult = None
+            if (fsa_table is not None):
+                fsa_mult = get_fsa_multipliers(fsa_table)
+            (final_df, result) = finalCost.final_frame(cost_df, filename,
+                                                       far_df, fsa_mult)
+        result = tuple(value.item() if hasattr(value, 'item') else value
+                       for value in result)
+        final_df.set_index('Origin').to_csv(finalPath)
+        state.record(5, key, frame_hash(final_df), [finalPath], list(result))
+
+    state.save()
+    print('Done with.... ' + filename)
+
+    return (filename,) + (result if result is not None else ())
+
+
+def main_program(argv=None):
+    parser = stage_arg_parser('Run the stages in one process for every '
+                              'start file')
+    parser.add_argument('--stages', type=parse_stages, default=STAGES,
+                        help='stages to run, eg. 1,2,3,5 (default: all)')
+    parser.add_argument('--write', type=parse_stages, default=[],
+                        help='stages whose output folder is written, eg. '
+                             '1,2,3 or all (5_FinalLists is always written). '
+                             'Only written stages are skipped on the next '
+                             'run.')
+    parser.add_argument('--force', action='store_true',
+                        help='run every stage even if its inputs did not '
+                             'change')
+    parser.add_argument('--method', choices=METHODS, default='vincenty',
+                        help='distance formula used for the LOSD')
+    parser.add_argument('--radius', type=int, default=None,
+                        help='only keep rows for pairs under this LOSD (km)')
+    parser.add_argument('--store', choices=STORE_FORMATS, default='csv',
+                        help='format of 3_ComboLists and 4_CostLists '
+                             '(parquet needs pyarrow, see ColumnStore.py)')
+    parser.add_argument('--cache', default=DEFAULT_CACHE,
+                        help='geocode cache file shared across runs')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='always use the Google Maps API')
+    parser.add_argument('--rps', type=float, default=DEFAULT_RPS,
+                        help='maximum geocode requests per second, shared '
+                             'by all workers')
+    parser.add_argument('--geocode-threads', type=int, default=DEFAULT_THREADS,
+                        help='geocode requests sent at the same time')
+    parser.add_argument('--dd-cache', default=DEFAULT_DD_CACHE,
+                        help='driving distance cache shared across runs')
+    parser.add_argument('--no-dd-cache', action='store_true',
+                        help='always use the Google Maps API')
+    parser.add_argument('--pack-singles', action='store_true',
+                        help='also send pairs that share no location in '
+                             'one request (fewer requests, but unused '
+                             'elements are billed, see '
+                             'DistanceMatrixBatch.py)')
+    parser.add_argument('--ci-width', type=float,
+                        default=ddCalcs.DEFAULT_CI_WIDTH,
+                        help='stop a region once the confidence interval of '
+                             'its multiplier is narrower than this')
+    parser.add_argument('--seed', type=int, default=None,
+                        help='seed for the random selection of pairs')
+    parser.add_argument('--road-network', default=None, metavar='DIR',
+                        help='look up driving distances on the road network '
+                             'in DIR instead of Google Maps')
+    parser.add_argument('--max-lookups', type=int, default=None,
+                        help='lookups per region instead of the fixed '
+                             'number of each region')
+    parser.add_argument('--fsa-table', default=None, metavar='FILE',
+                        help='use the multiplier of the FSA pair from this '
+                             'table (see FsaDistTable.py) for the pairs '
+                             'without a lookup')
+    args = parser.parse_args(argv)
+    metrics.start(args.metrics, args.progress)
+    cache_path = None if args.no_cache else args.cache
+    dd_cache_path = None if args.no_dd_cache else args.dd_cache
+
+    directory = '1_StartFiles'
+
+    # The workers share the request rate
+    rps = worker_rps(args.rps, pool_size(directory, args.workers))
+
+    results = run_files(run_region, directory, args.workers,
+                        kwargs={'stages': args.stages,
+                                'write': args.write,
+                                'force': args.force,
+                                'cache_path': cache_path,
+                                'rps': rps,
+                                'threads': args.geocode_threads,
+                                'method': args.method,
+                                'radius': args.radius,
+                                'dd_cache_path': dd_cache_path,
+                                'lookup_options': {
+                                    'pack_singles': args.pack_singles,
+                                    'dd_cache_path': dd_cache_path,
+                                    'ci_width': args.ci_width,
+                                    'seed': args.seed,
+                                    'road_network': args.road_network,
+                                    'max_lookups': args.max_lookups},
+                                'fsa_table': args.fsa_table,
+                                'store': args.store},
+                        stage='Pipeline')
+
+    print("Region   AvgDist  TotalDist  TotalRec Mult TotalCost u300Cost o300Cost corr")
+    for result in results:
+        print(result)
+
+    metrics.save()
+
+if __name__ == '__main__':
+    main_program()
@@ -0,0 +1,263 @@
+#!/usr/bin/python3
+# CRA OCAD Project
+#
+# PostalCodeIndex.py
+# Created for group project:
+# Andrew Campbell, Xiang Gao, Gurleen Kaur and Apurv Shah
+# Algonquin College
+# This file compiles CanadianPostalCodes.csv into a compact index that is
+# memory-mapped instead of parsed on every run. A postal code (A9A9A9) is
+# packed into one integer, the codes are sorted and looked up with a binary
+# search, a whole list of codes at a time.
+#
+# The index is kept in 1_PostalCodes/Index:
+#   Codes.npy      packed postal codes, sorted (uint32)
+#   Latitude.npy   Lat/Long in the order of Codes.npy, as micro-degrees
+#   Longitude.npy  (int32) when that holds the CSV values exactly,
+#                  otherwise as float64
+#   Meta.json      the CSV it was built from, the scale of the Lat/Long,
+#                  the overrides and the rows whose code does not pack
+#
+# It is rebuilt when the CSV or the overrides change, or with
+# python PostalCodeIndex.py
+#
+# Some postal codes need to be modified slightly to get the correct lookup,
+# these are in OVERRIDES and are applied before every lookup.
+
+import os
+import json
+import argparse
+import numpy as np
+import pandas as pd
+
+# Postal codes with known Lat/Long
+POSTAL_CODES_CSV = '1_PostalCodes/CanadianPostalCodes.csv'
+INDEX_DIR = '1_PostalCodes/Index'
+
+# Postal code -> postal code looked up instead
+OVERRIDES = {'A1E0G5': 'A1E0B9',
+             'V3Z9R6': 'V3S9R2'}
+
+# Lat/Long are kept as integers of 1/MICRO_DEGREES degree when possible
+MICRO_DEGREES = 1000000
+
+
+def remap_postal_code(pc, overrides=OVERRIDES):
+    return overrides.get(pc, pc)
+
+
+# Pack postal codes of the form A9A9A9 into integers (the letters base 26,
+# the digits base 10). Returns -1 for anything else.
+def pack_codes(codes):
+    codes = np.asarray(codes, dtype=str)
+    if (len(codes) == 0):
+        return np.zeros(0, dtype=np.int64)
+    valid = np.char.str_len(codes) == 6
+    chars = (codes.astype('<U6').view(np.uint32).reshape(len(codes), 6)
+             .astype(np.int64))
+    letters = chars[:, 0::2] - ord('A')
+    digits = chars[:, 1::2] - ord('0')
+    valid &= ((letters >= 0) & (letters < 26)).all(axis=1)
+    valid &= ((digits >= 0) & (digits < 10)).all(axis=1)
+
+    packed = np.zeros(len(codes), dtype=np.int64)
+    for n in range(3):
+        packed = (packed * 26 + letters[:, n]) * 10 + digits[:, n]
+    return np.where(valid, packed, -1)
+
+
+def csv_stamp(csv_path):
+    stat = os.stat(csv_path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+# Store values as micro-degrees if that gives back the exact same floats
+def fixed_point(values):
+    micro = np.round(values * MICRO_DEGREES)
+    if (np.all(np.abs(micro) < 2**31) and
+        np.array_equal(micro / MICRO_DEGREES, values)):
+        return (micro.astype(np.int32), MICRO_DEGREES)
+    return (values.astype(np.float64), 0)
+
+
+def build_index(csv_path=POSTAL_CODES_CSV, index_dir=INDEX_DIR,
+                overrides=OVERRIDES):
+    pc_df = pd.read_csv(csv_path, header=0)
+    pc_df = pc_df.drop_duplicates('PostalCode', keep='last')
+
+    codes = pc_df['PostalCode'].values
+    lats = pc_df['Latitude'].values.astype(np.float64)
+    lngs = pc_df['Longitude'].values.astype(np.float64)
+
+    # Rows whose postal code does not pack are kept as they are
+    packed = pack_codes(codes)
+    odd = packed < 0
+    extras = {str(pc): [float(lat), float(lng)]
+              for (pc, lat, lng) in zip(codes[odd], lats[odd], lngs[odd])}
+
+    order = np.argsort(packed[~odd], kind='stable')
+    (latValues, scale) = fixed_point(lats[~odd][order])
+    (lngValues, lngScale) = fixed_point(lngs[~odd][order])
+    if (scale != lngScale):
+        (latValues, scale) = (lats[~odd][order], 0)
+        lngValues = lngs[~odd][order]
+
+    os.makedirs(index_dir, exist_ok=True)
+    np.save(os.path.join(index_dir, 'Codes.npy'),
+            packed[~odd][order].astype(np.uint32))
+    np.save(os.path.join(index_dir, 'Latitude.npy'), latValues)
+    np.save(os.path.join(index_dir, 'Longitude.npy'), lngValues)
+
+    # Written last, an index without it is rebuilt
+    meta = {'csv': os.path.abspath(csv_path), 'stamp': csv_stamp(csv_path),
+            'scale': scale, 'overrides': overrides, 'extras': extras}
+    with open(os.path.join(index_dir, 'Meta.json.tmp'), 'w') as f:
+        json.dump(meta, f)
+    os.replace(os.path.join(index_dir, 'Meta.json.tmp'),
+               os.path.join(index_dir, 'Meta.json'))
+
+    return (len(order), len(extras))
+
+
+class PostalCodeIndex:
+
+    def __init__(self, index_dir=INDEX_DIR):
+        self.index_dir = index_dir
+        with open(os.path.join(index_dir, 'Meta.json')) as f:
+            self.meta = json.load(f)
+        self.overrides = self.meta['overrides']
+        self.extras = self.meta['extras']
+        self.scale = self.meta['scale']
+        self.codes = np.load(os.path.join(index_dir, 'Codes.npy'),
+                             mmap_mode='r')
+        self.lats = np.load(os.path.join(index_dir, 'Latitude.npy'),
+                            mmap_mode='r')
+        self.lngs = np.load(os.path.join(index_dir, 'Longitude.npy'),
+                            mmap_mode='r')
+
+    # Workers reopen the index rather than receive a copy of it
+    def __getstate__(self):
+        return {'index_dir': self.index_dir}
+
+    def __setstate__(self, state):
+        self.__init__(state['index_dir'])
+
+    def __len__(self):
+        return len(self.codes) + len(self.extras)
+
+    def _degrees(self, values):
+        if (self.scale == 0):
+            return np.asarray(values, dtype=np.float64)
+        return np.asarray(values, dtype=np.float64) / self.scale
+
+    # Return (found, lats, lngs) arrays for a list of postal codes, the
+    # Lat/Long are NaN where found is False
+    def locate(self, postalCodes):
+        postalCodes = [remap_postal_code(pc, self.overrides)
+                       for pc in postalCodes]
+        packed = pack_codes(postalCodes)
+
+        pos = np.searchsorted(self.codes, packed)
+        pos = np.minimum(pos, len(self.codes) - 1)
+        if (len(self.codes) > 0):
+            found = (packed >= 0) & (self.codes[pos] == packed)
+        else:
+            found = np.zeros(len(packed), dtype=bool)
+
+        lats = np.full(len(packed), np.nan)
+        lngs = np.full(len(packed), np.nan)
+        lats[found] = self._degrees(self.lats[pos[found]])
+        lngs[found] = self._degrees(self.lngs[pos[found]])
+
+        for n in np.flatnonzero(~found):
+            extra = self.extras.get(str(postalCodes[n]))
+            if (extra is not None):
+                (found[n], lats[n], lngs[n]) = (True, extra[0], extra[1])
+
+        return (found, lats, lngs)
+
+    # (lat, long) of one postal code, or None
+    def find(self, postalCode):
+        (found, lats, lngs) = self.locate([postalCode])
+        if (not found[0]):
+            return None
+        return (float(lats[0]), float(lngs[0]))
+
+
+# One coordinate of the index, used where a {postalCode: lat} dictionary
+# was used before
+class CoordinateView:
+
+    def __init__(self, index, column):
+        self.index = index
+        self.column = column
+
+    def __contains__(self, postalCode):
+        return self.index.find(postalCode) is not None
+
+    def __getitem__(self, postalCode):
+        location = self.index.find(postalCode)
+        if (location is None):
+            raise KeyError(postalCode)
+        return location[self.column]
+
+    def __len__(self):
+        return len(self.index)
+
+
+def index_is_current(csv_path=POSTAL_CODES_CSV, index_dir=INDEX_DIR,
+                     overrides=OVERRIDES):
+    metaPath = os.path.join(index_dir, 'Meta.json')
+    if (not os.path.exists(metaPath)):
+        return False
+    with open(metaPath) as f:
+        meta = json.load(f)
+    return (meta['csv'] == os.path.abspath(csv_path) and
+            meta['stamp'] == csv_stamp(csv_path) and
+            meta['overrides'] == overrides)
+
+
+# Open the index of the CSV, building it first if needed
+def load_index(csv_path=POSTAL_CODES_CSV, index_dir=INDEX_DIR):
+    if (not index_is_current(csv_path, index_dir)):
+        (packedCnt, extraCnt) = build_index(csv_path, index_dir)
+        print('Postal code index built:', packedCnt, 'codes',
+              '(' + str(extraCnt) + ' not packed)')
+    return PostalCodeIndex(index_dir)
+
+
+# Return (found, lats, lngs) arrays for a list of postal codes from the
+# lookups returned by load_postal_code_lookup, or from plain dictionaries
+def locate_in_lookup(postalCodes, lat_lookup, long_lookup,
+                     overrides=OVERRIDES):
+    if (isinstance(lat_lookup, CoordinateView) and
+        isinstance(long_lookup, CoordinateView) and
+        lat_lookup.index is long_lookup.index):
+        return lat_lookup.index.locate(postalCodes)
+
+    found = np.zeros(len(postalCodes), dtype=bool)
+    lats = np.full(len(postalCodes), np.nan)
+    lngs = np.full(len(postalCodes), np.nan)
+    for (n, pc) in enumerate(postalCodes):
+        postalCode = remap_postal_code(pc, overrides)
+        if (postalCode in lat_lookup):
+            (found[n], lats[n], lngs[n]) = (True, lat_lookup[postalCode],
+                                            long_lookup[postalCode])
+    return (found, lats, lngs)
+
+
+def main_program(argv=None):
+    parser = argparse.ArgumentParser(description='Build the postal code '
+                                     'index from ' + POSTAL_CODES_CSV)
+    parser.add_argument('--csv', default=POSTAL_CODES_CSV,
+                        help='postal code csv')
+    parser.add_argument('--index-dir', default=INDEX_DIR,
+                        help='folder of the index')
+    args = parser.parse_args(argv)
+
+    (packedCnt, extraCnt) = build_index(args.csv, args.index_dir)
+    print('Postal code index built:', packedCnt, 'codes',
+          '(' + str(extraCnt) + ' not packed)')
+
+if __name__ == '__main__':
+    main_program()
@@ -0,0 +1,371 @@
+#!/usr/bin/python3
+# CRA OCAD Project
+#
+# RoadNetwork.py
+# Created for group project:
+# Andrew Campbell, Xiang Gao, Gurleen Kaur and Apurv Shah
+# Algonquin College
+# This file computes driving distances on a local road graph instead of
+# the Google Distance Matrix API, so there is no daily limit on lookups.
+#
+# The graph is read from a folder with two files, eg. exported from
+# OpenStreetMap:
+#   Nodes.csv   NodeId,Lat,Long
+#   Edges.csv   FromNode,ToNode,Metres[,OneWay]
+# An edge is driveable both ways unless OneWay is 1.
+#
+# A coordinate is snapped to the nearest node within max_snap_km (a
+# GridIndex of the nodes, see NeighborIndex.py), and the straight line to
+# the node is added to the distance. The shortest paths are found with
+#   one origin, one destination - bidirectional A*, with the straight line
+#                                 distance to both ends as the potential
+#   one origin, many destinations (or the other way around on the reversed
+#                                 graph) - Dijkstra, stopped once the last
+#                                 destination is reached
+# Neither needs any preprocessing of the graph.
+#
+# RoadNetworkClient answers distance_matrix() like googlemaps.Client, so
+# it can be used wherever the Google client is (see 4_DDCalcs --road-network).
+# Statuses are OK, NOT_FOUND (no node near the coordinate) or ZERO_RESULTS
+# (no road between them).
+#
+# python RoadNetwork.py --grid DIR writes a small synthetic grid graph to
+# try it without any map data, and
+# python RoadNetwork.py DIR --origin "45.42, -75.69" --destination "..."
+# prints one distance.
+
+import os
+import math
+import heapq
+import argparse
+import numpy as np
+import pandas as pd
+from NeighborIndex import GridIndex
+from GeoDistance import haversine_km, EARTH_RADIUS_KM
+
+# Coordinates further than this from every node are NOT_FOUND
+DEFAULT_MAX_SNAP_KM = 5
+
+NODE_LABELS = ['NodeId', 'Lat', 'Long']
+EDGE_LABELS = ['FromNode', 'ToNode', 'Metres', 'OneWay']
+
+
+# Straight line distance in metres, for the A* potentials
+def straight_metres(lat1, lng1, lat2, lng2):
+    sinDLat = math.sin((lat2 - lat1) / 2)
+    sinDLng = math.sin((lng2 - lng1) / 2)
+    h = sinDLat**2 + math.cos(lat1) * math.cos(lat2) * sinDLng**2
+    return 2000 * EARTH_RADIUS_KM * math.asin(math.sqrt(min(h, 1.0)))
+
+
+# Adjacency lists as (start, heads, metres) lists: the edges leaving node v
+# are heads[start[v]:start[v+1]]
+def adjacency(tails, heads, metres, n):
+    order = np.argsort(tails, kind='stable')
+    start = np.concatenate([[0], np.cumsum(np.bincount(tails, minlength=n))])
+    return (start.tolist(), heads[order].tolist(), metres[order].tolist())
+
+
+class RoadNetwork:
+
+    def __init__(self, nodeIds, lats, lngs, fromNodes, toNodes, metres,
+                 oneWay=None):
+        self.nodeIds = np.asarray(nodeIds)
+        self.lats = np.asarray(lats, dtype=np.float64)
+        self.lngs = np.asarray(lngs, dtype=np.float64)
+        n = len(self.nodeIds)
+
+        # Node ids can be anything (eg. OSM ids), work on their position
+        order = np.argsort(self.nodeIds, kind='stable')
+        tails = order[np.searchsorted(self.nodeIds[order], fromNodes)]
+        heads = order[np.searchsorted(self.nodeIds[order], toNodes)]
+        metres = np.asarray(metres, dtype=np.float64)
+
+        # Every two-way edge is added in both directions
+        if (oneWay is None):
+            oneWay = np.zeros(len(tails), dtype=bool)
+        twoWay = ~np.asarray(oneWay, dtype=bool)
+        allTails = np.concatenate([tails, heads[twoWay]])
+        allHeads = np.concatenate([heads, tails[twoWay]])
+        allMetres = np.concatenate([metres, metres[twoWay]])
+
+        self.forward = adjacency(allTails, allHeads, allMetres, n)
+        self.reverse = adjacency(allHeads, allTails, allMetres, n)
+
+        # The potentials must never exceed the road distance, so scale the
+        # straight line by the shortest edge relative to its own straight
+        # line (edges are rarely shorter than that, but can be by rounding)
+        straight = haversine_km(self.lats[allTails], self.lngs[allTails],
+                                self.lats[allHeads], self.lngs[allHeads]) * 1000
+        ratio = allMetres[straight > 0] / straight[straight > 0]
+        self.scale = min(1.0, float(ratio.min()) if len(ratio) > 0 else 1.0)
+        self.scale *= 0.999999
+
+        self.radLats = np.radians(self.lats).tolist()
+        self.radLngs = np.radians(self.lngs).tolist()
+        self.grid = None
+
+    def __len__(self):
+        return len(self.nodeIds)
+
+    def edge_count(self):
+        return len(self.forward[1])
+
+    # Nearest node of a coordinate and the straight line to it in metres,
+    # or (None, None) if there is none within max_snap_km
+    def snap(self, lat, lng, max_snap_km=DEFAULT_MAX_SNAP_KM):
+        if (self.grid is None or self.grid.radius_km != max_snap_km):
+            self.grid = GridIndex(self.lats, self.lngs, max_snap_km)
+        row = math.floor(lat / self.grid.cell_lat)
+        col = math.floor(lng / self.grid.cell_lng)
+        near = [self.grid.cells[(row + dr, col + dc)]
+                for dr in (-1, 0, 1) for dc in (-1, 0, 1)
+                if (row + dr, col + dc) in self.grid.cells]
+        if (len(near) == 0):
+            return (None, None)
+        near = np.concatenate(near)
+        km = haversine_km(lat, lng, self.lats[near], self.lngs[near])
+        best = int(np.argmin(km))
+        if (km[best] > max_snap_km):
+            return (None, None)
+        return (int(near[best]), float(km[best]) * 1000)
+
+    def _potential(self, node, target):
+        return self.scale * straight_metres(self.radLats[node],
+                                            self.radLngs[node],
+                                            self.radLats[target],
+                                            self.radLngs[target])
+
+    # Road distance in metres from source to target, None if there is no
+    # path (bidirectional A* with average potentials)
+    def shortest(self, source, target):
+        if (source == target):
+            return 0.0
+
+        # pf(v) = (h_t(v) - h_s(v)) / 2, the reverse search uses -pf(v)
+        potentials = {}
+        def pf(v):
+            p = potentials.get(v)
+            if (p is None):
+                p = (self._potential(v, target) -
+                     self._potential(v, source)) / 2
+                potentials[v] = p
+            return p
+
+        dist = [{source: 0.0}, {target: 0.0}]
+        done = [set(), set()]
+        heaps = [[(pf(source), source)], [(-pf(target), target)]]
+        graphs = [self.forward, self.reverse]
+        signs = [1, -1]
+        best = math.inf
+
+        while (len(heaps[0]) > 0 and len(heaps[1]) > 0):
+            if (heaps[0][0][0] + heaps[1][0][0] >= best):
+                break
+
+            # Grow the side with the smaller queue
+            side = 0 if len(heaps[0]) <= len(heaps[1]) else 1
+            (key, u) = heapq.heappop(heaps[side])
+            if (u in done[side]):
+                continue
+            done[side].add(u)
+
+            (start, heads, metres) = graphs[side]
+            mine = dist[side]
+            other = dist[1 - side]
+            du = mine[u]
+            for e in range(start[u], start[u + 1]):
+                v = heads[e]
+                dv = du + metres[e]
+                if (dv < mine.get(v, math.inf)):
+                    mine[v] = dv
+                    heapq.heappush(heaps[side], (dv + signs[side] * pf(v), v))
+                    if (v in other and dv + other[v] < best):
+                        best = dv + other[v]
+        return None if best == math.inf else best
+
+    # Road distances in metres from source to every target (from every
+    # target to source when reverse is True), None where there is no path
+    def one_to_many(self, source, targets, reverse=False):
+        (start, heads, metres) = self.reverse if reverse else self.forward
+        left = set(targets)
+        dist = {source: 0.0}
+        done = set()
+        heap = [(0.0, source)]
+        while (len(heap) > 0 and len(left) > 0):
+            (du, u) = heapq.heappop(heap)
+            if (u in done):
+                continue
+            done.add(u)
+            left.discard(u)
+            for e in range(start[u], start[u + 1]):
+                v = heads[e]
+                dv = du + metres[e]
+                if (dv < dist.get(v, math.inf)):
+                    dist[v] = dv
+                    heapq.heappush(heap, (dv, v))
+        return [dist[t] if t in done else None for t in targets]
+
+
+def load_network(directory):
+    nodes_df = pd.read_csv(os.path.join(directory, 'Nodes.csv'), header=0)
+    edges_df = pd.read_csv(os.path.join(directory, 'Edges.csv'), header=0)
+    oneWay = None
+    if ('OneWay' in edges_df.columns):
+        oneWay = edges_df['OneWay'].fillna(0).astype(int).values == 1
+    return RoadNetwork(nodes_df['NodeId'].values, nodes_df['Lat'].values,
+                       nodes_df['Long'].values, edges_df['FromNode'].values,
+                       edges_df['ToNode'].values, edges_df['Metres'].values,
+                       oneWay)
+
+
+# Networks already read in this process, by folder
+_networks = {}
+
+def get_network(directory):
+    if (directory not in _networks):
+        _networks[directory] = load_network(directory)
+        print('Road network loaded:', len(_networks[directory]), 'nodes',
+              _networks[directory].edge_count(), 'edges')
+    return _networks[directory]
+
+
+# "lat, long" (as sent to Google) or (lat, long)
+def parse_location(location):
+    if (isinstance(location, str)):
+        (lat, lng) = location.split(',')
+        return (float(lat), float(lng))
+    return (float(location[0]), float(location[1]))
+
+
+def element(status, metres=None):
+    if (status != 'OK'):
+        return {'status': status}
+    metres = int(round(metres))
+    return {'status': 'OK',
+            'distance': {'text': str(round(metres / 1000, 1)) + ' km',
+                         'value': metres}}
+
+
+# Answers distance_matrix() from a RoadNetwork, in the form of the Google
+# Distance Matrix API
+class RoadNetworkClient:
+
+    # Recorded as the source of the distances in the driving distance cache
+    source = 'road'
+
+    def __init__(self, network, max_snap_km=DEFAULT_MAX_SNAP_KM):
+        self.network = network
+        self.max_snap_km = max_snap_km
+
+    def _snap_all(self, locations):
+        return [self.network.snap(*parse_location(location), self.max_snap_km)
+                for location in locations]
+
+    def distance_matrix(self, origins, destinations, mode='driving', **kwargs):
+        if (isinstance(origins, str)):
+            origins = [origins]
+        if (isinstance(destinations, str)):
+            destinations = [destinations]
+        oriSnaps = self._snap_all(origins)
+        dstSnaps = self._snap_all(destinations)
+
+        # metres[i][j] on the road, None if there is no path
+        dstNodes = [node for (node, off) in dstSnaps if node is not None]
+        oriNodes = [node for (node, off) in oriSnaps if node is not None]
+        metres = {}
+        if (len(set(oriNodes)) == 1 and len(set(dstNodes)) == 1):
+            for ori in set(oriNodes):
+                for dst in set(dstNodes):
+                    metres[(ori, dst)] = self.network.shortest(ori, dst)
+        elif (len(oriNodes) <= len(dstNodes)):
+            targets = list(set(dstNodes))
+            for ori in set(oriNodes):
+                for (dst, m) in zip(targets, self.network.one_to_many(
+                        ori, targets)):
+                    metres[(ori, dst)] = m
+        else:
+            targets = list(set(oriNodes))
+            for dst in set(dstNodes):
+                for (ori, m) in zip(targets, self.network.one_to_many(
+                        dst, targets, reverse=True)):
+                    metres[(ori, dst)] = m
+
+        rows = []
+        for (ori, oriOff) in oriSnaps:
+            elements = []
+            for (dst, dstOff) in dstSnaps:
+                if (ori is None or dst is None):
+                    elements.append(element('NOT_FOUND'))
+                elif (metres[(ori, dst)] is None):
+                    elements.append(element('ZERO_RESULTS'))
+                else:
+                    elements.append(element('OK', oriOff + metres[(ori, dst)]
+                                            + dstOff))
+            rows.append({'elements': elements})
+        return {'status': 'OK',
+                'origin_addresses': [str(o) for o in origins],
+                'destination_addresses': [str(d) for d in destinations],
+                'rows': rows}
+
+
+def get_road_client(directory, max_snap_km=DEFAULT_MAX_SNAP_KM):
+    return RoadNetworkClient(get_network(directory), max_snap_km)
+
+
+# Write a rows x cols grid of two-way streets spacing km apart, with every
+# other street slower (longer) so the shortest path is not just the
+# straight line
+def write_grid(directory, rows=40, cols=40, lat=45.0, lng=-76.0, spacing=0.5):
+    dLat = math.degrees(spacing / EARTH_RADIUS_KM)
+    dLng = dLat / math.cos(math.radians(lat))
+    ids = np.arange(rows * cols).reshape(rows, cols)
+    (r, c) = np.meshgrid(np.arange(rows), np.arange(cols), indexing='ij')
+    nodes_df = pd.DataFrame({'NodeId': ids.ravel() + 1000,
+                             'Lat': (lat + r * dLat).ravel(),
+                             'Long': (lng + c * dLng).ravel()})
+
+    fromNodes = np.concatenate([ids[:, :-1].ravel(), ids[:-1, :].ravel()])
+    toNodes = np.concatenate([ids[:, 1:].ravel(), ids[1:, :].ravel()])
+    straight = haversine_km(nodes_df['Lat'].values[fromNodes],
+                            nodes_df['Long'].values[fromNodes],
+                            nodes_df['Lat'].values[toNodes],
+                            nodes_df['Long'].values[toNodes]) * 1000
+    winding = np.where(np.concatenate([r[:, :-1].ravel(),
+                                       c[:-1, :].ravel()]) % 2 == 1, 1.5, 1.05)
+    edges_df = pd.DataFrame({'FromNode': fromNodes + 1000,
+                             'ToNode': toNodes + 1000,
+                             'Metres': np.round(straight * winding, 1),
+                             'OneWay': 0})
+
+    os.makedirs(directory, exist_ok=True)
+    nodes_df.to_csv(os.path.join(directory, 'Nodes.csv'), index=False)
+    edges_df.to_csv(os.path.join(directory, 'Edges.csv'), index=False)
+    return (len(nodes_df), len(edges_df))
+
+
+def main_program(argv=None):
+    parser = argparse.ArgumentParser(description='Driving distances on a '
+                                     'local road network')
+    parser.add_argument('directory', help='folder with Nodes.csv and '
+                                          'Edges.csv')
+    parser.add_argument('--grid', action='store_true',
+                        help='write a synthetic grid network to the folder')
+    parser.add_argument('--origin', help='"lat, long" to look up from')
+    parser.add_argument('--destination', help='"lat, long" to look up to')
+    parser.add_argument('--max-snap-km', type=float,
+                        default=DEFAULT_MAX_SNAP_KM,
+                        help='furthest a coordinate can be from the roads')
+    args = parser.parse_args(argv)
+
+    if (args.grid):
+        (nodeCnt, edgeCnt) = write_grid(args.directory)
+        print('Grid network written:', nodeCnt, 'nodes', edgeCnt, 'edges')
+        return
+
+    client = get_road_client(args.directory, args.max_snap_km)
+    distance = client.distance_matrix(args.origin, args.destination)
+    print(distance['rows'][0]['elements'][0])
+
+if __name__ == '__main__':
+    main_program()
@@ -0,0 +1,325 @@
+#!/usr/bin/python3
+# CRA OCAD Project
+#
+# RosterDelta.py
+# Created for group project:
+# Andrew Campbell, Xiang Gao, Gurleen Kaur and Apurv Shah
+# Algonquin College
+# This file updates a region after postal codes were added to or removed
+# from its start file, instead of running stages 1-5 again over all pairs.
+#
+# The start file is compared with 2_LatLongLists, the postal codes the
+# region was last processed with. Then:
+# - only the added postal codes are located (stage 1)
+# - only the pairs with an added postal code are measured (stage 2) and
+#   costed (stage 3), the pairs of the removed postal codes are dropped
+#   from 3_ComboLists, 3_FarSummaries and 4_CostLists
+# - the driving distances already looked up by 4_DDCalcs are kept
+# - 5_FinalCost is run again for the region (with --fsa-table if it was
+#   used for 5_FinalCost)
+# 2_LatLongLists is written last, so it always holds the postal codes the
+# other files were built from.
+#
+# A postal code which is in the start file a different number of times
+# than before is handled as removed and added again.
+
+import os
+import collections
+import importlib
+import datetime
+import numpy as np
+import pandas as pd
+from GeoDistance import losd_km, METHODS
+from NeighborIndex import (FarSummary, FAR_LABELS, iter_block_pairs,
+                           read_far_summary, write_far_summary)
+from ParallelRunner import stage_arg_parser, run_files, pool_size
+from Metrics import metrics
+from GeocodeCache import GeocodeCache, DEFAULT_CACHE
+from GeocodeResolver import (locate_postal_codes, load_postal_code_lookup,
+                             worker_rps, DEFAULT_RPS, DEFAULT_THREADS)
+from DrivingDistCache import (DrivingDistCache, DEFAULT_DD_CACHE,
+                              prefill_driving_dist)
+from LookupJournal import compact_journal
+from ColumnStore import read_region, write_region, region_format
+
+# The stages are imported for their functions, they do not run on import
+genOriDstComb = importlib.import_module('2_GenOriDstComb')
+costLOSD      = importlib.import_module('3_CostLOSD')
+finalCost     = importlib.import_module('5_FinalCost')
+
+LATLONG_LABELS = ['PostalCode', 'Latitude', 'Longitude']
+
+
+# Return the set of postal codes whose number of entries changed
+def roster_changes(oldCodes, newCodes):
+    oldCount = collections.Counter(oldCodes)
+    newCount = collections.Counter(newCodes)
+    return set(pc for pc in set(oldCount) | set(newCount)
+               if oldCount[pc] != newCount[pc])
+
+
+# Yield (i, j) index arrays with i < j for every pair of sites with at
+# least one site in changed (a boolean array), at most about chunk_size
+# pairs at a time
+def iter_changed_pairs(changed, chunk_size=1000000):
+    chgIdx = np.flatnonzero(changed)
+    keepIdx = np.flatnonzero(~changed)
+
+    # Changed x unchanged
+    step = max(1, chunk_size // max(len(keepIdx), 1))
+    for start in range(0, len(chgIdx), step):
+        part = chgIdx[start:start+step]
+        a = np.repeat(part, len(keepIdx))
+        b = np.tile(keepIdx, len(part))
+        yield (np.minimum(a, b), np.maximum(a, b))
+
+    # Changed x changed
+    for pair in iter_block_pairs(chgIdx, chgIdx, chunk_size):
+        yield pair
+
+
+# Measure the pairs with a changed site. Returns the index and LOSD arrays
+# in LOSD order, and if radius is set, only the pairs under radius km with
+# a far pair summary of the others (otherwise None).
+def measure_changed_pairs(postalCodes, lats, lngs, changed, method='vincenty',
+                          radius=None, chunk_size=1000000):
+    far = None
+    if (radius is not None):
+        far = FarSummary(np.array([str(pc)[:1] for pc in postalCodes]))
+
+    oriList = []
+    dstList = []
+    losdList = []
+    for (oriIdx, dstIdx) in iter_changed_pairs(changed, chunk_size):
+        losd = losd_km(lats[oriIdx], lngs[oriIdx],
+                       lats[dstIdx], lngs[dstIdx], method)
+        if (far is not None):
+            isNear = losd < radius
+            if (not isNear.all()):
+                far.add(oriIdx[~isNear], dstIdx[~isNear], losd[~isNear])
+            oriIdx, dstIdx, losd = oriIdx[isNear], dstIdx[isNear], losd[isNear]
+        oriList.append(oriIdx)
+        dstList.append(dstIdx)
+        losdList.append(losd)
+
+    if (len(oriList) > 0):
+        oriIdx = np.concatenate(oriList)
+        dstIdx = np.concatenate(dstList)
+        losd = np.concatenate(losdList)
+    else:
+        oriIdx = dstIdx = losd = np.zeros(0, dtype=np.int64)
+
+    # Same order as sorting itertools.combinations on LOSD
+    order = np.lexsort((dstIdx, oriIdx, losd))
+    far_df = far.to_frame() if far is not None else None
+    return (oriIdx[order], dstIdx[order], losd[order], far_df)
+
+
+# Add the counts of added_df to far_df and take away those of removed_df
+def update_far_summary(far_df, added_df, removed_df):
+    removed_df = removed_df.assign(Count=-removed_df['Count'])
+    far_df = pd.concat([far_df, added_df, removed_df])
+    far_df = far_df.groupby(['OriPrefix', 'DstPrefix', 'LOSD'],
+                            as_index=False)['Count'].sum()
+    if ((far_df['Count'] < 0).any()):
+        print("***ERROR***: Far summary does not match the previous "
+              "postal codes, run 2_GenOriDstComb again")
+    return far_df[far_df['Count'] > 0][FAR_LABELS]
+
+
+# Drop the rows of the removed postal codes from df, add new_df and keep
+# the rows in LOSD order. The rows of df stay before the new rows with the
+# same LOSD.
+def merge_rows(df, new_df, changed):
+    keep = ~(df['Origin'].isin(changed) | df['Destination'].isin(changed))
+    print("Rows removed:", int((~keep).sum()), " added:", len(new_df))
+    df = pd.concat([df[keep], new_df], ignore_index=True)
+    return df.sort_values('LOSD', kind='mergesort').reset_index(drop=True)
+
+
+def apply_delta(directory, filename, method='vincenty', radius=None,
+                cache_path=None, dd_cache_path=None,
+                rps=DEFAULT_RPS, threads=DEFAULT_THREADS, chunk_size=1000000,
+                fsa_table=None):
+    print('Working on.... ' + filename)
+
+    # The postal codes the region was last processed with
+    try:
+        old_df = pd.read_csv('2_LatLongLists/' + filename, header=0)
+        combo_df = read_region('3_ComboLists', filename)
+    except FileNotFoundError:
+        print("***ERROR***: " + filename + " was never processed, "
+              "run stages 1-5 first")
+        return (filename, None)
+    oldCodes = old_df['PostalCode'].tolist()
+    oldLats = old_df['Latitude'].values
+    oldLngs = old_df['Longitude'].values
+
+    # Read the source
+    df = pd.read_csv(directory+'/'+filename, header=0)
+    newCodes = df['Postal Code'].tolist()
+
+    changed = roster_changes(oldCodes, newCodes)
+    removed = [pc for pc in dict.fromkeys(oldCodes) if pc in changed]
+    added = [pc for pc in newCodes if pc in changed]
+    print("Postal codes removed:", len(removed), " added:", len(added))
+    if (len(changed) == 0):
+        print('Done with.... ' + filename)
+        return (filename, 0, 0)
+
+    # The far pair summary must be kept up to date with the same radius
+    far_df = read_far_summary(filename)
+    if (far_df is not None and radius is None):
+        print("***ERROR***: " + filename + " has a far pair summary, give "
+              "the --radius used by 2_GenOriDstComb")
+        return (filename, None)
+    if (far_df is None):
+        radius = None
+
+    # Stage 1: Lat/Long of the postal codes that are new to the region, 
+    # the others keep the Lat/Long they were processed with
+    known = dict(zip(oldCodes, zip(oldLats, oldLngs)))
+    unknown = list(dict.fromkeys(pc for pc in added if pc not in known))
+    if (len(unknown) > 0):
+        (lat_lookup, long_lookup) = load_postal_code_lookup()
+        cache = None
+        if (cache_path is not None):
+            cache = GeocodeCache(cache_path)
+        for (pc, lat, long) in locate_postal_codes(unknown, lat_lookup, 
+                                                   long_lookup, None, cache,
+                                                   rps, threads):
+            known[pc] = (lat, long)
+        if (cache is not None):
+            cache.close()
+
+    # Sites of the new roster, in the order of the start file. Postal 
+    # codes that could not be located are left out, as with stage 1.
+    locationList = [(pc,) + known[pc] for pc in newCodes if pc in known]
+    postalCodes = np.array([loc[0] for loc in locationList], dtype=object)
+    lats = np.array([loc[1] for loc in locationList], dtype=np.float64)
+    lngs = np.array([loc[2] for loc in locationList], dtype=np.float64)
+    isAdded = np.array([pc in changed for pc in postalCodes], dtype=bool)
+
+    # Stage 2: LOSD of the pairs with an added postal code only
+    print ("Starting LOSD Calculations. Time: "
+           + str(datetime.datetime.now().strftime('%H:%M:%S')))
+    (oriIdx, dstIdx, losd, added_far_df) = measure_changed_pairs(
+        postalCodes, lats, lngs, isAdded, method, radius, chunk_size)
+    new_df = genOriDstComb.pair_frame(postalCodes, lats, lngs,
+                                      oriIdx, dstIdx, losd)
+
+    # LOSD of 0 is updated to 1 as you may have atleast 1 km to drive
+    new_df = new_df.replace(0, 1)
+    print ("Done LOSD Calculations. Pairs: " + str(len(new_df)) + ". Time: "
+           + str(datetime.datetime.now().strftime('%H:%M:%S')))
+
+    combo_df = merge_rows(combo_df, new_df, changed)
+    combo_df.set_index('Origin', inplace=True)
+    write_region(combo_df, '3_ComboLists', filename,
+                 region_format('3_ComboLists', filename))
+
+    # The far pairs of the removed postal codes are measured again to take
+    # them out of the summary
+    if (far_df is not None):
+        isRemoved = np.array([pc in changed for pc in oldCodes], dtype=bool)
+        removed_far_df = measure_changed_pairs(
+            np.array(oldCodes, dtype=object), oldLats, oldLngs, isRemoved,
+            method, radius, chunk_size)[3]
+        far_df = update_far_summary(far_df, added_far_df, removed_far_df)
+        write_far_summary(filename, far_df)
+
+    # Stage 3: Cost of the added pairs only, the driving distances already
+    # looked up for the other pairs are kept
+    result = (filename, len(removed), len(added))
+    try:
+        compact_journal('4_CostLists', filename)
+        cost_df = read_region('4_CostLists', filename)
+    except FileNotFoundError:
+        cost_df = None
+    if (cost_df is not None):
+        costLOSD.add_cost_columns(new_df)
+        if (dd_cache_path is not None):
+            with DrivingDistCache(dd_cache_path) as dd_cache:
+                filled = prefill_driving_dist(new_df, dd_cache)
+            print('Driving distances from cache:', filled)
+
+        cost_df = merge_rows(cost_df, new_df, changed)
+        (avg, total, cnt, totalCost) = costLOSD.losd_aggregates(cost_df,
+                                                                far_df)
+        print(filename, avg, total, cnt, totalCost)
+        result = result + (avg, total, cnt, totalCost)
+
+        cost_df.set_index('Origin', inplace=True)
+        write_region(cost_df, '4_CostLists', filename,
+                     region_format('4_CostLists', filename))
+
+        # Stage 5: The multiplier is for the whole region, so every final
+        # cost is calculated again, with the options of 5_FinalCost
+        os.makedirs('5_FinalLists', exist_ok=True)
+        finalCost.generate_costs('4_CostLists', filename, fsa_table)
+
+    # The new list of postal codes
+    final_df = pd.DataFrame.from_records(locationList, columns=LATLONG_LABELS)
+    final_df.set_index('PostalCode', inplace=True)
+    final_df.to_csv('2_LatLongLists/' + filename)
+    print('Done with.... ' + filename)
+
+    return result
+
+
+def main_program(argv=None):
+    parser = stage_arg_parser('Update the regions for the postal codes '
+                              'added to or removed from the start files')
+    parser.add_argument('--method', choices=METHODS, default='vincenty',
+                        help='distance formula used for the LOSD')
+    parser.add_argument('--radius', type=int, default=None,
+                        help='radius given to 2_GenOriDstComb, for the '
+                             'regions with a far pair summary')
+    parser.add_argument('--chunk-size', type=int, default=1000000,
+                        help='pairs measured at a time')
+    parser.add_argument('--cache', default=DEFAULT_CACHE,
+                        help='geocode cache file shared across runs')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='always use the Google Maps API')
+    parser.add_argument('--dd-cache', default=DEFAULT_DD_CACHE,
+                        help='driving distance cache used to pre-fill '
+                             'DrivingDist and Mult')
+    parser.add_argument('--no-dd-cache', action='store_true',
+                        help='do not pre-fill driving distances')
+    parser.add_argument('--rps', type=float, default=DEFAULT_RPS,
+                        help='maximum geocode requests per second, shared '
+                             'by all workers')
+    parser.add_argument('--geocode-threads', type=int, default=DEFAULT_THREADS,
+                        help='geocode requests sent at the same time')
+    parser.add_argument('--fsa-table', default=None, metavar='FILE',
+                        help='FSA table given to 5_FinalCost (see '
+                             'FsaDistTable.py)')
+    args = parser.parse_args(argv)
+    metrics.start(args.metrics, args.progress)
+    cache_path = None if args.no_cache else args.cache
+    dd_cache_path = None if args.no_dd_cache else args.dd_cache
+
+    directory = '1_StartFiles'
+
+    # The workers share the request rate
+    rps = worker_rps(args.rps, pool_size(directory, args.workers))
+
+    results = run_files(apply_delta, directory, args.workers,
+                        kwargs={'method': args.method,
+                                'radius': args.radius,
+                                'cache_path': cache_path,
+                                'dd_cache_path': dd_cache_path,
+                                'rps': rps,
+                                'threads': args.geocode_threads,
+                                'chunk_size': args.chunk_size,
+                                'fsa_table': args.fsa_table},
+                        stage='RosterDelta')
+
+    print("Region   Removed  Added  AvgDist  TotalDist  TotalRec TotalCost")
+    for result in results:
+        print(result)
+
+    metrics.save()
+
+if __name__ == '__main__':
+    main_program()
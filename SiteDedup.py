@@ -0,0 +1,84 @@
+#!/usr/bin/python3
+# CRA OCAD Project
+#
+# SiteDedup.py
+# Created for group project:
+# Andrew Campbell, Xiang Gao, Gurleen Kaur and Apurv Shah
+# Algonquin College
+# This file reduces the sites of a region to their unique locations. Many
+# sites share a postal code, or end up at the same FSA centre when only
+# the first 3 characters of their postal code could be geocoded, and all
+# pairs between two such groups have the same LOSD.
+#
+# unique_locations  - the unique Lat/Long of the sites, with the number of
+#                     sites at each (multiplicity) and the location of
+#                     every site
+# dedup_losd        - the LOSD of a list of site pairs, measured once for
+#                     each unique pair of locations and copied to the rest
+# weighted_totals   - the LOSD total and pair count of a region from the
+#                     unique location pairs weighted by their number of
+#                     site pairs, without a row per pair
+#
+# The per pair rows written by 2_GenOriDstComb are still expanded from the
+# unique pairs, so they are the same as before.
+
+import numpy as np
+from GeoDistance import losd_km
+from PairStream import iter_pair_chunks
+
+
+# Return (locLats, locLngs, counts, siteLocation) for the sites
+def unique_locations(lats, lngs):
+    coords = np.column_stack([np.asarray(lats, dtype=np.float64),
+                              np.asarray(lngs, dtype=np.float64)])
+    (locs, siteLocation, counts) = np.unique(coords, axis=0,
+                                             return_inverse=True,
+                                             return_counts=True)
+    return (locs[:, 0], locs[:, 1], counts, siteLocation.ravel())
+
+
+# Return the LOSD of the site pairs (oriIdx[k], dstIdx[k]) and the number
+# of distances that were measured
+def dedup_losd(lats, lngs, oriIdx, dstIdx, method='vincenty',
+               locations=None):
+    if (locations is None):
+        locations = unique_locations(lats, lngs)
+    (locLats, locLngs, counts, siteLocation) = locations
+
+    # Every site has its own location
+    if (len(locLats) == len(lats)):
+        return (losd_km(lats[oriIdx], lngs[oriIdx], lats[dstIdx],
+                        lngs[dstIdx], method), len(oriIdx))
+
+    m = len(locLats)
+    keys = siteLocation[oriIdx] * m + siteLocation[dstIdx]
+    (uniqueKeys, pairKey) = np.unique(keys, return_inverse=True)
+    oriLoc = uniqueKeys // m
+    dstLoc = uniqueKeys % m
+    losd = losd_km(locLats[oriLoc], locLngs[oriLoc],
+                   locLats[dstLoc], locLngs[dstLoc], method)
+    return (losd[pairKey.ravel()], len(uniqueKeys))
+
+
+# Return (total, cnt) of the LOSD over all pairs of sites, as written by
+# 2_GenOriDstComb (an LOSD of 0 counts as 1)
+def weighted_totals(lats, lngs, method='vincenty', chunk_size=1000000,
+                    locations=None):
+    if (locations is None):
+        locations = unique_locations(lats, lngs)
+    (locLats, locLngs, counts, siteLocation) = locations
+    counts = counts.astype(np.int64)
+
+    # Pairs of two sites at the same location
+    sameCnt = int((counts * (counts - 1) // 2).sum())
+    total = sameCnt
+    cnt = sameCnt
+
+    for (oriLoc, dstLoc) in iter_pair_chunks(len(locLats), chunk_size):
+        losd = losd_km(locLats[oriLoc], locLngs[oriLoc],
+                       locLats[dstLoc], locLngs[dstLoc], method)
+        weight = counts[oriLoc] * counts[dstLoc]
+        total += int((np.where(losd == 0, 1, losd) * weight).sum())
+        cnt += int(weight.sum())
+
+    return (total, cnt)
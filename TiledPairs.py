@@ -0,0 +1,254 @@
+#!/usr/bin/python3
+# CRA OCAD Project
+#
+# TiledPairs.py
+# Created for group project:
+# Andrew Campbell, Xiang Gao, Gurleen Kaur and Apurv Shah
+# Algonquin College
+# This file generates the combinations of a very large region (eg. one
+# file for all of Canada) with a pool of processes. The pairs (i, j) with
+# i < j are split into tiles of consecutive origins holding about the same
+# number of pairs. The postal codes, Lat/Long and unique locations (see
+# SiteDedup.py) are put in shared memory once, every task only names its
+# tile.
+#
+# Every tile is measured by a worker and written to its own shard (index
+# and LOSD arrays in LOSD order, the number of pairs per km and a summary
+# with the partial aggregates: pairs, total LOSD, LOSD cost under and over
+# 300 km). The CSV is then written in parts, one range of LOSD km per task,
+# taking that range from every shard in tile order. This gives the same
+# order as sorting itertools.combinations on LOSD, so the file is the same
+# as the one of a serial run.
+
+import os
+import json
+import shutil
+import tempfile
+import importlib
+import numpy as np
+from multiprocessing import shared_memory
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from SiteDedup import unique_locations, dedup_losd
+from PairStream import iter_pair_chunks, pair_count
+from CostRules import LOSD_COST_RULES, apply_rules, zero_to_default
+from Metrics import metrics
+
+# Pairs per tile, a worker holds one tile in memory
+DEFAULT_TILE_PAIRS = 4000000
+
+
+# First origin of every tile, and n, so that the tiles have about the same
+# number of pairs
+def tile_bounds(n, tiles):
+    rows = np.arange(n + 1, dtype=np.int64)
+    pairsBefore = rows * (n - 1) - rows * (rows - 1) // 2
+    targets = np.linspace(0, pair_count(n), tiles + 1)
+    bounds = np.unique(np.searchsorted(pairsBefore, targets[:-1]))
+    return bounds.tolist() + [n]
+
+
+# The site arrays of a region and its unique locations in shared memory
+class SharedSites:
+
+    def __init__(self, postalCodes, lats, lngs):
+        lats = np.asarray(lats, dtype=np.float64)
+        lngs = np.asarray(lngs, dtype=np.float64)
+        (locLats, locLngs, counts, siteLocation) = unique_locations(lats, lngs)
+        arrays = {'codes': np.asarray(postalCodes, dtype=str),
+                  'lats': lats,
+                  'lngs': lngs,
+                  'locLats': locLats,
+                  'locLngs': locLngs,
+                  'counts': counts,
+                  'siteLocation': siteLocation}
+        self.blocks = []
+        self.layout = {}
+        for (name, array) in arrays.items():
+            block = shared_memory.SharedMemory(create=True,
+                                               size=max(array.nbytes, 1))
+            np.ndarray(array.shape, array.dtype, buffer=block.buf)[:] = array
+            self.blocks.append(block)
+            self.layout[name] = (block.name, array.dtype.str, array.shape)
+
+    def close(self):
+        for block in self.blocks:
+            block.close()
+            block.unlink()
+        self.blocks = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+# Site arrays of the worker, attached once when the worker starts
+_blocks = []
+_sites = {}
+
+def _attach(layout):
+    for (name, (blockName, dtype, shape)) in layout.items():
+        block = shared_memory.SharedMemory(name=blockName)
+        _blocks.append(block)
+        _sites[name] = np.ndarray(shape, np.dtype(dtype), buffer=block.buf)
+
+
+def measure_tile(tile, first, last, shardDir, method, chunk_size):
+    codes = _sites['codes']
+    lats = _sites['lats']
+    lngs = _sites['lngs']
+
+    locations = (_sites['locLats'], _sites['locLngs'], _sites['counts'],
+                 _sites['siteLocation'])
+
+    oriParts = []
+    dstParts = []
+    losdParts = []
+    total = 0
+    u300Cost = 0
+    o300Cost = 0
+    for (oriIdx, dstIdx) in iter_pair_chunks(len(codes), chunk_size,
+                                             first, last):
+        (losd, measured) = dedup_losd(lats, lngs, oriIdx, dstIdx, method,
+                                      locations)
+        oriParts.append(oriIdx)
+        dstParts.append(dstIdx)
+        losdParts.append(losd)
+
+        # Partial aggregates, LOSD of 0 is written as 1 (see
+        # 2_GenOriDstComb) and costed as in 3_CostLOSD
+        written = np.where(losd == 0, 1, losd)
+        cost = apply_rules(LOSD_COST_RULES, codes[oriIdx], codes[dstIdx],
+                           zero_to_default(written))
+        total += int(written.sum())
+        u300Cost += float(cost[written < 300].sum())
+        o300Cost += float(cost[written >= 300].sum())
+
+    if (len(losdParts) > 0):
+        oriIdx = np.concatenate(oriParts)
+        dstIdx = np.concatenate(dstParts)
+        losd = np.concatenate(losdParts)
+    else:
+        oriIdx = dstIdx = losd = np.zeros(0, dtype=np.int64)
+
+    # LOSD order, pairs of the same LOSD stay in combination order
+    order = np.argsort(losd, kind='stable')
+    os.makedirs(shardDir, exist_ok=True)
+    np.save(os.path.join(shardDir, 'ori.npy'), oriIdx[order].astype(np.int32))
+    np.save(os.path.join(shardDir, 'dst.npy'), dstIdx[order].astype(np.int32))
+    np.save(os.path.join(shardDir, 'losd.npy'), losd[order].astype(np.int32))
+    np.save(os.path.join(shardDir, 'perkm.npy'), np.bincount(losd))
+
+    summary = {'tile': tile, 'first': first, 'last': last,
+               'pairs': int(len(losd)), 'total': total,
+               'u300Cost': u300Cost, 'o300Cost': o300Cost}
+    with open(os.path.join(shardDir, 'summary.json'), 'w') as f:
+        json.dump(summary, f)
+    return summary
+
+
+# Write the rows of all shards with an LOSD from lo to hi - 1 km to path
+def write_part(path, lo, hi, shardDirs):
+    pair_frame = importlib.import_module('2_GenOriDstComb').pair_frame
+    codes = _sites['codes'].astype(object)
+
+    parts = []
+    for shardDir in shardDirs:
+        perKm = np.load(os.path.join(shardDir, 'perkm.npy'))
+        offsets = np.concatenate([[0], np.cumsum(perKm)])
+        start = offsets[min(lo, len(perKm))]
+        stop = offsets[min(hi, len(perKm))]
+        if (stop > start):
+            parts.append([np.load(os.path.join(shardDir, name + '.npy'),
+                                  mmap_mode='r')[start:stop]
+                          for name in ['ori', 'dst', 'losd']])
+    if (len(parts) == 0):
+        open(path, 'w').close()
+        return 0
+
+    oriIdx = np.concatenate([part[0] for part in parts]).astype(np.int64)
+    dstIdx = np.concatenate([part[1] for part in parts]).astype(np.int64)
+    losd = np.concatenate([part[2] for part in parts]).astype(np.int64)
+    order = np.argsort(losd, kind='stable')
+    (oriIdx, dstIdx, losd) = (oriIdx[order], dstIdx[order], losd[order])
+
+    chunk_df = pair_frame(codes, _sites['lats'], _sites['lngs'],
+                          oriIdx, dstIdx, losd)
+    # LOSD of 0 is updated to 1 as you may have atleast 1 km to drive
+    chunk_df = chunk_df.replace(0, 1)
+    with open(path, 'w', newline='') as f:
+        chunk_df.to_csv(f, header=False, index=False)
+    return len(chunk_df)
+
+
+# LOSD km ranges [lo, hi) of about chunk_size rows each
+def losd_ranges(perKm, chunk_size):
+    ranges = []
+    lo = 0
+    rows = 0
+    for km in range(len(perKm)):
+        rows += int(perKm[km])
+        if (rows >= chunk_size):
+            ranges.append((lo, km + 1))
+            (lo, rows) = (km + 1, 0)
+    if (lo < len(perKm)):
+        ranges.append((lo, len(perKm)))
+    return ranges
+
+
+# Measure all pairs of the sites and write them to path in LOSD order.
+# Returns the aggregates (total, cnt, u300Cost, o300Cost).
+def write_tiled(path, columns, postalCodes, lats, lngs, workers=None,
+                method='vincenty', chunk_size=1000000,
+                tile_pairs=DEFAULT_TILE_PAIRS, tmp_dir=None):
+    if (workers is None):
+        workers = os.cpu_count()
+    n = len(postalCodes)
+    pairCnt = pair_count(n)
+    tiles = max(1, workers, -(-pairCnt // max(int(tile_pairs), 1)))
+    bounds = tile_bounds(n, tiles)
+
+    with tempfile.TemporaryDirectory(dir=tmp_dir) as tmp:
+        with SharedSites(postalCodes, lats, lngs) as sites:
+            with ProcessPoolExecutor(max_workers=workers, initializer=_attach,
+                                     initargs=(sites.layout,)) as pool:
+                shardDirs = [os.path.join(tmp, 'shard' + str(tile))
+                             for tile in range(len(bounds) - 1)]
+                futures = [pool.submit(measure_tile, tile, bounds[tile],
+                                       bounds[tile + 1], shardDirs[tile],
+                                       method, chunk_size)
+                           for tile in range(len(bounds) - 1)]
+                done = 0
+                for future in as_completed(futures):
+                    done += future.result()['pairs']
+                    metrics.progress(done, pairCnt, 'pairs')
+                summaries = [future.result() for future in futures]
+
+                # Number of pairs per LOSD km over all shards
+                perKm = np.zeros(1, dtype=np.int64)
+                for shardDir in shardDirs:
+                    shardPerKm = np.load(os.path.join(shardDir, 'perkm.npy'))
+                    if (len(shardPerKm) > len(perKm)):
+                        perKm = np.pad(perKm, (0, len(shardPerKm) - len(perKm)))
+                    perKm[:len(shardPerKm)] += shardPerKm
+
+                ranges = losd_ranges(perKm, chunk_size)
+                partPaths = [os.path.join(tmp, 'part' + str(part) + '.csv')
+                             for part in range(len(ranges))]
+                list(pool.map(write_part, partPaths,
+                              [lo for (lo, hi) in ranges],
+                              [hi for (lo, hi) in ranges],
+                              [shardDirs] * len(ranges)))
+
+        with open(path, 'w', newline='') as out:
+            out.write(','.join(columns) + os.linesep)
+            for partPath in partPaths:
+                with open(partPath, 'r', newline='') as f:
+                    shutil.copyfileobj(f, out)
+
+    total = sum(summary['total'] for summary in summaries)
+    cnt = sum(summary['pairs'] for summary in summaries)
+    u300Cost = round(sum(summary['u300Cost'] for summary in summaries))
+    o300Cost = round(sum(summary['o300Cost'] for summary in summaries))
+    return (total, cnt, u300Cost, o300Cost)